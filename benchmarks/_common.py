@@ -0,0 +1,119 @@
+"""Helpers shared by the benchmark scripts."""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# Benchmark the checkout containing this file, not an installed version
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import mmappickle  # noqa: E402
+
+
+class BudgetExceeded(Exception):
+    """Raised when a benchmark (or its fixture) takes longer than its time budget."""
+    pass
+
+
+class Deadline:
+    """Time budget of a benchmark, in seconds (``None`` means no limit)."""
+
+    def __init__(self, budget):
+        self._end = None if budget is None else time.perf_counter() + budget
+
+    @property
+    def expired(self):
+        return self._end is not None and time.perf_counter() > self._end
+
+    def check(self):
+        if self.expired:
+            raise BudgetExceeded()
+
+
+def percentiles(latencies, points=(50, 90, 99)):
+    """:returns: a dict with the mean, max and the requested percentiles of ``latencies`` (seconds), in microseconds."""
+    if len(latencies) == 0:
+        return {}
+    latencies = sorted(latencies)
+    ret = {
+        'mean': 1e6 * sum(latencies) / len(latencies),
+        'max': 1e6 * latencies[-1],
+    }
+    for p in points:
+        idx = min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))
+        ret['p{}'.format(p)] = 1e6 * latencies[idx]
+    return ret
+
+
+def measure(op, args, deadline=None, nbytes=None):
+    """Call ``op(arg)`` for each ``arg`` in ``args``, recording the latency of each call.
+
+    :param op: the operation to measure
+    :param args: iterable of arguments, one per operation
+    :param deadline: a :class:`Deadline`, when it expires the measurement is stopped
+    :param nbytes: if not ``None``, function returning the number of bytes processed by ``op(arg)``
+    :returns: a dict with the number of operations, the total time, the throughput and the latency distribution
+    """
+    latencies = []
+    total_bytes = 0
+    complete = True
+    for arg in args:
+        if deadline is not None and deadline.expired:
+            complete = False
+            break
+        t0 = time.perf_counter()
+        op(arg)
+        latencies.append(time.perf_counter() - t0)
+        if nbytes is not None:
+            total_bytes += nbytes(arg)
+
+    seconds = sum(latencies)
+    ret = {
+        'ops': len(latencies),
+        'seconds': seconds,
+        'ops_per_sec': len(latencies) / seconds if seconds > 0 else None,
+        'latency_us': percentiles(latencies),
+        'complete': complete,
+    }
+    if nbytes is not None:
+        ret['bytes'] = total_bytes
+        ret['bytes_per_sec'] = total_bytes / seconds if seconds > 0 else None
+    return ret
+
+
+def metadata():
+    """:returns: information about the environment, to be stored along with the results"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+
+    return {
+        'mmappickle_version': mmappickle.__version__,
+        'git_commit': commit,
+        'python_version': platform.python_version(),
+        'numpy_version': numpy_version,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def write_results(output, results, **meta):
+    """Write the results as JSON to ``output`` (file name, or ``-`` for stdout)."""
+    data = {'meta': metadata(), 'results': results}
+    data['meta'].update(meta)
+    if output == '-':
+        json.dump(data, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,188 @@
+"""Multi-process contention benchmark of the :class:`mmappickle.mmapdict` locking model.
+
+Spawns N reader and M writer processes working on the same file for a fixed duration. Readers read random keys,
+writers overwrite random keys (which changes the commit number, and forces the other processes to rebuild their
+cache of the keys).
+
+For each configuration, the throughput, the latency distribution of the operations, the distribution of the time
+spent waiting for the file lock and the number (and time) of cache rebuilds are reported, separately for readers and writers::
+
+    python benchmarks/bench_contention.py --configs 1w32r,8w0r --duration 10 --output contention.json
+
+Configurations are written ``<M>w<N>r``, for M writers and N readers. Use ``--locking range`` to measure the
+``locking='range'`` mode of :class:`mmappickle.mmapdict`, in which the readers share the lock.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from _common import percentiles, write_results
+
+from mmappickle import mmapdict
+
+
+class Reservoir:
+    """Uniform random sample of at most ``size`` values, to bound the memory used by the latency measurements."""
+
+    def __init__(self, size=100000, seed=0):
+        self.size = size
+        self.count = 0
+        self.values = []
+        self._random = random.Random(seed)
+
+    def add(self, value):
+        self.count += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            idx = self._random.randrange(self.count)
+            if idx < self.size:
+                self.values[idx] = value
+
+
+def _record_lock_waits(lock_waits):
+    """Record each lock wait time (in this process only), since mmapdict.stats() only has the total."""
+    lock_acquire = mmapdict._lock_acquire
+
+    def timed_lock_acquire(self, shared):
+        t0 = time.perf_counter()
+        lock_acquire(self, shared)
+        lock_waits.add(time.perf_counter() - t0)
+
+    mmapdict._lock_acquire = timed_lock_acquire
+
+
+def _worker(role, worker_id, path, keys, value, start, duration, results, locking):
+    m = mmapdict(path, stats=True, locking=locking)
+    lock_waits = Reservoir(seed=worker_id)
+    latencies = Reservoir(seed=worker_id)
+    _record_lock_waits(lock_waits)
+    rnd = random.Random(worker_id)
+
+    if role == 'writer':
+        def op(k):
+            m[k] = value
+    else:
+        def op(k):
+            m[k]
+
+    start.wait()
+    end = time.perf_counter() + duration
+    ops = 0
+    m.reset_stats()
+    while True:
+        t0 = time.perf_counter()
+        if t0 > end:
+            break
+        op(rnd.choice(keys))
+        latencies.add(time.perf_counter() - t0)
+        ops += 1
+
+    stats = m.stats()
+    results.put({
+        'role': role,
+        'ops': ops,
+        'latencies': latencies.values,
+        'lock_waits': lock_waits.values,
+        'lock_acquisitions': stats.get('lock.count', 0),
+        'lock_wait_total': stats.get('lock.time', 0),
+        'cache_rebuilds': stats.get('cache.rebuild.count', 0),
+        'cache_rebuild_time': stats.get('cache.rebuild.time', 0),
+    })
+
+
+def _summary(worker_results, duration):
+    if len(worker_results) == 0:
+        return None
+    ops = sum(r['ops'] for r in worker_results)
+    acquisitions = sum(r['lock_acquisitions'] for r in worker_results)
+    return {
+        'processes': len(worker_results),
+        'ops': ops,
+        'ops_per_sec': ops / duration,
+        'ops_per_sec_per_process': ops / duration / len(worker_results),
+        'latency_us': percentiles([x for r in worker_results for x in r['latencies']]),
+        'lock_acquisitions': acquisitions,
+        'lock_wait_us': percentiles([x for r in worker_results for x in r['lock_waits']]),
+        'lock_wait_fraction': sum(r['lock_wait_total'] for r in worker_results) / duration / len(worker_results),
+        'cache_rebuilds': sum(r['cache_rebuilds'] for r in worker_results),
+        'cache_rebuilds_per_op': sum(r['cache_rebuilds'] for r in worker_results) / max(1, ops),
+        'cache_rebuild_fraction': sum(r['cache_rebuild_time'] for r in worker_results) / duration / len(worker_results),
+    }
+
+
+def run_config(path, writers, readers, args):
+    """Run one configuration, returns the results for the readers and the writers."""
+    keys = ['key-{:06d}'.format(i) for i in range(args.keys)]
+    value = b'\0' * args.value_size
+
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = []
+    for i in range(writers + readers):
+        role = 'writer' if i < writers else 'reader'
+        p = multiprocessing.Process(target=_worker, args=(role, i, path, keys, value, start, args.duration, results,
+                                                          args.locking))
+        p.start()
+        processes.append(p)
+
+    # Give some time to the processes to open the file
+    time.sleep(0.5)
+    start.set()
+
+    worker_results = [results.get() for p in processes]
+    for p in processes:
+        p.join()
+
+    return {
+        'writers': _summary([r for r in worker_results if r['role'] == 'writer'], args.duration),
+        'readers': _summary([r for r in worker_results if r['role'] == 'reader'], args.duration),
+    }
+
+
+def _parse_config(config):
+    writers, readers = config.lower().rstrip('r').split('w')
+    return int(writers), int(readers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--configs', default='0w1r,0w32r,1w0r,1w1r,1w32r,8w0r,8w8r',
+                        help='comma-separated configurations <writers>w<readers>r (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10, help='duration of each configuration, in seconds (default: %(default)s)')
+    parser.add_argument('--keys', type=int, default=100, help='number of keys in the file (default: %(default)s)')
+    parser.add_argument('--value-size', type=int, default=1024, help='size of the values, in bytes (default: %(default)s)')
+    parser.add_argument('--locking', default='file', choices=('file', 'range'), help='locking mode of the file (default: %(default)s)')
+    parser.add_argument('--tmpdir', default=None, help='directory in which the file is created (should be on the storage to test)')
+    parser.add_argument('--output', default='-', help='output JSON file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for config in args.configs.split(','):
+        writers, readers = _parse_config(config)
+        print('{} writers, {} readers...'.format(writers, readers), file=sys.stderr)
+
+        fd, path = tempfile.mkstemp(suffix='.mmdpickle', dir=args.tmpdir)
+        os.close(fd)
+        try:
+            m = mmapdict(path)
+            m.update(('key-{:06d}'.format(i), b'\0' * args.value_size) for i in range(args.keys))
+            del m
+
+            for role, result in sorted(run_config(path, writers, readers, args).items()):
+                if result is not None:
+                    result.update({'benchmark': 'contention_{}'.format(role), 'n': config, 'status': 'ok'})
+                    results.append(result)
+        finally:
+            os.unlink(path)
+
+    write_results(args.output, results, duration=args.duration, keys=args.keys, value_size=args.value_size,
+                  locking=args.locking)
+
+
+if __name__ == '__main__':
+    main()
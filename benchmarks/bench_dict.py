@@ -0,0 +1,265 @@
+"""Benchmarks of the main :class:`mmappickle.mmapdict` operations.
+
+Measures the throughput and latency of opening a file, ``__setitem__``/``__getitem__`` of small generic values and
+of large arrays, ``keys()``, ``vacuum()`` and the conversion of a plain pickle (``_convert_file``), for several
+numbers of keys. :mod:`shelve` and :func:`numpy.load` (with ``mmap_mode='r'``) are measured as baselines.
+
+The results are written as JSON, and two result files can be compared using ``compare.py``::
+
+    python benchmarks/bench_dict.py --sizes 1000,10000 --output before.json
+    (change something)
+    python benchmarks/bench_dict.py --sizes 1000,10000 --output after.json
+    python benchmarks/compare.py before.json after.json
+
+Each benchmark has a time budget (``--budget``). When it is exceeded, the benchmark is stopped and reported as
+incomplete: the throughput is still meaningful, and it shows at which scale an operation stops being usable.
+"""
+import argparse
+import os
+import pickle
+import random
+import shelve
+import shutil
+import sys
+import tempfile
+import warnings
+
+from _common import BudgetExceeded, Deadline, measure, write_results
+
+from mmappickle import mmapdict
+
+
+def _small_value(i):
+    return (i, 'value-{}'.format(i))
+
+
+def _small_keys(n):
+    return ['key-{:08d}'.format(i) for i in range(n)]
+
+
+def _shuffled(keys, seed=0):
+    keys = list(keys)
+    random.Random(seed).shuffle(keys)
+    return keys
+
+
+class Benchmarks:
+    def __init__(self, workdir, args):
+        self._workdir = workdir
+        self._args = args
+        # Files containing n small keys, built by the setitem benchmarks
+        self._small_fixtures = {}
+        self._shelve_fixtures = {}
+        # Files containing the arrays, built by the setitem and save benchmarks
+        self._array_fixtures = {}
+
+    def _path(self, name):
+        return os.path.join(self._workdir, name)
+
+    def _deadline(self):
+        return Deadline(self._args.budget)
+
+    def _small_fixture(self, n):
+        if n not in self._small_fixtures:
+            raise BudgetExceeded()
+        return self._small_fixtures[n]
+
+    def _shelve_fixture(self, n):
+        if n not in self._shelve_fixtures:
+            raise BudgetExceeded()
+        return self._shelve_fixtures[n]
+
+    def _array_fixture(self, name):
+        if name not in self._array_fixtures:
+            raise BudgetExceeded()
+        return self._array_fixtures[name]
+
+    # mmapdict, small generic values
+
+    def mmapdict_setitem_small(self, n):
+        path = self._path('small-{}.mmdpickle'.format(n))
+        m = mmapdict(path)
+
+        def op(ik):
+            m[ik[1]] = _small_value(ik[0])
+
+        result = measure(op, list(enumerate(_small_keys(n))), self._deadline())
+        if result['complete']:
+            self._small_fixtures[n] = path
+        return result
+
+    def mmapdict_getitem_small(self, n):
+        m = mmapdict(self._small_fixture(n), readonly=True)
+        return measure(lambda k: m[k], _shuffled(_small_keys(n)), self._deadline())
+
+    def mmapdict_open(self, n):
+        path = self._small_fixture(n)
+        # Opening includes building the index of the keys, which is done lazily
+        return measure(lambda _: len(mmapdict(path, readonly=True).keys()), range(self._args.repeat), self._deadline())
+
+    def mmapdict_keys(self, n):
+        m = mmapdict(self._small_fixture(n), readonly=True)
+        m.keys()
+        return measure(lambda _: list(m.keys()), range(self._args.repeat), self._deadline())
+
+    def mmapdict_vacuum(self, n):
+        path = self._path('vacuum-{}.mmdpickle'.format(n))
+        shutil.copyfile(self._small_fixture(n), path)
+        m = mmapdict(path)
+        deadline = self._deadline()
+        for k in _small_keys(n)[::2]:
+            deadline.check()
+            del m[k]
+        return measure(lambda _: m.vacuum(), [None], deadline)
+
+    def mmapdict_convert(self, n):
+        # The conversion inserts the keys one by one, it can't be done in time if the setitem benchmark couldn't
+        self._small_fixture(n)
+        path = self._path('convert-{}.pickle'.format(n))
+        with open(path, 'wb') as f:
+            pickle.dump({k: _small_value(i) for i, k in enumerate(_small_keys(n))}, f, 4)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return measure(lambda _: mmapdict(path), [None], self._deadline())
+
+    # mmapdict, large arrays
+
+    def _arrays(self):
+        import numpy
+        elements = self._args.array_mb * 1024 * 1024 // 8
+        return [('array-{}'.format(i), numpy.full((elements, ), i, dtype=numpy.float64)) for i in range(self._args.arrays)]
+
+    def mmapdict_setitem_array(self, n):
+        path = self._path('arrays.mmdpickle')
+        m = mmapdict(path)
+
+        def op(kv):
+            m[kv[0]] = kv[1]
+
+        result = measure(op, self._arrays(), self._deadline(), nbytes=lambda kv: kv[1].nbytes)
+        if result['complete']:
+            self._array_fixtures['mmapdict'] = path
+        return result
+
+    def mmapdict_getitem_array(self, n):
+        m = mmapdict(self._array_fixture('mmapdict'), readonly=True)
+        # The data is read (summed) to include the cost of the page faults
+        return measure(lambda k: m[k].sum(), _shuffled(m.keys()), self._deadline(), nbytes=lambda k: self._args.array_mb * 1024 * 1024)
+
+    # Baselines
+
+    def shelve_setitem_small(self, n):
+        path = self._path('shelve-{}'.format(n))
+        s = shelve.open(path, 'n', protocol=4)
+
+        def op(ik):
+            s[ik[1]] = _small_value(ik[0])
+
+        try:
+            result = measure(op, list(enumerate(_small_keys(n))), self._deadline())
+        finally:
+            s.close()
+        if result['complete']:
+            self._shelve_fixtures[n] = path
+        return result
+
+    def shelve_getitem_small(self, n):
+        s = shelve.open(self._shelve_fixture(n), 'r')
+        try:
+            return measure(lambda k: s[k], _shuffled(_small_keys(n)), self._deadline())
+        finally:
+            s.close()
+
+    def shelve_keys(self, n):
+        s = shelve.open(self._shelve_fixture(n), 'r')
+        try:
+            return measure(lambda _: list(s.keys()), range(self._args.repeat), self._deadline())
+        finally:
+            s.close()
+
+    def numpy_save_array(self, n):
+        import numpy
+
+        def op(kv):
+            numpy.save(self._path('{}.npy'.format(kv[0])), kv[1])
+
+        result = measure(op, self._arrays(), self._deadline(), nbytes=lambda kv: kv[1].nbytes)
+        if result['complete']:
+            self._array_fixtures['numpy'] = True
+        return result
+
+    def numpy_load_array(self, n):
+        import numpy
+        self._array_fixture('numpy')
+        keys = _shuffled('array-{}'.format(i) for i in range(self._args.arrays))
+        return measure(lambda k: numpy.load(self._path('{}.npy'.format(k)), mmap_mode='r').sum(), keys, self._deadline(),
+                       nbytes=lambda k: self._args.array_mb * 1024 * 1024)
+
+
+# Benchmarks depending on the number of keys, in execution order (some use the files created by the previous ones,
+# and are skipped if these were not run or were incomplete)
+SIZED_BENCHMARKS = [
+    'mmapdict_setitem_small',
+    'mmapdict_getitem_small',
+    'mmapdict_open',
+    'mmapdict_keys',
+    'mmapdict_vacuum',
+    'mmapdict_convert',
+    'shelve_setitem_small',
+    'shelve_getitem_small',
+    'shelve_keys',
+]
+
+ARRAY_BENCHMARKS = [
+    'mmapdict_setitem_array',
+    'mmapdict_getitem_array',
+    'numpy_save_array',
+    'numpy_load_array',
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000', help='comma-separated numbers of keys (default: %(default)s)')
+    parser.add_argument('--budget', type=float, default=60, help='time budget of each benchmark, in seconds (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=10, help='repetitions of the open and keys benchmarks (default: %(default)s)')
+    parser.add_argument('--arrays', type=int, default=8, help='number of arrays of the array benchmarks (default: %(default)s)')
+    parser.add_argument('--array-mb', type=int, default=64, help='size of each array, in MiB (default: %(default)s)')
+    parser.add_argument('--no-arrays', action='store_true', help='skip the array benchmarks (which require numpy)')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this string')
+    parser.add_argument('--tmpdir', default=None, help='directory in which the temporary files are created')
+    parser.add_argument('--output', default='-', help='output JSON file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    results = []
+
+    def run(benchmarks, name, n):
+        if args.filter not in name:
+            return
+        print('{} (n={})...'.format(name, n), file=sys.stderr)
+        try:
+            result = getattr(benchmarks, name)(n)
+            result['status'] = 'ok' if result.pop('complete') else 'incomplete'
+        except BudgetExceeded:
+            result = {'status': 'skipped'}
+        result['benchmark'] = name
+        result['n'] = n
+        results.append(result)
+
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as workdir:
+        benchmarks = Benchmarks(workdir, args)
+        for n in sizes:
+            for name in SIZED_BENCHMARKS:
+                run(benchmarks, name, n)
+
+        if not args.no_arrays:
+            for name in ARRAY_BENCHMARKS:
+                run(benchmarks, name, args.arrays)
+
+    write_results(args.output, results, sizes=sizes, budget=args.budget, array_mb=args.array_mb)
+
+
+if __name__ == '__main__':
+    main()
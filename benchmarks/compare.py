@@ -0,0 +1,65 @@
+"""Compare two JSON result files written by the benchmark scripts.
+
+Usage::
+
+    python benchmarks/compare.py before.json after.json [--threshold 0.1]
+
+Prints the throughput of each benchmark in both files, and their ratio. The exit code is 1 if a benchmark
+is slower than the threshold allows, which makes it usable in a CI job.
+"""
+import argparse
+import json
+import sys
+
+
+def _load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return data['meta'], {(r['benchmark'], r['n']): r for r in data['results']}
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    return '{:.4g}'.format(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    meta_before, before = _load(args.before)
+    meta_after, after = _load(args.after)
+
+    print('before: {} ({})'.format(meta_before.get('git_commit'), meta_before.get('time')))
+    print('after:  {} ({})'.format(meta_after.get('git_commit'), meta_after.get('time')))
+    print()
+
+    row = '{:<28} {:>9} {:>12} {:>12} {:>8}  {}'
+    print(row.format('benchmark', 'n', 'before op/s', 'after op/s', 'ratio', 'status'))
+
+    regressions = 0
+    for key in sorted(set(before) | set(after)):
+        r_before = before.get(key, {})
+        r_after = after.get(key, {})
+        ops_before = r_before.get('ops_per_sec')
+        ops_after = r_after.get('ops_per_sec')
+        status = '{} -> {}'.format(r_before.get('status', 'missing'), r_after.get('status', 'missing'))
+
+        ratio = None
+        if ops_before and ops_after:
+            ratio = ops_after / ops_before
+            if ratio < 1 - args.threshold:
+                status += '  REGRESSION'
+                regressions += 1
+
+        print(row.format(key[0], key[1], _format(ops_before), _format(ops_after), _format(ratio), status))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,4 @@
-from .dict import mmapdict
+from .dict import mmapdict, mmapgroup, fsckreport, spacereport, valueinfo, lazyvalue
+from .sharded import shardedmmapdict
 from ._version import __version__
-__all__ = ['mmapdict', '__version__']
+__all__ = ['mmapdict', 'mmapgroup', 'fsckreport', 'spacereport', 'valueinfo', 'lazyvalue', 'shardedmmapdict', '__version__']
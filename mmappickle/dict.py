@@ -1,11 +1,18 @@
 import os
 import io
+import bisect
+import heapq
 import pickle
 import struct
+import time
 import warnings
 import weakref
 
 from .utils import *
+from .utils import _mmap_file, _bounded_file, _crc32_file, _crc32_combine, _lock_file, _unlock_file, _lease_file, \
+    _lock_range, _range_locks_supported, _turnstile_offset
+from .stats import _stats, _counting_file
+from .trace import _span, null_span
 
 
 class _header:
@@ -157,9 +164,19 @@ class _terminator:
         """
         self._mmapdict = weakref.ref(mmapdict)
 
-        # Check if we have a valid header
-        if not self.exists and self._mmapdict()._header.is_valid():
-            self.write()
+        # Check if we have a valid header. The file is locked, since another process may be writing an entry
+        # (which overwrites the terminator until the entry is complete). If it can't be locked, the terminator is
+        # not written, it could be written in the middle of an entry.
+        try:
+            mmapdict._lock_acquire(False)
+        except (OSError, ValueError):
+            return
+        try:
+            if not self.exists and mmapdict._header.is_valid():
+                self.write()
+                self._file.flush()
+        finally:
+            mmapdict._lock_release()
 
     def __len__(self):
         """:returns: the length of the terminator"""
@@ -192,6 +209,24 @@ class _terminator:
         self._file.write(self._data)
 
 
+# Opcodes used to store the keys, with the struct format of their length (the shortest possible is used)
+_key_opcodes = (
+    (pickle.SHORT_BINUNICODE, '<B'),
+    (pickle.BINUNICODE, '<I'),
+    (pickle.BINUNICODE8, '<Q'),
+)
+# Opcodes of the keys of the reserved entries (see mmapdict.__setitem__), which are pickled as bytes until the value
+# is written
+_reserved_key_opcodes = {
+    pickle.SHORT_BINUNICODE: pickle.SHORT_BINBYTES,
+    pickle.BINUNICODE: pickle.BINBYTES,
+    pickle.BINUNICODE8: pickle.BINBYTES8,
+}
+_unreserved_key_opcodes = dict((v, k) for k, v in _reserved_key_opcodes.items())
+_key_length_formats = dict((opcode[0], fmt) for opcode, fmt in _key_opcodes)
+_key_length_formats.update((_reserved_key_opcodes[opcode][0], fmt) for opcode, fmt in _key_opcodes)
+
+
 class _kvdata:
     """kvdata is the structure holding a key-value data entry.
 
@@ -208,11 +243,26 @@ class _kvdata:
     ::
 
       FRAME <length>
-      SHORT_BINUNICODE <length> <key bytes>
+      SHORT_BINUNICODE|BINUNICODE|BINUNICODE8 <length> <key bytes> (depending on the length of the key)
       <<< data >>>
       BININT <max memo idx> POP (max memo index of this part)
       NEWTRUE|POP POP (if NEWTRUE POP: entry is valid, else entry is deactivated.)
+
+    When checksums are enabled (see :class:`mmapdict`), the max memo index is replaced by
+    ``MARK BININT <CRC32 of the data> BININT <max memo idx> POP_MARK``. Since the data may end with any byte, the
+    POP_MARK (instead of POP) at a fixed offset from the end of the entry tells that the entry has a checksum.
+
+    When deduplication is enabled (see :class:`mmapdict`), the data may either end with
+    ``LONG_BINPUT <memo idx> SHORT_BINBYTES <digest> POP`` (the value is stored in the memo, and can be
+    referred to), or be only ``LONG_BINGET <memo idx>`` (the value is the same as the one stored in the memo).
+
+    While its value is written outside of the lock (see :meth:`mmapdict.__setitem__`), the entry is reserved: it is
+    deactivated, and its key is pickled as bytes (``SHORT_BINBYTES|BINBYTES|BINBYTES8``) instead of a string.
     """
+    # Length of the suffix of the values which can be referred to, see _dedup
+    _dedup_suffix_length = 1 + 4 + 1 + 1 + 32 + 1
+    # Length added to the trailer by the checksum, if it exists
+    _checksum_length = 1 + 1 + 4
 
     def __init__(self, mmapdict, offset):
         """
@@ -222,11 +272,13 @@ class _kvdata:
         self._mmapdict = weakref.ref(mmapdict)
         self._offset = offset
         self._exists = self._exists_initial
-        # Cache for non-written entries
+        # Cache for non-written entries (and of the key, which never changes, for written entries)
         self._cache = {
             'valid': True,
             # key, data_length, memomaxidx
         }
+        # Cache of the length of the key opcode and of the key, for written entries
+        self._key_header_cache = None
 
     def __len__(self):
         """:returns: the length of the key-value data"""
@@ -256,7 +308,8 @@ class _kvdata:
         This is done either by reading it in the file, or by computing it if it doesn't exist"""
 
         if not self._exists:
-            return 2 + self.key_length + self.data_length + 1 + 4 + 1 + 1 + 1
+            key_header_length, key_length = self._key_header
+            return key_header_length + key_length + self.data_length + self._trailer_length
         self._file.seek(self._offset + 1, io.SEEK_SET)
         return struct.unpack('<Q', self._file.read(8))[0]
 
@@ -268,38 +321,134 @@ class _kvdata:
         data = self._file.read(10)
         if len(data) < 10:
             return False
-        return data[0] == pickle.FRAME[0] and data[9] == pickle.SHORT_BINUNICODE[0]
+        return data[0] == pickle.FRAME[0] and data[9] in _key_length_formats
 
     @property
     def data_length(self):
-        """:returns: True if the file contains the header of the frame"""
+        """:returns: the length of the pickled data"""
         if not self._exists:
             return self._cache['data_length']
-        return self._frame_length - 2 - self.key_length - 6 - 2
+        key_header_length, key_length = self._key_header
+        return self._frame_length - key_header_length - key_length - self._trailer_length
 
     @property
     def data_offset(self):
         """:returns: the offset of the pickled data"""
-        return self._offset + 9 + 2 + self.key_length
+        key_header_length, key_length = self._key_header
+        return self._offset + 9 + key_header_length + key_length
 
     @property
     @save_file_position
+    def _key_header(self):
+        """:returns: a tuple (length of the key opcode with its argument, binary length of the key)"""
+        if self._key_header_cache is not None:
+            return self._key_header_cache
+
+        if not self._exists:
+            key_length = len(self._cache['key'].encode('utf8', 'surrogatepass'))
+            for opcode, fmt in _key_opcodes:
+                if key_length < 256 ** struct.calcsize(fmt):
+                    return 1 + struct.calcsize(fmt), key_length
+            raise ValueError("key is too long")
+
+        self._file.seek(self._offset + 9, io.SEEK_SET)
+        fmt = _key_length_formats[self._file.read(1)[0]]
+        key_length = struct.unpack(fmt, self._file.read(struct.calcsize(fmt)))[0]
+        self._key_header_cache = (1 + struct.calcsize(fmt), key_length)
+        return self._key_header_cache
+
+    @property
     def key_length(self):
         """:returns: the binary length of the key"""
-        if not self._exists:
-            return len(self._cache['key'].encode('utf8', 'surrogatepass'))
-        self._file.seek(self._offset + 10)
-        return self._file.read(1)[0]
+        return self._key_header[1]
 
     @property
     @save_file_position
     def key(self):
         """:returns: the key as an unicode string"""
+        if self._exists and 'key' not in self._cache:
+            key_header_length, key_length = self._key_header
+            self._file.seek(self._offset + 9 + key_header_length, io.SEEK_SET)
+            self._cache['key'] = self._file.read(key_length).decode('utf8')
+        return self._cache['key']
+
+    @property
+    @save_file_position
+    def reserved(self):
+        """:returns: True if the entry is reserved (its value is being written, or its writer was interrupted)"""
         if not self._exists:
-            return self._cache['key']
-        key_length = self.key_length
-        self._file.seek(self._offset + 11, io.SEEK_SET)
-        return self._file.read(key_length).decode('utf8')
+            return self._cache.get('reserved', False)
+        self._file.seek(self._offset + 9, io.SEEK_SET)
+        return self._file.read(1) in _unreserved_key_opcodes
+
+    @require_writable
+    @save_file_position
+    def _unreserve(self):
+        """Pickle the key of the reserved entry as a string again, once its value is written"""
+        self._file.seek(self._offset + 9, io.SEEK_SET)
+        opcode = self._file.read(1)
+        self._file.seek(self._offset + 9, io.SEEK_SET)
+        self._file.write(_unreserved_key_opcodes[opcode])
+
+    @property
+    @save_file_position
+    def _has_checksum(self):
+        """:returns: True if the entry has a checksum"""
+        if not self._exists:
+            return self._cache.get('checksum') is not None
+        if 'has_checksum' not in self._cache:
+            # The opcode popping the max memo index
+            self._file.seek(self._offset + 9 + self._frame_length - 3, io.SEEK_SET)
+            self._cache['has_checksum'] = self._file.read(1) == pickle.POP_MARK
+        return self._cache['has_checksum']
+
+    @property
+    def _trailer_length(self):
+        """:returns: the length of what follows the data (checksum, max memo index and valid flag)"""
+        return (self._checksum_length if self._has_checksum else 0) + 1 + 4 + 1 + 1 + 1
+
+    @property
+    @save_file_position
+    def checksum(self):
+        """:returns: the CRC32 of the data, or None if the entry has no checksum"""
+        if not self._exists:
+            return self._cache.get('checksum')
+        if not self._has_checksum:
+            return None
+        self._file.seek(self._offset + 9 + self._frame_length - 8 - 4, io.SEEK_SET)
+        return struct.unpack('<I', self._file.read(4))[0]
+
+    @checksum.setter
+    def checksum(self, newvalue):
+        if self._exists:
+            raise RuntimeError("Cannot set checksum of an existing key-value entry")
+        self._cache['checksum'] = newvalue
+        self._write_if_allowed()
+
+    @property
+    @save_file_position
+    def _dedup(self):
+        """:returns: a tuple (kind, memo index, digest), where kind is ``'reference'`` if the value is a reference to
+        another value, ``'payload'`` if the value can be referred to, and ``None`` otherwise."""
+        if 'dedup' not in self._cache:
+            ret = (None, None, None)
+            if self.reserved:
+                # The value is not written yet
+                return ret
+            data_length = self.data_length
+            if data_length == 5:
+                self._file.seek(self.data_offset, io.SEEK_SET)
+                data = self._file.read(5)
+                if data[0] == pickle.LONG_BINGET[0]:
+                    ret = ('reference', struct.unpack('<I', data[1:])[0], None)
+            elif data_length >= self._dedup_suffix_length:
+                self._file.seek(self.data_offset + data_length - self._dedup_suffix_length, io.SEEK_SET)
+                data = self._file.read(self._dedup_suffix_length)
+                if data[0] == pickle.LONG_BINPUT[0] and data[5] == pickle.SHORT_BINBYTES[0] and data[6] == 32 and \
+                        data[39] == pickle.POP[0]:
+                    ret = ('payload', struct.unpack('<I', data[1:5])[0], data[7:39])
+            self._cache['dedup'] = ret
+        return self._cache['dedup']
 
     @property
     def _valid_offset(self):
@@ -371,6 +520,33 @@ class _kvdata:
         else:
             self._cache['valid'] = newvalue
 
+    @require_writable
+    @save_file_position
+    def _resize(self, data_length, memomaxidx, checksum=None, valid=True):
+        """Change the length (and the checksum) of the data of an existing entry, and rewrite the end of the entry.
+
+        The data should already be written. The end of the entry may have been overwritten, so ``memomaxidx``
+        should have been read before."""
+        if not self._exists:
+            raise RuntimeError("Cannot resize a non-existing key-value entry")
+        trailer = self._trailer(checksum, memomaxidx, valid)
+        key_header_length, key_length = self._key_header
+        self._file.seek(self._offset + 1, io.SEEK_SET)
+        self._file.write(struct.pack('<Q', key_header_length + key_length + data_length + len(trailer)))
+        self._file.seek(self.data_offset + data_length, io.SEEK_SET)
+        self._file.write(trailer)
+        self._cache['has_checksum'] = checksum is not None
+
+    @staticmethod
+    def _trailer(checksum, memomaxidx, valid):
+        """:returns: what follows the data (checksum, max memo index and valid flag)"""
+        if checksum is None:
+            trailer = pickle.BININT + struct.pack('<i', memomaxidx) + pickle.POP
+        else:
+            trailer = pickle.MARK + pickle.BININT + struct.pack('<I', checksum) + \
+                pickle.BININT + struct.pack('<i', memomaxidx) + pickle.POP_MARK
+        return trailer + (pickle.NEWTRUE if valid else pickle.POP) + pickle.POP
+
     @require_writable
     @save_file_position
     def _write_if_allowed(self):
@@ -385,16 +561,14 @@ class _kvdata:
 
         self._file.seek(self._offset, io.SEEK_SET)
         key = self.key.encode('utf8', 'surrogatepass')
+        opcode, fmt = [x for x in _key_opcodes if len(key) < 256 ** struct.calcsize(x[1])][0]
+        if self._cache.get('reserved', False):
+            opcode = _reserved_key_opcodes[opcode]
         self._file.write(pickle.FRAME + struct.pack('<Q', self._frame_length) +
-                         pickle.SHORT_BINUNICODE + struct.pack('<B', len(key)) + key)
+                         opcode + struct.pack(fmt, len(key)) + key)
         # Skip data
         self._file.seek(self.data_length, io.SEEK_CUR)
-        self._file.write(pickle.BININT + struct.pack('<i', self.memomaxidx) + pickle.POP)
-
-        if self.valid:
-            self._file.write(pickle.NEWTRUE + pickle.POP)
-        else:
-            self._file.write(pickle.POP + pickle.POP)
+        self._file.write(self._trailer(self.checksum, self.memomaxidx, self.valid))
 
         # This entry now exists
         self._exists = True
@@ -408,14 +582,66 @@ class mmapdict:
     This class is safe to use in a multi-process environment."""
     _required_file_methods = ('fileno', 'seek', 'read', 'write', 'writable', 'truncate', 'tell')
 
-    def __init__(self, file, readonly=None, picklers=None):
+    def __init__(self, file, readonly=None, picklers=None, stats=False, tracer=None, immutable=False, dedup=False,
+                 checksums=False, verify_on_read=False, durability='none', fsync_interval=1.0, fsync_commits=1000,
+                 advice=None, populate=False, hugepages=False, auto_vacuum=None, auto_vacuum_min_bytes=1048576,
+                 locking='file'):
         """
         Create or load a mmap dictionnary.
 
         :param file: either a file-like object or a string representing the name of the file.
         :param readonly: if ``file`` is a string, the file will be open in readonly mode if set to True.
         :param picklers: explicit list of picklers. Usually this is not needed (by default, all are used)
+        :param stats: if True, collect statistics about the operations on the file (see :meth:`stats`).
+        :param tracer: a :class:`mmappickle.trace.Tracer`, which receives the timing of each operation.
+        :param immutable: if True, the file is assumed to never change while this object is used. The file is mapped
+          in memory and its keys are read once, then it is never locked again, and arrays are returned as views of
+          the memory map. The object can be shared with child processes (e.g. by ``fork()``) without any additional
+          work. The file should be opened in readonly mode (this is the default if ``file`` is a string).
+        :param dedup: if True, the arrays and bytes values which are identical to a value already in the file are not
+          written again: a reference to the existing value is written instead (the file stays a valid pickle). Values
+          which are still referred to are kept by :meth:`vacuum`, even if their key was deleted. Files with references
+          can be read without enabling this option.
+        :param checksums: if True, a CRC32 checksum of each value is written with the value, see :meth:`verify`. Values
+          modified through a memory map (e.g. arrays opened in read/write mode) no longer match their checksum.
+        :param verify_on_read: if True, the checksum of a value (if any) is verified each time the value is read, and
+          ``ValueError`` is raised if it doesn't match. This reads the whole value, even if it is memory mapped.
+        :param durability: when the changes are synced to the disk (with ``fsync``), see :meth:`sync`:
+
+          - ``'none'``: never (the operating system writes them eventually)
+          - ``'batch'``: after a commit, if ``fsync_interval`` seconds or ``fsync_commits`` commits have elapsed since
+            the last sync. The commits done since the last sync may be lost (use :meth:`fsck` to repair the file).
+          - ``'always'``: at each change, in this order: the data of the value, the end of the entry and the
+            terminator, then the header (with the commit number).
+        :param fsync_interval: maximum time between two syncs, in seconds, if ``durability`` is ``'batch'``
+        :param fsync_commits: maximum number of commits between two syncs, if ``durability`` is ``'batch'``
+        :param advice: access pattern given to the operating system for each value read (e.g. ``'sequential'`` if the
+          arrays are read from the beginning to the end, or ``'random'``), see :meth:`advise`
+        :param populate: if True, the pages of the memory maps returned are mapped before returning them (with
+          ``MADV_POPULATE_READ`` if available, otherwise by reading one byte of each page), so that the first access
+          to the array doesn't cause a page fault for each page. This reads the whole array.
+        :param hugepages: if True, transparent huge pages are requested for the memory maps returned (with
+          ``MADV_HUGEPAGE``, on Linux). Depending on the file system, this may have no effect.
+        :param auto_vacuum: if set (a ratio between 0 and 1), :meth:`vacuum` is called after a key is changed or
+          deleted, once the dead bytes (see :meth:`space_report`) are more than this ratio of the file size. It is only
+          called if no value of the file is mapped in memory, by any :class:`mmapdict` (in this process or in others),
+          otherwise it is retried after the next change. This requires open file description locks (on Linux), it has
+          no effect on the other systems.
+        :param auto_vacuum_min_bytes: :meth:`vacuum` is not called automatically if there are fewer dead bytes
+        :param locking: how the file is locked, to access it from several processes:
+
+          - ``'file'``: the whole file is locked (with ``flock``) by each operation
+          - ``'range'``: the header of the file is locked with a byte-range lock (see :func:`fcntl.lockf`), which is
+            shared by the operations which only read the file (e.g. reading values, or listing the keys), and
+            exclusive for the changes. This requires open file description locks (on Linux).
+
+          All the processes using the file at the same time should use the same mode.
         """
+        if immutable:
+            if readonly is None:
+                readonly = True
+            elif not readonly:
+                raise ValueError("An immutable mmapdict should be readonly")
 
         # Open the file if f is a string.
         if type(file) == str:
@@ -434,6 +660,45 @@ class mmapdict:
                 raise TypeError('f should be a str, or have a the following methods: {}'.format(', '.join(mmapdict._required_file_methods)))
             self._file = file
 
+        if locking not in ('file', 'range'):
+            raise ValueError("locking should be 'file' or 'range'")
+        if locking == 'range' and not _range_locks_supported():
+            raise ValueError("locking='range' is not supported by this system")
+        self._locking = locking
+
+        self._immutable = False
+        if immutable:
+            if self._file.writable():
+                raise ValueError("An immutable mmapdict should be readonly")
+            self._file = _mmap_file(self._file)
+
+        self._dedup = dedup
+        self._checksums = checksums
+        self._verify_on_read = verify_on_read
+        if durability not in ('none', 'batch', 'always'):
+            raise ValueError("durability should be 'none', 'batch' or 'always'")
+        self._durability = durability
+        self._fsync_interval = fsync_interval
+        self._fsync_commits = fsync_commits
+        self._sync_pending = 0
+        self._sync_time = time.monotonic()
+        if advice is not None and advice not in _advice_names:
+            raise ValueError("advice should be one of {}".format(', '.join(_advice_names)))
+        self._advice = advice
+        self._populate = populate
+        self._hugepages = hugepages
+        if auto_vacuum is not None and not 0 < auto_vacuum <= 1:
+            raise ValueError("auto_vacuum should be between 0 and 1")
+        self._auto_vacuum = auto_vacuum
+        self._auto_vacuum_min_bytes = auto_vacuum_min_bytes
+        # Number of values mapped in memory, see _lease
+        self._leases = 0
+        self._tracer = tracer
+        self._stats = None
+        if stats:
+            self._stats = _stats()
+            self._file = _counting_file(self._file, self._stats)
+
         self._header = _header(self)
         self._terminator = _terminator(self)
 
@@ -451,6 +716,7 @@ class mmapdict:
 
         # Cache/lock infrastructure
         self._locked = 0
+        self._locked_shared = False
         self._cache_commit_number = None
         self._cache_clear()
 
@@ -458,6 +724,9 @@ class mmapdict:
         if not self._header.is_valid():
             self._convert_file()
 
+        if immutable:
+            self._freeze()
+
     def __getstate__(self):
         # This is called before pickling.
         # It returns the basic state used to create another copy of this mmappickle.
@@ -470,16 +739,33 @@ class mmapdict:
         state['_header'] = None
         state['_terminator'] = None
         state['_locked'] = 0
+        state['_locked_shared'] = False
         state['_cache_commit_number'] = None
         state['_cache_kv'] = None
+        state['_cache_sorted_keys'] = None
+        state['_cache_dedup'] = None
         state['_cache_kv_all'] = None
+        state['_cache_picklers'] = {}
+        state['_cache_info'] = {}
+        state['_sync_pending'] = 0
+        state['_leases'] = 0
+        state['_cache_dead_bytes'] = None
         state['_picklers'] = [x.__class__ for x in state['_picklers']]
+        # The copy has its own statistics
+        state['_stats'] = state['_stats'] is not None
 
         return state
 
     def __setstate__(self, state):
         # Restore the state and re-open the file
         state['_file'] = open(state['_file'][0], state['_file'][1])
+        if state['_immutable']:
+            state['_file'] = _mmap_file(state['_file'])
+        if state['_stats']:
+            state['_stats'] = _stats()
+            state['_file'] = _counting_file(state['_file'], state['_stats'])
+        else:
+            state['_stats'] = None
         self.__dict__.update(state)
 
         self._picklers = [x(self) for x in self._picklers]
@@ -487,13 +773,47 @@ class mmapdict:
         self._header = _header(self)
         self._terminator = _terminator(self)
 
+        if self._immutable:
+            self._freeze()
+
+    def _freeze(self):
+        """Read the keys (with the file locked), then disable the locking, see the ``immutable`` parameter."""
+        self._immutable = False
+        self._kv
+        self._immutable = True
+        # The whole file is mapped until it is closed
+        _lease_file(self._file, 'shared')
+
+    def _lock_acquire(self, shared):
+        """Lock the file, see the ``locking`` parameter and :func:`mmappickle.utils.lock`.
+
+        :param shared: if True, the lock is shared with the other readers (only if ``locking`` is ``'range'``)"""
+        if self._locking == 'range':
+            mode = 'shared' if shared else 'exclusive'
+            # The byte-range locks are not fair: a writer waiting for the header would wait until there is no reader.
+            # While it waits, it holds the turnstile, which stops the new readers.
+            _lock_range(self._file, mode, _turnstile_offset, 1)
+            try:
+                _lock_range(self._file, mode, 0, len(self._header))
+            finally:
+                _lock_range(self._file, 'unlock', _turnstile_offset, 1)
+        else:
+            _lock_file(self._file)
+
+    def _lock_release(self):
+        """Unlock the file, see :meth:`_lock_acquire`"""
+        if self._locking == 'range':
+            _lock_range(self._file, 'unlock', 0, len(self._header))
+        else:
+            _unlock_file(self._file)
+
     @property
     def writable(self):
         """True if the file is writable, False otherwise"""
         return self._file.writable()
 
     @property
-    @lock
+    @lock_shared
     def commit_number(self):
         """The monotonically increasing commit number of the :class:`mmapdict`.
 
@@ -510,41 +830,201 @@ class mmapdict:
     def commit_number(self, newvalue):
         self._header.commit_number = newvalue
 
+    def stats(self):
+        """Statistics about the operations done on the file by this object, since its creation or the last call to :meth:`reset_stats`.
+
+        :returns: a dict with the following keys (``<timer>.count`` is the number of measurements, ``<timer>.time`` the total time in seconds):
+
+          - ``file.seeks``, ``file.reads``, ``file.read_bytes``, ``file.writes``, ``file.write_bytes``: I/O done through the file object
+            (data read using memory maps, or written directly to the file descriptor, is not included)
+          - ``lock.count``, ``lock.time``: lock acquisitions, and the time spent waiting for the lock
+          - ``cache.clears``: number of times the cache of the keys was invalidated
+          - ``cache.rebuild.count``, ``cache.rebuild.time``: rebuilds of the cache of the entries (i.e. scans of the file)
+          - ``cache.index.count``, ``cache.index.time``: rebuilds of the index of the valid keys, from the cache of the entries
+          - ``cache.dedup.count``, ``cache.dedup.time``: rebuilds of the index of the values which can be referred to (see ``dedup``)
+          - ``dedup.references``: values written as a reference to an identical value
+          - ``cache.sort.count``, ``cache.sort.time``: rebuilds of the sorted index of the keys (used by :meth:`group`, :meth:`irange` and :meth:`iprefix`)
+          - ``getitem.{count,time}``, ``setitem.{count,time}``, ``delitem.{count,time}``, ``append_rows.{count,time}``, ``vacuum.{count,time}``,
+            ``verify.{count,time}``: calls of the corresponding methods
+          - ``vacuum.deferred``: automatic calls of :meth:`vacuum` which were postponed, because values were mapped in memory (see ``auto_vacuum``)
+          - ``checksum.{count,time}``: verifications of the checksum of a value, when reading it (see ``verify_on_read``)
+          - ``fsync.{count,time}``: syncs of the file to the disk (see ``durability`` and :meth:`sync`)
+          - ``info.{count,time}``: reads of the properties of values (see :meth:`info`)
+          - ``populate.{count,time}``: mappings of the pages of the values read (see ``populate`` and ``hugepages``)
+          - ``pickler.dispatch.{count,time}``: searches of the pickler able to read a value
+          - ``pickler.<name>.probe.{count,time}``: calls of :meth:`is_valid` of the pickler ``<name>``, during these searches
+          - ``pickler.<name>.read.{count,time}``, ``pickler.<name>.read_bytes``: values read by the pickler ``<name>``
+          - ``pickler.<name>.write.{count,time}``, ``pickler.<name>.write_bytes``: values written by the pickler ``<name>``
+          - ``pickler.<name>.append.{count,time}``: rows appended by the pickler ``<name>``
+
+        Keys are only present once the corresponding event happened.
+        Statistics should be enabled when creating the object (``mmapdict(..., stats=True)``), otherwise a :exc:`RuntimeError` is raised.
+        """
+        if self._stats is None:
+            raise RuntimeError("Statistics are not enabled, use mmapdict(..., stats=True)")
+        return self._stats.snapshot()
+
+    def reset_stats(self):
+        """Reset the statistics returned by :meth:`stats` to zero."""
+        if self._stats is None:
+            raise RuntimeError("Statistics are not enabled, use mmapdict(..., stats=True)")
+        self._stats.reset()
+
+    @property
+    def tracer(self):
+        """The :class:`mmappickle.trace.Tracer` receiving the timing of the operations, or ``None``."""
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, newvalue):
+        self._tracer = newvalue
+
+    def _span(self, *name, **args):
+        """:returns: a context manager measuring the block in the statistics and the tracer, if they are enabled.
+
+        :param name: parts of the name of the operation, joined by dots (this is only done if needed)
+        :param args: arguments of the operation, for the tracer"""
+        if self._stats is None and self._tracer is None:
+            return null_span
+        return _span(self._stats, self._tracer, '.'.join(name), args)
+
     def _cache_clear(self):
         self._cache_kv = None
+        self._cache_sorted_keys = None
         self._cache_kv_all = None
+        self._cache_dedup = None
+        self._cache_dead_bytes = None
+        # Pickler and info of each key, only used in immutable mode
+        self._cache_picklers = {}
+        self._cache_info = {}
+        if self._stats is not None:
+            self._stats.count('cache.clears')
 
     @property
-    @lock
+    @lock_shared
     @save_file_position
     def _kv_all(self):
         # Get all key-value couples in file
         if self._cache_kv_all is None:
-            self._cache_kv_all = []
-            offset = len(self._header)
-            self._file.seek(0, io.SEEK_END)
-            end_offset = self._file.tell() - len(self._terminator)
-            while offset < end_offset:
-                this_kv = _kvdata(self, offset)
-                self._cache_kv_all.append(this_kv)
-                offset += len(this_kv)
+            with self._span('cache.rebuild') as span:
+                self._cache_kv_all = []
+                offset = len(self._header)
+                self._file.seek(0, io.SEEK_END)
+                end_offset = self._file.tell() - len(self._terminator)
+                while offset < end_offset:
+                    this_kv = _kvdata(self, offset)
+                    self._cache_kv_all.append(this_kv)
+                    offset += len(this_kv)
+                span.set(entries=len(self._cache_kv_all), bytes=end_offset)
 
         return self._cache_kv_all
 
     @property
-    @lock
+    @lock_shared
     @save_file_position
     def _kv(self):
         # Get only valid key-values couples in file
         if self._cache_kv is None:
-            self._cache_kv = {}
-            for k in self._kv_all:
-                if k.valid:
-                    self._cache_kv[k.key] = k
+            kv_all = self._kv_all
+            with self._span('cache.index'):
+                self._cache_kv = {}
+                for k in kv_all:
+                    if k.valid:
+                        self._cache_kv[k.key] = k
 
         return self._cache_kv
 
-    @lock
+    @property
+    @lock_shared
+    def _sorted_keys(self):
+        # Get the valid keys, in sorted order
+        if self._cache_sorted_keys is None:
+            kv = self._kv
+            with self._span('cache.sort'):
+                self._cache_sorted_keys = sorted(kv)
+
+        return self._cache_sorted_keys
+
+    @property
+    @lock_shared
+    def _dedup_index(self):
+        # Get the values which can be referred to, as two dicts: by digest, and by memo index
+        if self._cache_dedup is None:
+            kv_all = self._kv_all
+            with self._span('cache.dedup'):
+                digests, memo = {}, {}
+                referenced = self._dedup_referenced()
+                if self._dedup or len(referenced) > 0:
+                    for kv in kv_all:
+                        # Deleted values are only kept if they are referred to
+                        valid = kv.valid
+                        if not valid and len(referenced) == 0:
+                            continue
+                        kind, memo_idx, digest = kv._dedup
+                        if kind == 'payload' and (valid or memo_idx in referenced):
+                            digests[digest] = kv
+                            memo[memo_idx] = kv
+                self._cache_dedup = (digests, memo)
+
+        return self._cache_dedup
+
+    def _dedup_referenced(self):
+        """:returns: the set of the memo indices of the values referred to by valid entries (see ``dedup``)"""
+        # A reference is the only possible value of 5 bytes, the other values are not read
+        return set(kv._dedup[1] for kv in self._kv_all
+                   if kv.data_length == 5 and kv.valid and kv._dedup[0] == 'reference')
+
+    def _sorted_keys_add(self, k):
+        # Update the sorted index of the keys (if it exists) after adding k
+        if self._cache_sorted_keys is not None:
+            bisect.insort(self._cache_sorted_keys, k)
+
+    def _sorted_keys_remove(self, k):
+        # Update the sorted index of the keys (if it exists) after removing k
+        if self._cache_sorted_keys is not None:
+            del self._cache_sorted_keys[bisect.bisect_left(self._cache_sorted_keys, k)]
+
+    @lock_shared
+    def _keys_with_prefix(self, prefix):
+        """:returns: the list of the keys starting with ``prefix``, in sorted order"""
+        sorted_keys = self._sorted_keys
+        ret = []
+        for i in range(bisect.bisect_left(sorted_keys, prefix), len(sorted_keys)):
+            if not sorted_keys[i].startswith(prefix):
+                break
+            ret.append(sorted_keys[i])
+        return ret
+
+    @lock_shared
+    def irange(self, lo=None, hi=None, inclusive=(True, False)):
+        """Iterate over the keys between ``lo`` and ``hi``, in sorted order.
+
+        :param lo: lower bound, or ``None`` to start from the first key
+        :param hi: upper bound, or ``None`` to go up to the last key
+        :param inclusive: tuple of booleans, telling if ``lo`` and ``hi`` are included (by default, ``lo <= k < hi``)
+        :returns: an iterator over the keys
+
+        The keys are searched in a sorted index of the keys, in ``O(log n + k)``.
+        """
+        sorted_keys = self._sorted_keys
+        start, end = 0, len(sorted_keys)
+        if lo is not None:
+            start = (bisect.bisect_left if inclusive[0] else bisect.bisect_right)(sorted_keys, lo)
+        if hi is not None:
+            end = (bisect.bisect_right if inclusive[1] else bisect.bisect_left)(sorted_keys, hi)
+        return iter(sorted_keys[start:end])
+
+    def iprefix(self, prefix):
+        """Iterate over the keys starting with ``prefix``, in sorted order.
+
+        :param prefix: prefix of the keys
+        :returns: an iterator over the keys
+
+        The keys are searched in a sorted index of the keys, in ``O(log n + k)``.
+        """
+        return iter(self._keys_with_prefix(prefix))
+
+    @lock_shared
     def __contains__(self, k):
         """Check if a key exists in dictionnary
 
@@ -553,18 +1033,17 @@ class mmapdict:
         """
         return k in self._kv
 
-    @lock
+    @lock_shared
     def keys(self):
         """:returns: a set-like object providing a view on D's keys"""
         return self._kv.keys()
 
     @require_writable
-    @lock
-    @save_file_position
+    @traced('setitem')
     def __setitem__(self, k, v):
         """Create or change key ``k``, sets its value to ``v``.
 
-        :param k: key, should be an unicode string of binary length <= 255.
+        :param k: key, should be an unicode string.
         :param v: value, any picklable object
 
         When replacing a value, this function adds the new key-value pair at the end of the file, and
@@ -573,10 +1052,14 @@ class mmapdict:
         using the old value if they don't reload the value from the file.
 
         If no concurrent access exists to the file, the old value can be freed using :meth:`vacuum`.
-        """
-        if k in self:
-            del self[k]
 
+        With ``locking='range'``, the values whose size is known in advance (e.g. arrays, see
+        :meth:`mmappickle.picklers.base.BasePickler.size`) are written in three steps: their entry is reserved at the
+        end of the file while the file is locked, then the value is written while the file is not locked (so other
+        processes can read and write other keys meanwhile), and the entry is made valid while the file is locked.
+        Reserved entries are ignored when reading the file. If the writer is interrupted, they are freed by
+        :meth:`vacuum`, or replaced by deleted entries by :meth:`fsck`.
+        """
         found = False
         for pickler in self._picklers:
             if pickler.is_picklable(v):
@@ -586,37 +1069,321 @@ class mmapdict:
         if not found:
             raise TypeError("Could not find a pickler for element of type {}".format(type(v)))
 
+        digest = pickler.digest(v) if self._dedup else None
+        reservation = self._setitem_locked(k, v, pickler, digest)
+        if reservation is not None:
+            self._write_reserved(reservation, v, pickler, digest)
+
+    @lock
+    @save_file_position
+    def _setitem_locked(self, k, v, pickler, digest):
+        """Write key ``k`` (see :meth:`__setitem__`), or reserve its entry if the value can be written without the lock.
+
+        :returns: None if the value was written, otherwise the reservation (see :meth:`_reserve`)"""
+        original = self._dedup_index[0].get(digest) if digest is not None else None
+
         offset = max([x.end_offset for x in self._kv_all] + [len(self._header)])
         memomaxidx = max([x.memomaxidx for x in self._kv_all] + [1])
+        if self._locking == 'range' and original is None:
+            size = pickler.size(v, memomaxidx)
+            if size is not None:
+                return self._reserve(k, offset, memomaxidx, size, digest)
+
+        if k in self:
+            del self[k]
+
         kv = _kvdata(self, offset)
         kv.key = k
-        kv.data_length, kv.memomaxidx = pickler.write(v, kv.data_offset, memomaxidx)
+        if original is not None:
+            # The same value is already in the file, only write a reference to it
+            self._file.seek(kv.data_offset, io.SEEK_SET)
+            data_length = self._file.write(pickle.LONG_BINGET + struct.pack('<I', original._dedup[1]))
+            if self._stats is not None:
+                self._stats.count('dedup.references')
+        else:
+            with self._span('pickler', pickler.__class__.__name__, 'write', key=k, offset=kv.data_offset) as span:
+                data_length, new_memomaxidx = pickler.write(v, kv.data_offset, memomaxidx)
+                span.set(bytes=data_length)
+            if self._stats is not None:
+                self._stats.count('pickler.{}.write_bytes'.format(pickler.__class__.__name__), data_length)
+            if digest is not None:
+                # Put the value in the memo, so that it can be referred to
+                memo_idx = max(memomaxidx, new_memomaxidx)
+                self._file.seek(kv.data_offset + data_length, io.SEEK_SET)
+                data_length += self._file.write(pickle.LONG_BINPUT + struct.pack('<I', memo_idx) +
+                                                pickle.SHORT_BINBYTES + struct.pack('<B', len(digest)) + digest + pickle.POP)
+                memomaxidx = memo_idx + 1
+            else:
+                memomaxidx = new_memomaxidx
+        if self._checksums:
+            kv.checksum = _crc32_file(self._file, kv.data_offset, data_length)
+        self._sync_data()
+        kv.data_length, kv.memomaxidx = data_length, memomaxidx
         # Update cache
         self._cache_kv[kv.key] = kv
         self._cache_kv_all.append(kv)
-        self.commit_number += 1
+        self._sorted_keys_add(kv.key)
+        if digest is not None and original is None and self._cache_dedup is not None:
+            self._cache_dedup[0][digest] = kv
+            self._cache_dedup[1][memo_idx] = kv
+        self._commit()
+        self._maybe_vacuum()
+
+    def _reserve(self, k, offset, memomaxidx, size, digest):
+        """Reserve the entry of key ``k`` at ``offset``, and lock it until its value is written.
+
+        :param memomaxidx: first memo index of the value
+        :param size: ``(length, last memo index)`` of the pickled value, see
+          :meth:`mmappickle.picklers.base.BasePickler.size`
+        :param digest: digest of the value, if it can be referred to (see ``dedup``)
+        :returns: the reservation ``(entry, first memo index of the value, memo index of the digest)``"""
+        data_length, new_memomaxidx = size
+        memo_idx = None
+        if digest is not None:
+            memo_idx = max(memomaxidx, new_memomaxidx)
+            data_length += _kvdata._dedup_suffix_length
+            new_memomaxidx = memo_idx + 1
+
+        kv = _kvdata(self, offset)
+        kv._cache['reserved'] = True
+        kv.key = k
+        kv.valid = False
+        if self._checksums:
+            # Written with the value
+            kv.checksum = 0
+        kv.memomaxidx = new_memomaxidx
+        kv.data_length = data_length
+        _lock_range(self._file, 'exclusive', offset, len(kv))
+        # Other processes should see that the end of the file changed
+        self._cache_kv_all.append(kv)
+        self._commit()
+        return kv, memomaxidx, memo_idx
+
+    @save_file_position
+    def _write_reserved(self, reservation, v, pickler, digest):
+        """Write value ``v`` in its reserved entry (see :meth:`_reserve`), without locking the file, then make it valid.
+
+        The value can only be written inside of the reserved entry, in case the size given by the pickler is wrong:
+        the entries after it may already be used by other processes."""
+        kv, memomaxidx, memo_idx = reservation
+        try:
+            file = self._file
+            self._file = _bounded_file(file, kv.data_offset, kv.data_length)
+            try:
+                with self._span('pickler', pickler.__class__.__name__, 'write', key=kv.key, offset=kv.data_offset) as span:
+                    data_length = pickler.write(v, kv.data_offset, memomaxidx)[0]
+                    span.set(bytes=data_length)
+                if self._stats is not None:
+                    self._stats.count('pickler.{}.write_bytes'.format(pickler.__class__.__name__), data_length)
+                if digest is not None:
+                    self._file.seek(kv.data_offset + data_length, io.SEEK_SET)
+                    data_length += self._file.write(pickle.LONG_BINPUT + struct.pack('<I', memo_idx) + pickle.SHORT_BINBYTES +
+                                                    struct.pack('<B', len(digest)) + digest + pickle.POP)
+            finally:
+                self._file = file
+            if data_length != kv.data_length:
+                raise RuntimeError("{} wrote {} bytes instead of the {} bytes reserved".format(
+                    pickler.__class__.__name__, data_length, kv.data_length))
+            checksum = _crc32_file(self._file, kv.data_offset, data_length) if self._checksums else None
+            self._sync_data()
+        except BaseException:
+            self._cancel_reservation(kv)
+            raise
+        self._commit_reservation(kv, checksum, digest, memo_idx)
+
+    @lock
+    @save_file_position
+    def _commit_reservation(self, kv, checksum, digest, memo_idx):
+        """Make the reserved entry ``kv`` valid, once its value is written (see :meth:`_write_reserved`)"""
+        k = kv.key
+        if k in self:
+            del self[k]
+
+        kv._resize(kv.data_length, kv.memomaxidx, checksum, valid=False)
+        kv._unreserve()
+        self._sync_data()
+        kv.valid = True
+        _lock_range(self._file, 'unlock', kv.offset, len(kv))
+
+        # Update cache (the entries may have been read again while the value was written)
+        kv_all = self._kv_all
+        for i in range(len(kv_all) - 1, -1, -1):
+            if kv_all[i].offset == kv.offset:
+                kv_all[i] = kv
+                break
+        self._cache_kv[k] = kv
+        self._sorted_keys_add(k)
+        if digest is not None and self._cache_dedup is not None:
+            self._cache_dedup[0][digest] = kv
+            self._cache_dedup[1][memo_idx] = kv
+        self._cache_dead_bytes = None
+        self._commit()
+        self._maybe_vacuum()
 
     @lock
+    @save_file_position
+    def _cancel_reservation(self, kv):
+        """Replace the reserved entry ``kv`` by a deleted entry, if its value could not be written"""
+        length = len(kv)
+        _fsck_write_filler(self._file, kv.offset, length)
+        _lock_range(self._file, 'unlock', kv.offset, length)
+        self._cache_clear()
+        self._commit()
+
+    def _reservation_in_progress(self, offset, length):
+        """:returns: True if a value is being written in the reserved entry at ``offset``, see :meth:`__setitem__`"""
+        if not _range_locks_supported():
+            # Can't be known
+            return True
+        if not _lock_range(self._file, 'shared', offset, length, wait=False):
+            return True
+        _lock_range(self._file, 'unlock', offset, length)
+        return False
+
+    def _values_being_written(self):
+        """:returns: True if values are being written in reserved entries, by this process or others"""
+        return any(kv.reserved and self._reservation_in_progress(kv.offset, len(kv)) for kv in self._kv_all if not kv.valid)
+
+    @traced('getitem')
+    @lock_shared
     def __getitem__(self, k):
         """Get value for key ``k``, raise ``KeyError`` if the key doesn't exists in file.
 
         If possible, the data will be returned as a mmap'ed object."""
-        if k not in self:
+        data_offset, data_length = self._value_location(k)
+        pickler = self._pickler(k, data_offset, data_length)
+        with self._span('pickler', pickler.__class__.__name__, 'read', key=k, offset=data_offset, bytes=data_length):
+            value = pickler.read(data_offset, data_length)[0]
+        if self._advice is not None:
+            self._advise([(data_offset, data_length)], self._advice, value)
+        if self._populate or self._hugepages:
+            with self._span('populate', key=k, offset=data_offset, bytes=data_length):
+                self._prefault(data_offset, data_length, value)
+        if self._stats is not None:
+            self._stats.count('pickler.{}.read_bytes'.format(pickler.__class__.__name__), data_length)
+        return value
+
+    @lock_shared
+    def get_many(self, keys):
+        """Get the values of ``keys``, see :meth:`__getitem__`. The file is locked only once.
+
+        :returns: a list of the values, in the same order as ``keys``
+        """
+        return [self[k] for k in keys]
+
+    def _value_location(self, k, verify=True):
+        """:returns: ``(offset, length)`` of the pickled value of key ``k`` (of the value it refers to, if it is a
+        reference), without the suffix used for deduplication.
+
+        :param verify: if True, the checksums are verified if ``verify_on_read`` is set"""
+        kv = self._kv.get(k)
+        if kv is None:
             raise KeyError(k)
 
-        data_offset = self._kv[k].data_offset
-        data_length = self._kv[k].data_length
-        found = False
-        for pickler in self._picklers:
-            if pickler.is_valid(data_offset, data_length):
-                found = True
-                break
+        data_offset = kv.data_offset
+        data_length = kv.data_length
+        kind, memo_idx, digest = kv._dedup
+        original = None
+        if kind == 'reference':
+            original = self._dedup_index[1].get(memo_idx)
+            if original is None:
+                raise ValueError("Value of key {!r} refers to a missing value".format(k))
+            data_offset = original.data_offset
+            data_length = original.data_length
+            kind = original._dedup[0]
+        if verify and self._verify_on_read:
+            for entry in (kv, original):
+                if entry is not None and not self._verify_entry(entry):
+                    raise ValueError("Checksum mismatch for key {!r}".format(k))
+        if kind == 'payload':
+            data_length -= _kvdata._dedup_suffix_length
+        return data_offset, data_length
+
+    def _pickler(self, k, data_offset, data_length):
+        """:returns: the pickler able to read the value of key ``k``, located at ``(data_offset, data_length)``"""
+        pickler = self._cache_picklers.get(k)
+        if pickler is None:
+            found = False
+            with self._span('pickler.dispatch', key=k, offset=data_offset) as span:
+                for pickler in self._picklers:
+                    with self._span('pickler', pickler.__class__.__name__, 'probe', key=k, offset=data_offset):
+                        found = pickler.is_valid(data_offset, data_length)
+                    if found:
+                        span.set(pickler=pickler.__class__.__name__)
+                        break
+
+            if not found:
+                raise ValueError("No picklers are valid to key {!r}".format(k))
+            if self._immutable:
+                self._cache_picklers[k] = pickler
+        return pickler
+
+    @lock_shared
+    def lazy(self, k):
+        """Get a proxy of the value of key ``k``, which is read when it is first used.
+
+        :returns: a :class:`lazyvalue`. Its attributes (and the usual operations: ``len``, indexing, iteration,
+          comparison, conversion to a numpy array) are the ones of the value. The value itself is returned by
+          :meth:`lazyvalue.get`.
+
+        The value is read once, then kept by the proxy until key ``k`` is changed (or rows are appended to it).
+        """
+        return lazyvalue(self, k, self._lazy_location(k))
 
-        if not found:
-            raise ValueError("No picklers are valid to key {!r}".format(k))
-        return pickler.read(data_offset, data_length)[0]
+    def _lazy_location(self, k):
+        """:returns: what changes when the value of key ``k`` is changed (the value is replaced, or rows are appended
+        to it, see :meth:`append_rows`), without reading it"""
+        kv = self._kv.get(k)
+        if kv is None:
+            raise KeyError(k)
+        data_offset, data_length = self._value_location(k, verify=False)
+        info = self._pickler(k, data_offset, data_length).info(data_offset, data_length)
+        return kv.offset, data_length, info.get('shape')
+
+    @lock_shared
+    def _lazy_get(self, proxy):
+        """:returns: the value of a :class:`lazyvalue`, read again only if the key was changed"""
+        commit_number = self.commit_number
+        if proxy._commit_number != commit_number:
+            location = self._lazy_location(proxy._key)
+            if location != proxy._location:
+                # The key was changed
+                proxy._location = location
+                proxy._loaded = False
+            proxy._commit_number = commit_number
+        if not proxy._loaded:
+            proxy._value = self[proxy._key]
+            proxy._loaded = True
+        return proxy._value
+
+    @lock_shared
+    def info(self, k):
+        """Get the properties of the value of key ``k``, without reading it (in particular, arrays are not mapped).
+
+        :returns: a :class:`valueinfo`
+        """
+        ret = self._cache_info.get(k)
+        if ret is None:
+            with self._span('info', key=k):
+                # The value is not read, its checksum is not verified
+                data_offset, data_length = self._value_location(k, verify=False)
+                pickler = self._pickler(k, data_offset, data_length)
+                ret = valueinfo(k, pickler.__class__.__name__, data_offset, data_length,
+                                **pickler.info(data_offset, data_length))
+            if self._immutable:
+                self._cache_info[k] = ret
+        return ret
+
+    @lock_shared
+    def info_many(self, keys):
+        """Get the properties of the values of ``keys``, see :meth:`info`. The file is locked only once.
+
+        :returns: a list of :class:`valueinfo`, in the same order as ``keys``
+        """
+        return [self.info(k) for k in keys]
 
     @require_writable
+    @traced('delitem')
     @lock
     @save_file_position
     def __delitem__(self, k):
@@ -634,11 +1401,478 @@ class mmapdict:
         if k not in self:
             raise KeyError(k)
 
+        self._dead_bytes_add(self._kv[k])
         self._kv[k].valid = False
         del self._kv[k]
-        self.commit_number += 1
+        self._sorted_keys_remove(k)
+        self._commit()
+        self._maybe_vacuum()
+
+    def _value_range(self, kv):
+        """:returns: ``(offset, length)`` of the data of entry ``kv`` (of the value it refers to, if it is a reference)"""
+        if kv._dedup[0] == 'reference':
+            kv = self._dedup_index[1].get(kv._dedup[1], kv)
+        return kv.data_offset, kv.data_length
+
+    @lock_shared
+    def advise(self, keys, advice):
+        """Give a hint to the operating system about the use of the values of ``keys``.
+
+        :param keys: keys of the values
+        :param advice: one of:
+
+          - ``'willneed'``: the values will be read soon, they are read in the page cache in the background
+          - ``'dontneed'``: the values won't be read soon, they can be removed from the page cache
+          - ``'sequential'``, ``'random'``: the values are read sequentially (more readahead), or in random order
+          - ``'normal'``: no specific hint
+
+        The hint is given using ``posix_fadvise`` on the bytes of the values in the file (and ``madvise`` on the
+        memory map, if ``immutable`` is set). It does nothing if the operating system doesn't support it.
+
+        The readahead of a memory map depends on its own hint, which is only given to the memory maps returned
+        by :meth:`__getitem__` if the ``advice`` parameter of :class:`mmapdict` is set.
+        """
+        if advice not in _advice_names:
+            raise ValueError("advice should be one of {}".format(', '.join(_advice_names)))
+        ranges = []
+        for k in keys:
+            kv = self._kv.get(k)
+            if kv is None:
+                raise KeyError(k)
+            ranges.append(self._value_range(kv))
+        if advice == 'dontneed':
+            # Dirty pages are not removed from the page cache
+            self._file.flush()
+        self._advise(ranges, advice)
+
+    def prefetch(self, keys):
+        """Start reading the values of ``keys`` in the page cache, in the background (see :meth:`advise`)"""
+        self.advise(keys, 'willneed')
+
+    def evict(self, keys):
+        """Remove the values of ``keys`` from the page cache (see :meth:`advise`).
+
+        The pages modified through memory maps which are not flushed yet are not removed."""
+        self.advise(keys, 'dontneed')
+
+    def _advise(self, ranges, advice, value=None):
+        """Give ``advice`` about the ``(offset, length)`` ranges of the file, and about the memory map of ``value``"""
+        fadvise_name, madvise_name = _advice_names[advice]
+        if hasattr(os, 'posix_fadvise'):
+            fileno = self._file.fileno()
+            for offset, length in ranges:
+                os.posix_fadvise(fileno, offset, length, getattr(os, fadvise_name))
+
+        import mmap
+        if not hasattr(mmap, madvise_name):
+            return
+        if self._immutable:
+            for offset, length in ranges:
+                start = offset - offset % mmap.PAGESIZE
+                self._file.mmap.madvise(getattr(mmap, madvise_name), start, offset + length - start)
+        else:
+            value_mmap = getattr(value, '_mmap', None)
+            if value_mmap is not None:
+                value_mmap.madvise(getattr(mmap, madvise_name))
+
+    def _prefault(self, offset, length, value):
+        """Request huge pages for the memory map of ``value``, and map its pages (see ``populate`` and ``hugepages``).
+
+        :param offset: offset of the data of ``value`` in the file
+        :param length: length of the data of ``value``"""
+        import mmap
+        if self._immutable:
+            value_mmap = self._file.mmap
+            start = offset - offset % mmap.PAGESIZE
+            end = offset + length
+        else:
+            value_mmap = getattr(value, '_mmap', None)
+            if value_mmap is None:
+                return
+            start, end = 0, len(value_mmap)
+        if start == end:
+            return
+
+        if self._hugepages and hasattr(mmap, 'MADV_HUGEPAGE'):
+            try:
+                value_mmap.madvise(mmap.MADV_HUGEPAGE, start, end - start)
+            except OSError:
+                pass  # Not supported
+        if self._populate:
+            if hasattr(mmap, 'MADV_POPULATE_READ'):
+                try:
+                    value_mmap.madvise(mmap.MADV_POPULATE_READ, start, end - start)
+                    return
+                except OSError:
+                    pass  # Not supported by this kernel
+            # Read one byte of each page
+            with memoryview(value_mmap) as view:
+                bytes(view[start:end:mmap.PAGESIZE])
+
+    def _lease(self, value):
+        """Hold a shared lease on the file while ``value`` (which maps the file in memory) exists, see ``auto_vacuum``"""
+        if self._leases == 0:
+            _lease_file(self._file, 'shared')
+        self._leases += 1
+        weakref.finalize(value, _release_lease, weakref.ref(self))
+
+    def _commit(self, commit_number=None):
+        """Change the commit number (by default, increment it), after a change of the file.
+
+        The file is synced according to the ``durability`` parameter, see :meth:`mmapdict`."""
+        if commit_number is None:
+            commit_number = self.commit_number + 1
+        if self._durability == 'always':
+            self.sync()
+        self.commit_number = commit_number
+        if self._durability == 'always':
+            self.sync()
+        elif self._durability == 'batch':
+            self._sync_pending += 1
+            if self._sync_pending >= self._fsync_commits or time.monotonic() - self._sync_time >= self._fsync_interval:
+                self.sync()
+
+    def _sync_data(self):
+        """Sync the data written so far (e.g. before writing the end of an entry), if ``durability`` is ``'always'``"""
+        if self._durability == 'always':
+            self.sync()
+
+    def sync(self):
+        """Write the changes to the disk (with ``fsync``, or ``fdatasync`` if available).
+
+        This is done automatically, depending on the ``durability`` parameter (see :class:`mmapdict`). For example,
+        it should be called after the last change if ``durability`` is ``'batch'``."""
+        with self._span('fsync'):
+            self._file.flush()
+            _fsync(self._file.fileno())
+        self._sync_pending = 0
+        self._sync_time = time.monotonic()
+
+    def group(self, name):
+        """Get a view on the keys starting with ``name/``, which can be used like a dictionnary.
+
+        :param name: name of the group (for example ``'run42'``, or ``'run42/frame0001'`` for a nested group)
+        :returns: a :class:`mmapgroup` object
+        """
+        if not name.endswith('/'):
+            name += '/'
+        return mmapgroup(self, name)
+
+    @require_writable
+    @lock
+    def _delete_keys(self, keys):
+        """Mark all the keys in ``keys`` as not valid, see :meth:`__delitem__`."""
+        keys = list(keys)
+        for k in keys:
+            if k not in self:
+                raise KeyError(k)
+        for k in keys:
+            self._dead_bytes_add(self._kv[k])
+            self._kv[k].valid = False
+            del self._kv[k]
+            self._sorted_keys_remove(k)
+        if len(keys) > 0:
+            self._commit()
+            self._maybe_vacuum()
+
+    @require_writable
+    @traced('append_rows')
+    @lock
+    @save_file_position
+    def append_rows(self, k, block):
+        """Append rows to the array stored in key ``k``, along its first axis.
+
+        :param k: key of a C-ordered :class:`numpy.ndarray` (with at least one dimension)
+        :param block: array of the rows to append, its shape (except the first axis) should match the shape of the array
+
+        If the array was created with some capacity (see :class:`mmappickle.stubs.EmptyNDArray`), the rows are written
+        in the reserved space. Otherwise, if the array is the last value of the file, it is extended in place. Otherwise,
+        the array is copied at the end of the file, with twice the capacity needed, and the old copy is freed by
+        :meth:`vacuum`.
+
+        If the value has a checksum (see the ``checksums`` parameter), it is computed again, which reads the whole array.
+        """
+        kv = self._kv.get(k)
+        if kv is None:
+            raise KeyError(k)
+        if kv._dedup[0] is not None:
+            raise ValueError("Cannot append rows to the deduplicated value of key {!r}".format(k))
+
+        data_offset = kv.data_offset
+        data_length = kv.data_length
+        for pickler in self._picklers:
+            if hasattr(pickler, 'append_rows') and pickler.is_valid(data_offset, data_length):
+                break
+        else:
+            raise TypeError("Value of key {!r} is not an array".format(k))
+
+        self._file.seek(0, io.SEEK_END)
+        is_last = kv.end_offset == self._file.tell() - len(self._terminator)
+        memomaxidx = kv.memomaxidx
+        has_checksum = kv.checksum is not None
+
+        with self._span('pickler', pickler.__class__.__name__, 'append', key=k, offset=data_offset):
+            new_data_length = pickler.append_rows(data_offset, block, None if is_last else data_length)
+
+        if new_data_length is None:
+            # Not enough room, copy the array at the end of the file
+            from .stubs.numpy import EmptyNDArray
+            old_value = self[k]
+            new_shape = (old_value.shape[0] + len(block), ) + old_value.shape[1:]
+            self[k] = EmptyNDArray(new_shape, old_value.dtype, capacity=2 * new_shape[0])
+            new_value = self[k]
+            new_value[:old_value.shape[0]] = old_value
+            new_value[old_value.shape[0]:] = block
+            new_kv = self._kv[k]
+            if new_kv.checksum is not None or self._durability == 'always':
+                new_value.flush()
+                del new_value
+                self._sync_data()
+            if new_kv.checksum is not None:
+                new_kv._resize(new_kv.data_length, new_kv.memomaxidx,
+                               _crc32_file(self._file, new_kv.data_offset, new_kv.data_length))
+                self._sync_data()
+        elif new_data_length != data_length:
+            checksum = _crc32_file(self._file, data_offset, new_data_length) if has_checksum else None
+            self._sync_data()
+            kv._resize(new_data_length, memomaxidx, checksum)
+            self._file.truncate(kv.end_offset)
+            self._terminator.write()
+            self._commit()
+        else:
+            self._sync_data()
+            if has_checksum:
+                kv._resize(data_length, memomaxidx, _crc32_file(self._file, data_offset, data_length))
+                self._sync_data()
+            # The shape of the array changed
+            self._commit()
+
+    @save_file_position
+    def _verify_entry(self, kv):
+        """:returns: False if the checksum of entry ``kv`` doesn't match its data (True if there is no checksum)"""
+        checksum = kv.checksum
+        if checksum is None:
+            return True
+        with self._span('checksum', key=kv.key, offset=kv.data_offset, bytes=kv.data_length):
+            return checksum == _crc32_file(self._file, kv.data_offset, kv.data_length)
+
+    @traced('verify', with_key=False)
+    @lock_shared
+    @save_file_position
+    def verify(self, keys=None, workers=None, chunk_size=67108864):
+        """Verify the checksums of the values (see the ``checksums`` parameter).
+
+        :param keys: keys to verify (default: all keys)
+        :param workers: number of worker processes reading the file in parallel (default: the file is read by this process)
+        :param chunk_size: values are split in chunks of this size, so that large values are also verified in parallel
+        :returns: the list of the keys whose value doesn't match its checksum. Values without checksum are not verified.
+
+        The checksums of the chunks are computed independently, then combined (as :func:`zlib.crc32` would do on the
+        whole value). Each worker process opens the file by its name.
+        """
+        if keys is None:
+            keys = list(self.keys())
+
+        # Entries to verify, for each key (the value referred to is also verified)
+        entries = {}
+        key_entries = []
+        for k in keys:
+            kv = self._kv.get(k)
+            if kv is None:
+                raise KeyError(k)
+            key_entry = [kv]
+            if kv._dedup[0] == 'reference':
+                original = self._dedup_index[1].get(kv._dedup[1])
+                if original is None:
+                    raise ValueError("Value of key {!r} refers to a missing value".format(k))
+                key_entry.append(original)
+            key_entry = [e for e in key_entry if e.checksum is not None]
+            for e in key_entry:
+                entries[e.data_offset] = e
+            key_entries.append((k, key_entry))
+
+        # Split the entries in chunks
+        tasks = []
+        for e in entries.values():
+            for offset in range(e.data_offset, e.data_offset + e.data_length, chunk_size):
+                tasks.append((offset, min(chunk_size, e.data_offset + e.data_length - offset)))
+
+        if workers is None or workers <= 1:
+            crcs = [_crc32_file(self._file, offset, length) for offset, length in tasks]
+        else:
+            import multiprocessing
+
+            self._file.flush()
+            with multiprocessing.Pool(workers, _verify_worker_init, (self._file.name, )) as pool:
+                crcs = pool.map(_verify_worker, tasks, chunksize=max(1, len(tasks) // (workers * 4)))
+
+        # Combine the checksums of the chunks (in order)
+        checksums = {}
+        for (offset, length), crc in zip(tasks, crcs):
+            if offset in entries:
+                data_offset = offset
+                checksums[data_offset] = 0
+            checksums[data_offset] = _crc32_combine(checksums[data_offset], crc, length)
+
+        return [k for k, key_entry in key_entries if any(checksums[e.data_offset] != e.checksum for e in key_entry)]
+
+    @require_writable
+    @lock
+    def update(self, other=(), **kw):
+        """Set several keys at once, like :meth:`dict.update`.
+
+        :param other: a mapping, or an iterable of ``(key, value)`` pairs
+        :param kw: additional keys to set
+
+        All the values are written while holding the lock only once, which is faster than setting
+        the keys one by one when there is concurrent access to the file.
+        """
+        if hasattr(other, 'keys'):
+            other = [(k, other[k]) for k in other.keys()]
+        for k, v in other:
+            self[k] = v
+        for k, v in kw.items():
+            self[k] = v
+
+    @lock_shared
+    def _partition_keys(self, keys, n):
+        """Split ``keys`` in at most ``n`` lists, such that the total length of the pickled data in each list is balanced.
+
+        :returns: a list of lists of keys, largest list first."""
+        sizes = []
+        for k in keys:
+            if k not in self:
+                raise KeyError(k)
+            sizes.append((self._kv[k].data_length, k))
+        sizes.sort(key=lambda x: x[0], reverse=True)
+
+        # Greedy (longest processing time first) assignment to the least loaded partition
+        partitions = [(0, i, []) for i in range(min(n, len(sizes)))]
+        for size, k in sizes:
+            total, i, partition_keys = heapq.heappop(partitions)
+            partition_keys.append(k)
+            heapq.heappush(partitions, (total + size, i, partition_keys))
+
+        return [p[2] for p in sorted(partitions, key=lambda x: x[0], reverse=True)]
+
+    def map(self, func, keys=None, processes=None, out=None):
+        """Apply ``func`` to the values of the dictionnary, in parallel using a :class:`multiprocessing.Pool`.
+
+        :param func: function taking a value as only argument. It should be picklable (i.e. defined at the top level of a module).
+        :param keys: keys on which ``func`` is applied (default: all keys)
+        :param processes: number of worker processes (default: :func:`os.cpu_count`)
+        :param out: if not ``None``, a :class:`mmapdict` in which the results are stored, under the same keys.
+        :returns: a dictionnary containing the results if ``out`` is ``None``, ``None`` otherwise.
+
+        The keys are partitioned according to the length of their data, to balance the load between the workers.
+        Each worker process opens the file only once, and writes its results to ``out`` in batches (see :meth:`update`).
+        """
+        import multiprocessing
+
+        if keys is None:
+            keys = list(self.keys())
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if out is not None and not out.writable:
+            raise io.UnsupportedOperation('out is not writable')
+
+        # Use more partitions than processes, so that a slow partition doesn't keep the other workers idle
+        partitions = self._partition_keys(keys, processes * 4)
+        self._file.flush()
+
+        # The pickled state is sent to the initializer, which forces each worker to re-open the files
+        # (even when forking, which would otherwise share the file position with this process)
+        state = pickle.dumps((self, func, out))
+
+        results = {}
+        with multiprocessing.Pool(processes, _map_worker_init, (state, )) as pool:
+            for partition_results in pool.imap_unordered(_map_worker, partitions):
+                results.update(partition_results)
+
+        if out is not None:
+            return None
+        return results
+
+    def _dead_entries(self):
+        """:returns: the list of the deleted entries, which are freed by :meth:`vacuum`"""
+        # Deleted values which are still referred to (see the dedup parameter) are kept
+        referenced = self._dedup_referenced()
+
+        return [kv for kv in self._kv_all
+                if not kv.valid and
+                not (len(referenced) > 0 and kv._dedup[0] == 'payload' and kv._dedup[1] in referenced) and
+                not (kv.reserved and self._reservation_in_progress(kv.offset, len(kv)))]
+
+    @property
+    def _dead_bytes(self):
+        """Number of bytes freed by :meth:`vacuum`"""
+        if self._cache_dead_bytes is None:
+            self._cache_dead_bytes = sum(len(kv) for kv in self._dead_entries())
+        return self._cache_dead_bytes
+
+    def _dead_bytes_add(self, kv):
+        """Update the number of dead bytes, before entry ``kv`` is deleted"""
+        if self._cache_dead_bytes is not None:
+            if kv._dedup[0] is None:
+                self._cache_dead_bytes += len(kv)
+            else:
+                # A value which can be referred to is only freed with its last reference
+                self._cache_dead_bytes = None
+
+    @lock_shared
+    @save_file_position
+    def space_report(self, max_holes=10):
+        """Get how the space of the file is used, e.g. to know how much space :meth:`vacuum` would free.
+
+        :param max_holes: maximum number of holes returned (the largest ones)
+        :returns: a :class:`spacereport`
+        """
+        dead = self._dead_entries()
+        self._cache_dead_bytes = sum(len(kv) for kv in dead)
+
+        ret = spacereport()
+        self._file.seek(0, io.SEEK_END)
+        ret.file_size = self._file.tell()
+        ret.overhead = len(self._header) + len(self._terminator)
+        ret.dead_bytes = self._cache_dead_bytes
+        ret.live_bytes = ret.file_size - ret.overhead - ret.dead_bytes
+        ret.keys = {k: len(kv) for k, kv in self._kv.items()}
+
+        # Merge the adjacent deleted entries
+        holes = []
+        for kv in dead:
+            if len(holes) > 0 and holes[-1][1] == kv.offset:
+                holes[-1][1] = kv.end_offset
+            else:
+                holes.append([kv.offset, kv.end_offset])
+        ret.holes = heapq.nlargest(max_holes, [(start, end - start) for start, end in holes], key=lambda x: x[1])
+        return ret
+
+    @save_file_position
+    def _maybe_vacuum(self):
+        """Call :meth:`vacuum` if required by ``auto_vacuum``, and if no value of the file is mapped in memory"""
+        if self._auto_vacuum is None or self._locked > 1:
+            # Disabled, or called during another change (e.g. when __setitem__ replaces a key)
+            return
+        dead_bytes = self._dead_bytes
+        if dead_bytes < self._auto_vacuum_min_bytes:
+            return
+        self._file.seek(0, io.SEEK_END)
+        if dead_bytes < self._auto_vacuum * self._file.tell():
+            return
+
+        # The shared leases are held by the values mapped in memory, in all the processes
+        if self._values_being_written() or self._leases > 0 or not _lease_file(self._file, 'exclusive'):
+            if self._stats is not None:
+                self._stats.count('vacuum.deferred')
+            return
+        try:
+            self.vacuum()
+        finally:
+            _lease_file(self._file, 'unlock')
 
     @require_writable
+    @traced('vacuum', with_key=False)
     @lock
     @save_file_position
     def vacuum(self, chunk_size=1048576):
@@ -656,15 +1890,14 @@ class mmapdict:
 
             If an mmap exists, it could crash the process and/or corrupt the file and/or return invalid data.
 
+        See :meth:`space_report` to know how much space would be freed, and the ``auto_vacuum`` parameter of
+        :class:`mmapdict` to call it automatically when no mmap exists. ``RuntimeError`` is raised if values are being
+        written by other processes (see ``locking='range'`` in :meth:`__setitem__`).
 
         """
-        holes = []
-        for kv in self._kv_all:
-            assert isinstance(kv, _kvdata)
-            if kv.valid:
-                continue
-
-            holes.append((kv.offset, kv.end_offset))
+        if self._values_being_written():
+            raise RuntimeError("Cannot vacuum the file while values are being written")
+        holes = [(kv.offset, kv.end_offset) for kv in self._dead_entries()]
 
         self._file.seek(0, io.SEEK_END)
         file_size = self._file.tell()
@@ -694,10 +1927,7 @@ class mmapdict:
 
         self._cache_clear()
         # Set the commit number to zero, except if it was already 0 (always change it)
-        if self.commit_number == 0:
-            self.commit_number = 1
-        else:
-            self.commit_number = 0
+        self._commit(1 if self.commit_number == 0 else 0)
 
     @require_writable
     def _convert_file(self, chunk_size=1048576):
@@ -745,75 +1975,409 @@ class mmapdict:
         self.vacuum(chunk_size)  # Normally not needed, but should not harm
 
     @require_writable
-    def fsck(self):
+    @lock
+    @save_file_position
+    def fsck(self, salvage=False):
         """Attempt to fix the file, if possible.
 
         This function should be called if some data could not be written to a file. This might be the case if,
         for example, not enough disk space was available.
 
-        This method truncates the file and recreates a valid terminator.
+        By default, this method truncates the file at the first frame which is not valid, and recreates a valid
+        terminator. If ``salvage`` is True, the end of each entry is also checked, and the file is scanned past the
+        damaged regions to find the next valid entries (whose frame length and end are consistent, and whose checksum
+        matches, if any). The damaged regions are replaced by deleted entries, and only the end of the file is
+        truncated.
+
+        The reserved entries whose writer was interrupted (see :meth:`__setitem__`) are also replaced by deleted entries.
+
+        :param salvage: if True, keep the valid entries found after a damaged region
+        :returns: a :class:`fsckreport`, which is true if the file was valid
 
         .. warning::
 
           Calling this function may lead to data loss."""
+        import mmap
+
+        self._file.flush()
         self._file.seek(0, io.SEEK_END)
-        end_offset = self._file.tell()
-
-        self._file.seek(2, io.SEEK_SET)
-        frame_id = 0
-        valid = True
-        while True:
-            frame_start = self._file.tell()
-            frame_id += 1
-
-            print("Frame (?) {} starting at {}".format(frame_id, frame_start))
-
-            data = self._file.read(9)
-            if data[0] != pickle.FRAME[0]:
-                print("Not on frame boundary")
-                self._file.seek(frame_start)
-                valid = False
-                break
+        file_size = self._file.tell()
 
-            frame_length = struct.unpack('<Q', data[1:9])[0]
-            if frame_start + 9 + frame_length > end_offset:
-                print("Incomplete frame starting at {}".format(frame_start))
-                self._file.seek(frame_start)
-                valid = False
-                break
+        report = fsckreport()
+        data_end_offset = file_size
+        damaged_start = None
+        offset = len(self._header)
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while offset < file_size:
+                kind, length = _fsck_entry(mm, offset, salvage, damaged_start is not None)
+                if kind == 'entry' and damaged_start is not None and offset - damaged_start < _fsck_filler_min_length:
+                    # Not enough room for a deleted entry before this one: it is lost too
+                    kind = None
+                if kind == 'terminator' and offset + length == file_size and damaged_start is None:
+                    data_end_offset = offset
+                    break
+
+                if kind == 'entry':
+                    if damaged_start is not None:
+                        report.damaged.append((damaged_start, offset - damaged_start))
+                        damaged_start = None
+                    if mm[offset + 9:offset + 10] in _unreserved_key_opcodes and \
+                            not self._reservation_in_progress(offset, length):
+                        # The value may be incomplete
+                        report.valid = False
+                        report.damaged.append((offset, length))
+                    report.entries += 1
+                    offset += length
+                    continue
+
+                report.valid = False
+                if not salvage:
+                    break
+                if damaged_start is None:
+                    damaged_start = offset
+                # Search the next frame, by large reads of the memory map
+                offset = mm.find(pickle.FRAME, offset + 1)
+                if offset == -1:
+                    offset = file_size
+
+        if damaged_start is not None:
+            offset = damaged_start
+        if offset == file_size:
+            # No terminator
+            report.valid = False
+        report.truncated = data_end_offset - offset
+
+        for damaged_offset, damaged_length in report.damaged:
+            _fsck_write_filler(self._file, damaged_offset, damaged_length)
+        self._file.seek(offset, io.SEEK_SET)
+        self._file.truncate()
+        self._terminator.write()
+        if not report.valid:
+            self._cache_clear()
+            self._commit()
+        return report
 
-            if frame_id == 1:
-                print("[header]")
-                self._file.seek(frame_start + frame_length + 9, io.SEEK_SET)
-                continue
 
-            first_data = self._file.read(1)
+_fsync = getattr(os, 'fdatasync', os.fsync)
 
-            if first_data == pickle.DICT:
-                self._file.seek(frame_start + frame_length + 9 - 1, io.SEEK_SET)
-                terminator = self._file.read(1)
-                if terminator == pickle.STOP:
-                    print("[terminator]")
-                else:
-                    valid = False
-                    print("[terminator (invalid)]")
-                self._file.seek(frame_start, io.SEEK_SET)
-                break
+# Names of the constants of posix_fadvise and madvise for each advice, see mmapdict.advise
+_advice_names = {
+    'normal': ('POSIX_FADV_NORMAL', 'MADV_NORMAL'),
+    'sequential': ('POSIX_FADV_SEQUENTIAL', 'MADV_SEQUENTIAL'),
+    'random': ('POSIX_FADV_RANDOM', 'MADV_RANDOM'),
+    'willneed': ('POSIX_FADV_WILLNEED', 'MADV_WILLNEED'),
+    'dontneed': ('POSIX_FADV_DONTNEED', 'MADV_DONTNEED'),
+}
 
-            if first_data != pickle.SHORT_BINUNICODE:
-                print("[Unknown stuff starting with {}]".format(first_data))
-                self._file.seek(frame_start, io.SEEK_SET)
-                valid = False
-                break
 
-            key_length = self._file.read(1)[0]
+class lazyvalue:
+    """Proxy of a value of a :class:`mmapdict`, which is read when it is first used, see :meth:`mmapdict.lazy`."""
 
-            print("Frame [{}]".format(self._file.read(key_length).decode('utf8')))
-            self._file.seek(frame_start + frame_length + 9, io.SEEK_SET)
+    def __init__(self, mmapdict, key, location):
+        """
+        :param mmapdict: :class:`mmapdict` object containing the value
+        :param key: key of the value
+        :param location: location of the value, see :meth:`mmapdict._lazy_location`
+        """
+        self._mmapdict = mmapdict
+        self._key = key
+        self._location = location
+        self._commit_number = None
+        self._loaded = False
+        self._value = None
 
-        self._file.truncate()
-        self._terminator.write()
-        return valid
+    @property
+    def key(self):
+        """The key of the value"""
+        return self._key
+
+    @property
+    def loaded(self):
+        """True if the value was read (it may be read again if the key was changed)"""
+        return self._loaded
+
+    def get(self):
+        """:returns: the value (raise ``KeyError`` if the key was deleted)"""
+        return self._mmapdict._lazy_get(self)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __len__(self):
+        return len(self.get())
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __getitem__(self, k):
+        return self.get()[k]
+
+    def __contains__(self, x):
+        return x in self.get()
+
+    def __eq__(self, other):
+        return self.get() == other
+
+    def __ne__(self, other):
+        return self.get() != other
+
+    __hash__ = None
+
+    def __bool__(self):
+        return bool(self.get())
+
+    def __array__(self, *a):
+        import numpy
+        return numpy.asarray(self.get(), *a)
+
+    def __repr__(self):
+        return '<lazyvalue key={!r} loaded={}>'.format(self._key, self._loaded)
+
+
+class valueinfo:
+    """Properties of a value of a :class:`mmapdict`, see :meth:`mmapdict.info`."""
+
+    def __init__(self, key, pickler, offset, length, shape=None, dtype=None):
+        #: Key of the value
+        self.key = key
+        #: Name of the class of the pickler of the value (e.g. ``'ArrayPickler'``)
+        self.pickler = pickler
+        #: Offset of the pickled value in the file
+        self.offset = offset
+        #: Length of the pickled value in the file
+        self.length = length
+        #: Shape of the array, or None if the value is not an array
+        self.shape = shape
+        #: :class:`numpy.dtype` of the array, or None if the value is not an array
+        self.dtype = dtype
+
+    @property
+    def nbytes(self):
+        """Size of the elements of the array, in bytes, or None if the value is not an array"""
+        if self.shape is None:
+            return None
+        ret = self.dtype.itemsize
+        for x in self.shape:
+            ret *= x
+        return ret
+
+    def __repr__(self):
+        return '<valueinfo key={!r} pickler={} offset={} length={} shape={} dtype={}>'.format(
+            self.key, self.pickler, self.offset, self.length, self.shape, self.dtype)
+
+
+class spacereport:
+    """Use of the space of the file of a :class:`mmapdict`, see :meth:`mmapdict.space_report`."""
+
+    def __init__(self):
+        #: Size of the file
+        self.file_size = 0
+        #: Size of the header and of the terminator of the file
+        self.overhead = 0
+        #: Size of the entries kept by :meth:`mmapdict.vacuum` (including the deleted values which are still referred
+        #: to, see ``dedup``)
+        self.live_bytes = 0
+        #: Size of the deleted entries, which are freed by :meth:`mmapdict.vacuum`
+        self.dead_bytes = 0
+        #: Dict of the size of the entry of each key
+        self.keys = {}
+        #: List of the ``(offset, length)`` of the largest regions of deleted entries, the largest first
+        self.holes = []
+
+    @property
+    def dead_ratio(self):
+        """Ratio of the file size used by deleted entries"""
+        if self.file_size == 0:
+            return 0.0
+        return self.dead_bytes / self.file_size
+
+    def __repr__(self):
+        return '<spacereport file_size={} live_bytes={} dead_bytes={} keys={} holes={}>'.format(
+            self.file_size, self.live_bytes, self.dead_bytes, len(self.keys), self.holes)
+
+
+class fsckreport:
+    """Result of :meth:`mmapdict.fsck`. It is true if the file was valid (i.e. nothing was changed)."""
+
+    def __init__(self):
+        #: True if the file was valid
+        self.valid = True
+        #: Number of entries kept in the file (including the deleted ones)
+        self.entries = 0
+        #: List of the ``(offset, length)`` of the damaged regions, which were replaced by deleted entries
+        self.damaged = []
+        #: Number of bytes removed at the end of the file (not counting the terminator)
+        self.truncated = 0
+
+    def __bool__(self):
+        return self.valid
+
+    def __repr__(self):
+        return '<fsckreport valid={} entries={} damaged={} truncated={}>'.format(self.valid, self.entries, self.damaged,
+                                                                                 self.truncated)
+
+
+# Deleted entry used by fsck to fill a damaged region:
+# FRAME <length> SHORT_BINUNICODE 0 SHORT_BINBYTES|BINBYTES8 <length> <damaged data> BININT 0 POP POP POP
+_fsck_filler_min_length = 9 + 2 + 2 + 6 + 2
+
+
+def _fsck_entry(mm, offset, strict, resync):
+    """Check the entry starting at ``offset`` in memory map ``mm``, see :meth:`mmapdict.fsck`.
+
+    :param strict: if True, also check the end of the entry, that the key is valid UTF-8 and that another frame follows
+    :param resync: if True, also check the checksum (used for the first entry after a damaged region)
+    :returns: a tuple ``(kind, length)``, where kind is ``'entry'``, ``'terminator'`` or ``None`` if it is not valid"""
+    size = len(mm)
+    if offset + 11 > size or mm[offset] != pickle.FRAME[0]:
+        return None, 0
+    frame_length = struct.unpack_from('<Q', mm, offset + 1)[0]
+    end_offset = offset + 9 + frame_length
+    if end_offset > size:
+        return None, 0
+    if frame_length == 2 and mm[offset + 9:offset + 11] == pickle.DICT + pickle.STOP:
+        return 'terminator', 11
+
+    fmt = _key_length_formats.get(mm[offset + 9])
+    if fmt is None or offset + 10 + struct.calcsize(fmt) > end_offset:
+        return None, 0
+    key_offset = offset + 10 + struct.calcsize(fmt)
+    data_offset = key_offset + struct.unpack_from(fmt, mm, offset + 10)[0]
+    if data_offset + 8 > end_offset:
+        return None, 0
+    if not strict:
+        return 'entry', 9 + frame_length
+
+    if mm[end_offset - 8] != pickle.BININT[0] or mm[end_offset - 3] not in (pickle.POP[0], pickle.POP_MARK[0]) or \
+            mm[end_offset - 2] not in (pickle.NEWTRUE[0], pickle.POP[0]) or mm[end_offset - 1] != pickle.POP[0]:
+        return None, 0
+    if end_offset < size and mm[end_offset] != pickle.FRAME[0]:
+        return None, 0
+    try:
+        mm[key_offset:data_offset].decode('utf8', 'surrogatepass')
+    except UnicodeDecodeError:
+        return None, 0
+
+    if mm[end_offset - 3] == pickle.POP_MARK[0]:
+        checksum_offset = end_offset - 8 - _kvdata._checksum_length
+        if checksum_offset < data_offset or mm[checksum_offset] != pickle.MARK[0] or \
+                mm[checksum_offset + 1] != pickle.BININT[0]:
+            return None, 0
+        if resync:
+            import zlib
+            if zlib.crc32(mm[data_offset:checksum_offset]) != struct.unpack_from('<I', mm, checksum_offset + 2)[0]:
+                return None, 0
+
+    return 'entry', 9 + frame_length
+
+
+def _fsck_write_filler(file, offset, length):
+    """Write a deleted entry of ``length`` bytes at ``offset``, keeping the data in it, see :meth:`mmapdict.fsck`."""
+    data_length = length - _fsck_filler_min_length
+    if data_length < 256:
+        data_header = pickle.SHORT_BINBYTES + struct.pack('<B', data_length)
+    else:
+        data_length -= 7
+        data_header = pickle.BINBYTES8 + struct.pack('<Q', data_length)
+    file.seek(offset, io.SEEK_SET)
+    file.write(pickle.FRAME + struct.pack('<Q', length - 9) + pickle.SHORT_BINUNICODE + b'\x00' + data_header)
+    file.seek(offset + length - 8, io.SEEK_SET)
+    file.write(pickle.BININT + struct.pack('<i', 0) + pickle.POP + pickle.POP + pickle.POP)
+
+
+class mmapgroup:
+    """View on the keys of a :class:`mmapdict` starting with a prefix (i.e. a group), see :meth:`mmapdict.group`.
+
+    The keys of the group are relative to the prefix: ``d.group('run42')['image']`` is ``d['run42/image']``.
+    The keys are listed using a sorted index of the keys of the :class:`mmapdict`, without scanning all of them."""
+
+    def __init__(self, mmapdict, prefix):
+        """
+        :param mmapdict: :class:`mmapdict` object containing the data
+        :param prefix: prefix of the keys of the group
+        """
+        self._mmapdict = mmapdict
+        self._prefix = prefix
+
+    @property
+    def prefix(self):
+        """The prefix of the keys of the group (ending with ``/``)"""
+        return self._prefix
+
+    def __contains__(self, k):
+        """:returns: ``True`` if key ``k`` exists in the group, ``False`` otherwise."""
+        return self._prefix + k in self._mmapdict
+
+    def keys(self):
+        """:returns: the list of the keys of the group (including the keys of the nested groups), in sorted order"""
+        return [k[len(self._prefix):] for k in self._mmapdict._keys_with_prefix(self._prefix)]
+
+    def __getitem__(self, k):
+        """Get value for key ``k`` of the group, see :meth:`mmapdict.__getitem__`"""
+        return self._mmapdict[self._prefix + k]
+
+    def __setitem__(self, k, v):
+        """Create or change key ``k`` of the group, see :meth:`mmapdict.__setitem__`"""
+        self._mmapdict[self._prefix + k] = v
+
+    def __delitem__(self, k):
+        """Remove key ``k`` of the group, see :meth:`mmapdict.__delitem__`"""
+        del self._mmapdict[self._prefix + k]
+
+    def group(self, name):
+        """:returns: a :class:`mmapgroup` on the nested group ``name``"""
+        return self._mmapdict.group(self._prefix + name)
+
+    def clear(self):
+        """Remove all the keys of the group (including the nested groups)"""
+        self._mmapdict._delete_keys(self._mmapdict._keys_with_prefix(self._prefix))
+
+
+def _release_lease(mmapdict_ref):
+    """Release the lease held for a value by :meth:`mmapdict._lease`, once the value is freed"""
+    d = mmapdict_ref()
+    if d is None or d._file.closed:
+        return  # The leases are released when the file is closed
+    d._leases -= 1
+    if d._leases == 0:
+        _lease_file(d._file, 'unlock')
+
+
+_map_worker_state = None
+
+
+def _map_worker_init(state):
+    """Initializer of the worker processes of :meth:`mmapdict.map`"""
+    global _map_worker_state
+    _map_worker_state = pickle.loads(state)
+
+
+def _map_worker(keys):
+    """Compute the results of one partition of :meth:`mmapdict.map`"""
+    d, func, out = _map_worker_state
+    results = [(k, func(d[k])) for k in keys]
+    if out is None:
+        return results
+
+    out.update(results)
+    return []
+
+
+_verify_worker_file = None
+
+
+def _verify_worker_init(filename):
+    """Initializer of the worker processes of :meth:`mmapdict.verify`"""
+    global _verify_worker_file
+    _verify_worker_file = open(filename, 'rb')
+
+
+def _verify_worker(task):
+    """Compute the checksum of one chunk of :meth:`mmapdict.verify`"""
+    offset, length = task
+    return _crc32_file(_verify_worker_file, offset, length)
 
 
 if __name__ == '__main__':
@@ -4,9 +4,11 @@ __all__ = ['GenericPickler']
 
 try:
     import numpy
-    from .numpy import MaskedArrayPickler, ArrayPickler
+    from .numpy import MaskedArrayPickler, PackedMaskedArrayPickler, ArrayPickler, ContainerPickler
     __all__.append('ArrayPickler')
     __all__.append('MaskedArrayPickler')
+    __all__.append('PackedMaskedArrayPickler')
+    __all__.append('ContainerPickler')
 except ImportError:
     # No numpy, just ignore what would not be loadable
     pass
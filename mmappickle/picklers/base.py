@@ -1,3 +1,4 @@
+import hashlib
 import pickle
 import struct
 import pickletools
@@ -45,6 +46,33 @@ class BasePickler:
         Returns a tuple (number of bytes, last memo index)"""
         raise NotImplementedError("Should be subclassed")
 
+    def size(self, obj, memo_start_idx=0):
+        """
+        Return the tuple (number of bytes, last memo index) which :meth:`write` would return, without writing the object,
+        or None if it can't be known without pickling the object.
+
+        With ``mmapdict(..., locking='range')``, the space of the objects of known size is reserved in the file, then they
+        are written while the file is not locked (see :meth:`mmapdict.__setitem__`)."""
+        return None
+
+    @save_file_position
+    def info(self, offset, length):
+        """
+        Return a dict of the properties of the object starting at offset, without reading it (see :meth:`mmapdict.info`):
+        ``shape`` and ``dtype`` for arrays, nothing otherwise.
+
+        File position is kept.
+        """
+        return {}
+
+    def digest(self, obj):
+        """
+        Return a digest (32 bytes) of the pickled object, used to find identical values (see ``mmapdict(..., dedup=True)``),
+        or None if the values written by this pickler cannot be deduplicated.
+
+        Objects with the same digest should be written identically by this pickler."""
+        return None
+
     def _pickle_load_fix(self, p):
         """Load a pickle object from p, adding the header and the terminator. Returns the object."""
         p = pickle.PROTO + struct.pack('<B', 4) + p + pickle.STOP
@@ -126,6 +154,11 @@ class GenericPickler(BasePickler):
     def is_picklable(self, obj):
         return True  # catch all
 
+    def digest(self, obj):
+        if type(obj) != bytes:
+            return None
+        return hashlib.sha256(b'GenericPickler\0' + obj).digest()
+
     @save_file_position
     def read(self, offset, length):
         self._file.seek(offset, io.SEEK_SET)
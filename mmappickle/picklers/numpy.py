@@ -1,3 +1,4 @@
+import hashlib
 import numpy
 import io
 import pickle
@@ -9,6 +10,9 @@ from ..stubs.numpy import EmptyNDArray
 
 
 class ArrayPickler(BasePickler):
+    # Size of the blocks used to write non-contiguous arrays, in bytes
+    _write_block_size = 1048576
+
     def __init__(self, parent_object):
         super().__init__(parent_object)
         self._header = (
@@ -50,7 +54,8 @@ class ArrayPickler(BasePickler):
 
         # Write to file
         startpos = self._file.tell()
-        obj.tofile(self._file)
+        order = self._order(obj)
+        self._write_data(obj, order)
         endpos = self._file.tell()
 
         retlength += (endpos - startpos)
@@ -61,17 +66,135 @@ class ArrayPickler(BasePickler):
 
         # Continue wrinting
         self._file.seek(endpos, io.SEEK_SET)
-        retlength += self._file.write(self._pickle_dump_fix(str(obj.dtype))[0])
-        retlength += self._file.write(pickle.TUPLE2+pickle.REDUCE)
-        retlength += self._file.write(self._pickle_dump_fix(obj.shape)[0])
-        retlength += self._file.write(pickle.TUPLE2+pickle.REDUCE)
+        retlength += self._file.write(self._suffix(obj.dtype, obj.shape, order, getattr(obj, 'capacity', None) is not None))
 
         self._file.seek(startpos, io.SEEK_SET)
 
         return retlength, 0
 
+    def size(self, obj, memo_start_idx=0):
+        if len(str(obj.dtype)) >= 256:
+            raise ValueError("dtype length should be less than 256")
+        growable = getattr(obj, 'capacity', None) is not None
+        count = obj.capacity if growable else 1
+        for x in obj.shape[1:] if growable else obj.shape:
+            count *= x
+        suffix = self._suffix(obj.dtype, obj.shape, self._order(obj), growable)
+        return len(self._header) + 1 + 8 + count * obj.dtype.itemsize + len(suffix), 0
+
+    def _order(self, obj):
+        """:returns: the order ('C' or 'F') in which the elements of obj are stored in the file"""
+        if not isinstance(obj, numpy.ndarray) or obj.flags.c_contiguous:
+            return 'C'
+        if obj.flags.f_contiguous:
+            return 'F'
+        # Not contiguous, use the order which is the closest to the memory layout
+        if obj.ndim > 1 and abs(obj.strides[0]) < abs(obj.strides[-1]):
+            return 'F'
+        return 'C'
+
+    def _write_data(self, obj, order):
+        """Write the elements of obj in the given order, at the current position"""
+        if isinstance(obj, numpy.ndarray) and not self._has_fileno():
+            # The writes done by tofile can't be checked (e.g. when writing a reserved entry, see mmapdict._write_reserved)
+            self._write_blocks(obj, order)
+        elif not isinstance(obj, numpy.ndarray) or obj.flags.c_contiguous:
+            obj.tofile(self._file)
+        elif obj.flags.f_contiguous:
+            # The transpose of a Fortran-contiguous array is C-contiguous, and has the same memory layout
+            obj.T.tofile(self._file)
+        else:
+            self._write_blocks(obj, order)
+
+    def _has_fileno(self):
+        """:returns: True if the data can be written directly using the file descriptor"""
+        try:
+            self._file.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return False
+        return True
+
+    def _write_blocks(self, obj, order):
+        """Write a non-contiguous array in the given order, in blocks of at most :attr:`_write_block_size` bytes."""
+        for block in self._blocks(obj, order):
+            self._file.write(block)
+
+    def _blocks(self, obj, order):
+        """Iterate over the elements of obj in the given order, as contiguous blocks of at most :attr:`_write_block_size` bytes."""
+        iterator = numpy.nditer(obj, flags=['external_loop', 'buffered', 'zerosize_ok'], op_flags=['readonly'],
+                                order=order, buffersize=max(1, self._write_block_size // obj.itemsize))
+        for block in iterator:
+            # Blocks may still be strided, make a (small) contiguous copy
+            yield numpy.ascontiguousarray(block)
+
+    def digest(self, obj):
+        if type(obj) not in (numpy.ndarray, numpy.memmap) or obj.dtype.hasobject:
+            return None
+        order = self._order(obj)
+        digest = hashlib.sha256('ArrayPickler\0{}\0{}\0{}\0'.format(obj.dtype.str, obj.shape, order).encode('utf8'))
+        if obj.flags.c_contiguous:
+            digest.update(obj.reshape(-1).view(numpy.uint8))
+        elif obj.flags.f_contiguous:
+            digest.update(obj.T.reshape(-1).view(numpy.uint8))
+        else:
+            for block in self._blocks(obj, order):
+                digest.update(block.view(numpy.uint8))
+        return digest.digest()
+
+    def _suffix(self, dtype, shape, order, growable):
+        """:returns: the pickled data following the array data.
+
+        :param growable: if True, the number of elements and of rows are stored with a fixed width, and
+          the data may contain unused capacity: ``reshape(fromstring(data, dtype, count), shape)``"""
+        ret = self._pickle_dump_fix(str(dtype))[0]
+        if not growable:
+            ret += pickle.TUPLE2 + pickle.REDUCE + self._pickle_dump_fix(tuple(shape))[0]
+        else:
+            if len(shape) == 0 or order != 'C':
+                raise ValueError("Only C-ordered arrays with at least one dimension can be growable")
+            count = 1
+            for x in shape:
+                count *= x
+            ret += pickle.LONG1 + struct.pack('<Bq', 8, count) + pickle.TUPLE3 + pickle.REDUCE
+            elements = [pickle.LONG1 + struct.pack('<Bq', 8, shape[0])] + [self._pickle_dump_fix(x)[0] for x in shape[1:]]
+            if len(elements) <= 3:
+                ret += b''.join(elements) + (pickle.TUPLE1, pickle.TUPLE2, pickle.TUPLE3)[len(elements) - 1]
+            else:
+                ret += pickle.MARK + b''.join(elements) + pickle.TUPLE
+
+        if order == 'F':
+            ret += self._pickle_dump_fix(order)[0] + pickle.TUPLE3 + pickle.REDUCE
+        else:
+            ret += pickle.TUPLE2 + pickle.REDUCE
+        return ret
+
+    def _read_int(self, opcode):
+        """Read the argument of a pickled int, at the current position.
+
+        :param opcode: the opcode, which was just read
+        :returns: the int, or None if the opcode isn't an int (nothing is then read)"""
+        if opcode == pickle.BININT1:
+            return struct.unpack('<B', self._file.read(1))[0]
+        elif opcode == pickle.BININT2:
+            return struct.unpack('<H', self._file.read(2))[0]
+        elif opcode == pickle.BININT:
+            return struct.unpack('<i', self._file.read(4))[0]
+        elif opcode == pickle.LONG1:
+            return int.from_bytes(self._file.read(self._file.read(1)[0]), 'little', signed=True)
+        return None
+
     @save_file_position
-    def read(self, offset, length):
+    def _parse(self, offset):
+        """Parse the pickled array at offset.
+
+        :returns: a dict with the following keys:
+
+          - ``dtype``, ``shape``, ``order``: the properties of the array
+          - ``data_offset``, ``capacity``: the offset and the length of the data (which may be larger than the array)
+          - ``count_offset``, ``rows_offset``: if the array is growable, the offsets of the (8 bytes) number of elements
+            and number of rows, otherwise ``None``
+          - ``length``: the length of the pickled array
+        """
         self._file.seek(offset)
 
         assert self._file.read(len(self._header)) == self._header
@@ -95,39 +218,132 @@ class ArrayPickler(BasePickler):
         dtypelength = struct.unpack('<B', self._file.read(1))[0]
         dtype = self._file.read(dtypelength).decode('utf8', 'surrogatepass')
 
-        # Skip TUPLE2 and REDUCE, to get to the shape tuple
-        self._file.seek(2, io.SEEK_CUR)
+        # Then either TUPLE2 and REDUCE, or the number of elements, TUPLE3 and REDUCE (growable arrays)
+        count_offset = None
+        rows_offset = None
+        if self._file.read(1) == pickle.LONG1:
+            count_offset = self._file.tell() + 1
+            self._file.seek(1 + 8 + 2, io.SEEK_CUR)
+        else:
+            self._file.seek(1, io.SEEK_CUR)
 
+        # Then the shape tuple
         shapelist = []
         while True:
+            shapeelementoffset = self._file.tell()
             shapeelementtype = self._file.read(1)
-            if shapeelementtype == pickle.BININT1:
-                shapeelement = struct.unpack('<B', self._file.read(1))[0]
-            elif shapeelementtype == pickle.BININT2:
-                shapeelement = struct.unpack('<H', self._file.read(2))[0]
-            elif shapeelementtype == pickle.BININT:
-                shapeelement = struct.unpack('<i', self._file.read(4))[0]
-            elif shapeelementtype in (pickle.TUPLE1, pickle.TUPLE2, pickle.TUPLE3, pickle.TUPLE):
+            if shapeelementtype == pickle.MARK:
+                continue  # ignore mark
+            shapeelement = self._read_int(shapeelementtype)
+            if shapeelement is None:
+                assert shapeelementtype in (pickle.TUPLE1, pickle.TUPLE2, pickle.TUPLE3, pickle.TUPLE, pickle.EMPTY_TUPLE), \
+                    "Invalid element type: 0x{:02x}".format(ord(shapeelementtype))
                 # End of tuple
                 break
-            elif shapeelementtype == pickle.MARK:
-                continue  # ignore mark
-            else:
-                assert False, "Invalid element type: 0x{:02x}".format(ord(shapeelementtype))
+            if count_offset is not None and len(shapelist) == 0:
+                rows_offset = shapeelementoffset + 2
             shapelist.append(shapeelement)
 
-        # Skip TUPLE2 and REDUCE
-        self._file.seek(2, io.SEEK_CUR)
+        # Memory order, if it's not C (the default)
+        order = 'C'
+        opcode = self._file.read(1)
+        if opcode == pickle.SHORT_BINUNICODE:
+            orderlength = struct.unpack('<B', self._file.read(1))[0]
+            order = self._file.read(orderlength).decode('utf8')
+            opcode = self._file.read(1)
+        assert opcode in (pickle.TUPLE2, pickle.TUPLE3)
+
+        # Skip REDUCE
+        self._file.seek(1, io.SEEK_CUR)
+
+        return {
+            'dtype': numpy.dtype(dtype),
+            'shape': tuple(shapelist),
+            'order': order,
+            'data_offset': datastart,
+            'capacity': datalength,
+            'count_offset': count_offset,
+            'rows_offset': rows_offset,
+            'length': self._file.tell() - offset,
+        }
+
+    def info(self, offset, length):
+        info = self._parse(offset)
+        return {'shape': info['shape'], 'dtype': info['dtype']}
 
-        length = self._file.tell() - offset
+    @save_file_position
+    def read(self, offset, length):
+        info = self._parse(offset)
+        dtype, shape, order, datastart = info['dtype'], info['shape'], info['order'], info['data_offset']
 
-        if self._file.writable():
-            return numpy.memmap(self._file, dtype=dtype, mode='r+', shape=tuple(shapelist), offset=datastart), length
-        else:
-            return numpy.memmap(self._file, dtype=dtype, mode='r', shape=tuple(shapelist), offset=datastart), length
+        if self._parent_object()._immutable:
+            # Return a view of the memory map of the whole file, which is shared by all the arrays
+            count = 1
+            for x in shape:
+                count *= x
+            return numpy.frombuffer(self._file.mmap, dtype=dtype, count=count, offset=datastart).reshape(shape, order=order), info['length']
+
+        mode = 'r+' if self._file.writable() else 'r'
+        value = numpy.memmap(self._file, dtype=dtype, mode=mode, shape=shape, offset=datastart, order=order)
+        self._parent_object()._lease(value)
+        return value, info['length']
+
+    @save_file_position
+    def append_rows(self, offset, block, max_length=None):
+        """Append rows (along the first axis) to the array at offset.
+
+        The rows are written in the unused capacity of the array if it is growable, otherwise after the data of the
+        array, if it can be extended (it is then the last value of the file).
+
+        :param offset: offset of the pickled array
+        :param block: array of rows to append (its shape, except for the first axis, should match the shape of the array)
+        :param max_length: maximum length of the pickled array, or ``None`` if it can be extended
+        :returns: the new length of the pickled array, or ``None`` if there isn't enough room (nothing is written)"""
+        info = self._parse(offset)
+        shape = info['shape']
+        if len(shape) == 0 or info['order'] != 'C':
+            raise ValueError("Only C-ordered arrays with at least one dimension can be extended")
+        block = numpy.asarray(block, dtype=info['dtype'])
+        if block.shape[1:] != shape[1:]:
+            raise ValueError("Cannot append rows of shape {} to an array of shape {}".format(block.shape[1:], shape))
+
+        row_elements = 1
+        for x in shape[1:]:
+            row_elements *= x
+        rows = shape[0] + block.shape[0]
+        used_length = shape[0] * row_elements * info['dtype'].itemsize
+        new_length = rows * row_elements * info['dtype'].itemsize
+
+        if info['rows_offset'] is not None and new_length <= info['capacity']:
+            # Enough capacity: write the rows, then update the number of elements and rows in place
+            self._file.seek(info['data_offset'] + used_length, io.SEEK_SET)
+            self._write_data(block, 'C')
+            self._file.seek(info['count_offset'], io.SEEK_SET)
+            self._file.write(struct.pack('<q', rows * row_elements))
+            self._file.seek(info['rows_offset'], io.SEEK_SET)
+            self._file.write(struct.pack('<q', rows))
+            return info['length']
+
+        if max_length is not None:
+            return None
+
+        # Write the rows after the data, then rewrite the data length and everything after the data
+        self._file.seek(info['data_offset'] + used_length, io.SEEK_SET)
+        self._write_data(block, 'C')
+        self._file.seek(info['data_offset'] - 8, io.SEEK_SET)
+        self._file.write(struct.pack('<Q', new_length))
+        self._file.seek(info['data_offset'] + new_length, io.SEEK_SET)
+        self._file.write(self._suffix(info['dtype'], (rows, ) + shape[1:], 'C', info['rows_offset'] is not None))
+        return self._file.tell() - offset
 
 
 class MaskedArrayPickler(BasePickler):
+    """Pickler of :class:`numpy.ma.MaskedArray`, storing the data and the mask as :class:`ArrayPickler` arrays.
+
+    If :attr:`pack_mask` is True (see :class:`PackedMaskedArrayPickler`), the mask is stored as packed bits,
+    and not stored at all if no element is masked. All the layouts can be read by this pickler."""
+    pack_mask = False
+
     def __init__(self, parent_object):
         super().__init__(parent_object)
         self._array_pickler = ArrayPickler(parent_object)
@@ -136,6 +352,16 @@ class MaskedArrayPickler(BasePickler):
             self._pickle_dump_fix('MaskedArray')[0] +
             pickle.STACK_GLOBAL
         )
+        # reshape(unpackbits(<packed mask>, None, <count>), <shape>)
+        self._packed_mask_header = (
+            self._pickle_dump_fix('numpy.core.fromnumeric')[0] +
+            self._pickle_dump_fix('reshape')[0] +
+            pickle.STACK_GLOBAL +
+
+            self._pickle_dump_fix('numpy')[0] +
+            self._pickle_dump_fix('unpackbits')[0] +
+            pickle.STACK_GLOBAL
+        )
 
     @save_file_position
     def is_valid(self, offset, length):
@@ -156,21 +382,78 @@ class MaskedArrayPickler(BasePickler):
         self._file.seek(offset, io.SEEK_SET)
         retlength = 0
         retlength += self._file.write(self._header)
-        retlength += self._array_pickler.write(numpy.ma.getdata(obj), offset + retlength)[0]
-        retlength += self._array_pickler.write(numpy.ma.getmaskarray(obj), offset + retlength)[0]
+        data = numpy.ma.getdata(obj)
+        retlength += self._array_pickler.write(data, offset + retlength)[0]
+
+        if not self.pack_mask:
+            retlength += self._array_pickler.write(numpy.ma.getmaskarray(obj), offset + retlength)[0]
+            self._file.seek(offset + retlength)
+            retlength += self._file.write(pickle.TUPLE2+pickle.REDUCE)
+            return retlength, 0
+
+        mask = numpy.ma.getmask(obj)
+        if mask is numpy.ma.nomask or not mask.any():
+            # MaskedArray(data)
+            self._file.seek(offset + retlength)
+            retlength += self._file.write(pickle.TUPLE1+pickle.REDUCE)
+            return retlength, 0
+
+        self._file.seek(offset + retlength)
+        retlength += self._file.write(self._packed_mask_header)
+        retlength += self._array_pickler.write(numpy.packbits(mask, axis=None), offset + retlength)[0]
         self._file.seek(offset + retlength)
+        retlength += self._file.write(pickle.NONE + self._pickle_dump_fix(int(data.size))[0] + pickle.TUPLE3 + pickle.REDUCE)
+        retlength += self._file.write(self._pickle_dump_fix(data.shape)[0] + pickle.TUPLE2 + pickle.REDUCE)
         retlength += self._file.write(pickle.TUPLE2+pickle.REDUCE)
 
         return retlength, 0
 
+    def size(self, obj, memo_start_idx=0):
+        data = numpy.ma.getdata(obj)
+        retlength = len(self._header) + self._array_pickler.size(data)[0]
+
+        if not self.pack_mask:
+            return retlength + self._array_pickler.size(numpy.ma.getmaskarray(obj))[0] + 2, 0
+
+        mask = numpy.ma.getmask(obj)
+        if mask is numpy.ma.nomask or not mask.any():
+            return retlength + 2, 0
+
+        # The packed mask has one byte per 8 elements
+        packed_mask = EmptyNDArray(((data.size + 7) // 8, ), numpy.uint8)
+        retlength += len(self._packed_mask_header) + self._array_pickler.size(packed_mask)[0]
+        retlength += 1 + len(self._pickle_dump_fix(int(data.size))[0]) + 2 + len(self._pickle_dump_fix(data.shape)[0]) + 2 + 2
+        return retlength, 0
+
+    def info(self, offset, length):
+        # The data array is first, the mask has the same shape
+        return self._array_pickler.info(offset + len(self._header), length - len(self._header))
+
     @save_file_position
     def read(self, offset, length):
         self._file.seek(offset)
 
         assert self._file.read(len(self._header)) == self._header
         data, data_pickle_length = self._array_pickler.read(offset + len(self._header), length - offset + len(self._header))
-        mask, mask_pickle_length = self._array_pickler.read(offset + len(self._header) + data_pickle_length,
-                                                            length - offset + len(self._header) + data_pickle_length)
+        mask_offset = offset + len(self._header) + data_pickle_length
+
+        self._file.seek(mask_offset)
+        if self._file.read(1) == pickle.TUPLE1:
+            # Nothing is masked
+            return numpy.ma.core.MaskedArray(data), len(self._header) + data_pickle_length + 2
+
+        if self._array_pickler.is_valid(mask_offset, None):
+            mask, mask_pickle_length = self._array_pickler.read(mask_offset, length - mask_offset)
+        else:
+            self._file.seek(mask_offset)
+            assert self._file.read(len(self._packed_mask_header)) == self._packed_mask_header
+            packed_mask, packed_mask_pickle_length = self._array_pickler.read(mask_offset + len(self._packed_mask_header),
+                                                                              length - mask_offset - len(self._packed_mask_header))
+            # The unpacked mask is in memory, but only the packed bits are read from the file
+            mask = numpy.unpackbits(packed_mask, None, data.size).reshape(data.shape).view(numpy.bool_)
+            # We know the count and the shape, so we can skip them
+            mask_pickle_length = len(self._packed_mask_header) + packed_mask_pickle_length + 1 + \
+                len(self._pickle_dump_fix(int(data.size))[0]) + 2 + len(self._pickle_dump_fix(data.shape)[0]) + 2
 
         # This works, but is inefficient, since it casts the mask into a ndarray
         # ret = numpy.ma.core.MaskedArray(data, mask)
@@ -180,3 +463,202 @@ class MaskedArrayPickler(BasePickler):
         ret._mask = mask
 
         return ret, len(self._header) + data_pickle_length + mask_pickle_length + 2
+
+
+class PackedMaskedArrayPickler(MaskedArrayPickler):
+    """Pickler of :class:`numpy.ma.MaskedArray`, storing the mask as packed bits (one bit per element, instead of
+    one byte), or not storing it at all if no element is masked.
+
+    The mask is unpacked in memory when the value is read, the data is still memory-mapped.
+    Since it has a lower priority than :class:`MaskedArrayPickler`, it should be explicitly enabled:
+    ``mmapdict(..., picklers=[PackedMaskedArrayPickler, ArrayPickler, GenericPickler])``."""
+    pack_mask = True
+
+    @property
+    def priority(self):
+        return 90
+
+
+class ContainerPickler(BasePickler):
+    """Pickler of :class:`dict`, :class:`list` and :class:`tuple` containers holding arrays (possibly nested).
+
+    The containers are written as pickle opcodes, and the arrays they contain are written using :class:`ArrayPickler`
+    (or :class:`MaskedArrayPickler`), so they are memory-mapped when the value is read. The other values (and the
+    keys of the dictionnaries) are pickled separately, so objects shared between them are not shared after reading.
+
+    The value is followed by an index, which allows to read it without having to parse the pickled values: ::
+
+      <marker> POP
+      <<< containers and values >>>
+      BINBYTES8 <length> <index: one uint64 per element, 0 for containers and arrays, the pickle length otherwise> POP
+      BININT <number of elements> POP
+
+    Containers with no array among their first :attr:`scan_limit` elements, or containing themselves, are left to
+    the other picklers.
+    """
+    #: Number of elements looked at to find an array in a container
+    scan_limit = 1000
+
+    def __init__(self, parent_object):
+        super().__init__(parent_object)
+        self._array_picklers = [MaskedArrayPickler(parent_object), ArrayPickler(parent_object)]
+        self._header = self._pickle_dump_fix('mmappickle.container')[0] + pickle.POP
+
+    @save_file_position
+    def is_valid(self, offset, length):
+        self._file.seek(offset, io.SEEK_SET)
+        data = self._file.read(len(self._header))
+
+        return data == self._header
+
+    def _contains_array(self, obj, budget, path):
+        """:returns: True if an array is found among the first ``budget[0]`` elements of ``obj`` (depth first), False
+        otherwise, or None if ``obj`` contains itself.
+
+        :param budget: a list holding the number of elements which can still be looked at
+        :param path: ids of the containers holding ``obj``"""
+        budget[0] -= 1
+        if type(obj) not in (dict, list, tuple):
+            return any(pickler.is_picklable(obj) for pickler in self._array_picklers)
+        if id(obj) in path:
+            return None
+
+        path.add(id(obj))
+        ret = False
+        for x in (obj.values() if type(obj) == dict else obj):
+            ret = self._contains_array(x, budget, path)
+            if ret is not False:
+                break
+            if budget[0] <= 0:
+                break
+        path.remove(id(obj))
+        return ret
+
+    def _contains_itself(self, obj, path):
+        """:returns: True if a container of ``obj`` contains itself, which can't be written
+
+        :param path: ids of the containers holding ``obj``"""
+        if type(obj) not in (dict, list, tuple):
+            return False
+        if id(obj) in path:
+            return True
+
+        path.add(id(obj))
+        ret = any(self._contains_itself(x, path) for x in (obj.values() if type(obj) == dict else obj))
+        path.remove(id(obj))
+        return ret
+
+    def is_picklable(self, obj):
+        if type(obj) not in (dict, list, tuple):
+            return False
+        return self._contains_array(obj, [self.scan_limit], set()) is True and not self._contains_itself(obj, set())
+
+    @property
+    def priority(self):
+        return 50
+
+    @save_file_position
+    def write(self, obj, offset, memo_start_idx=0):
+        self._file.seek(offset, io.SEEK_SET)
+        self._file.write(self._header)
+
+        lengths = []
+        memo_idx = self._write_element(obj, lengths, memo_start_idx)
+
+        index = struct.pack('<{}Q'.format(len(lengths)), *lengths)
+        self._file.write(pickle.BINBYTES8 + struct.pack('<Q', len(index)) + index + pickle.POP)
+        self._file.write(pickle.BININT + struct.pack('<i', len(lengths)) + pickle.POP)
+
+        return self._file.tell() - offset, memo_idx
+
+    def _write_element(self, obj, lengths, memo_idx):
+        """Write obj at the current position, and add its elements to the index ``lengths``.
+
+        :returns: the new memo index"""
+        if type(obj) == dict:
+            lengths.append(0)
+            self._file.write(pickle.EMPTY_DICT + pickle.MARK)
+            for k, v in obj.items():
+                memo_idx = self._write_pickle(k, lengths, memo_idx)
+                memo_idx = self._write_element(v, lengths, memo_idx)
+            self._file.write(pickle.SETITEMS)
+            return memo_idx
+        elif type(obj) in (list, tuple):
+            lengths.append(0)
+            self._file.write(pickle.EMPTY_LIST + pickle.MARK if type(obj) == list else pickle.MARK)
+            for v in obj:
+                memo_idx = self._write_element(v, lengths, memo_idx)
+            self._file.write(pickle.APPENDS if type(obj) == list else pickle.TUPLE)
+            return memo_idx
+
+        for pickler in self._array_picklers:
+            if pickler.is_picklable(obj):
+                lengths.append(0)
+                position = self._file.tell()
+                length = pickler.write(obj, position)[0]
+                self._file.seek(position + length, io.SEEK_SET)
+                return memo_idx
+
+        return self._write_pickle(obj, lengths, memo_idx)
+
+    def _write_pickle(self, obj, lengths, memo_idx):
+        data, memo_idx = self._pickle_dump_fix(obj, memo_idx)
+        lengths.append(len(data))
+        self._file.write(data)
+        return memo_idx
+
+    @save_file_position
+    def read(self, offset, length):
+        self._file.seek(offset + length - 5, io.SEEK_SET)
+        count = struct.unpack('<i', self._file.read(4))[0]
+        self._file.seek(offset + length - 6 - 1 - 8 * count, io.SEEK_SET)
+        lengths = struct.unpack('<{}Q'.format(count), self._file.read(8 * count))
+
+        self._file.seek(offset, io.SEEK_SET)
+        assert self._file.read(len(self._header)) == self._header
+        return self._read_element(iter(lengths), offset + length), length
+
+    def _read_element(self, lengths, end_offset):
+        """Read the element at the current position, and move after it.
+
+        :param lengths: iterator on the index
+        :param end_offset: offset of the end of the value"""
+        length = next(lengths)
+        if length > 0:
+            return self._pickle_load_fix(self._file.read(length))
+
+        position = self._file.tell()
+        opcode = self._file.read(1)
+        if opcode == pickle.EMPTY_DICT:
+            assert self._file.read(1) == pickle.MARK
+            ret = {}
+            while not self._read_if(pickle.SETITEMS):
+                key = self._read_element(lengths, end_offset)
+                ret[key] = self._read_element(lengths, end_offset)
+            return ret
+        elif opcode == pickle.EMPTY_LIST:
+            assert self._file.read(1) == pickle.MARK
+            ret = []
+            while not self._read_if(pickle.APPENDS):
+                ret.append(self._read_element(lengths, end_offset))
+            return ret
+        elif opcode == pickle.MARK:
+            ret = []
+            while not self._read_if(pickle.TUPLE):
+                ret.append(self._read_element(lengths, end_offset))
+            return tuple(ret)
+
+        for pickler in self._array_picklers:
+            if pickler.is_valid(position, end_offset - position):
+                ret, length = pickler.read(position, end_offset - position)
+                self._file.seek(position + length, io.SEEK_SET)
+                return ret
+
+        raise ValueError("Invalid element at offset {}".format(position))
+
+    def _read_if(self, opcode):
+        """:returns: True if the next opcode is ``opcode`` (it is then skipped), False otherwise"""
+        if self._file.read(1) == opcode:
+            return True
+        self._file.seek(-1, io.SEEK_CUR)
+        return False
@@ -0,0 +1,166 @@
+import json
+import os
+import zlib
+
+from .dict import mmapdict
+
+
+class shardedmmapdict:
+    """Dictionnary whose keys are spread over several :class:`mmappickle.mmapdict` files (the shards), in a directory.
+
+    The shard of a key is chosen using the CRC32 of the key, so that all the processes agree on it. Each shard has its
+    own lock: processes changing keys in different shards don't wait for each other, and :meth:`vacuum` only blocks
+    one shard at a time.
+
+    Like :class:`mmappickle.mmapdict`, it can be passed to the processes of the ``multiprocessing`` module."""
+    _file_name = 'shard-{:04d}.mmdpickle'
+    _manifest_name = 'manifest.json'
+
+    def __init__(self, directory, shards=None, readonly=None, **kw):
+        """
+        Create or load a sharded dictionnary.
+
+        The number of shards is written in a manifest file of the directory, once all the shards are created.
+
+        :param directory: directory of the files of the shards. It is created if it doesn't exist.
+        :param shards: number of shards. If the directory already contains shards, this should be None or their
+          number. Otherwise, the default is 16. The number of shards can't be changed afterwards.
+        :param readonly: if True, the shards are opened in readonly mode
+        :param kw: other parameters of :class:`mmappickle.mmapdict`, used for each shard
+        """
+        if readonly and not os.path.isdir(directory):
+            raise FileNotFoundError("Cannot open a non-existent directory {!r} in readonly mode".format(directory))
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+
+        manifest_shards = self._read_manifest(directory)
+        if manifest_shards is not None:
+            if shards is not None and shards != manifest_shards:
+                raise ValueError("{!r} contains {} shards, not {}".format(directory, manifest_shards, shards))
+            shards = manifest_shards
+            missing = [i for i in range(shards)
+                       if not os.path.exists(os.path.join(directory, self._file_name.format(i)))]
+            if len(missing) > 0:
+                raise ValueError("Shards {} are missing in {!r}".format(', '.join(str(i) for i in missing), directory))
+        elif readonly:
+            raise FileNotFoundError("{!r} doesn't contain a manifest of the shards".format(directory))
+        elif shards is None:
+            if any(name.startswith('shard-') for name in os.listdir(directory)):
+                # Another process is creating the shards, or was interrupted: their number is unknown
+                raise ValueError("{!r} contains shards, but no manifest: the number of shards should be given".format(
+                    directory))
+            shards = 16
+        elif shards < 1:
+            raise ValueError("There should be at least one shard")
+
+        self._directory = directory
+        self._shards = [mmapdict(os.path.join(directory, self._file_name.format(i)), readonly=readonly, **kw)
+                        for i in range(shards)]
+
+        if manifest_shards is None:
+            self._write_manifest(directory, shards)
+
+    @classmethod
+    def _read_manifest(cls, directory):
+        """:returns: the number of shards written in the manifest of ``directory``, or None if there is no manifest"""
+        try:
+            with open(os.path.join(directory, cls._manifest_name), 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        return manifest['shards']
+
+    @classmethod
+    def _write_manifest(cls, directory, shards):
+        """Write the manifest of ``directory``. It is replaced atomically, so it is either complete or missing."""
+        path = os.path.join(directory, cls._manifest_name)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'shards': shards}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @property
+    def directory(self):
+        """The directory of the files of the shards"""
+        return self._directory
+
+    @property
+    def shards(self):
+        """The list of the shards, as :class:`mmappickle.mmapdict` objects"""
+        return list(self._shards)
+
+    def shard(self, k):
+        """:returns: the shard (a :class:`mmappickle.mmapdict`) containing key ``k``"""
+        return self._shards[zlib.crc32(k.encode('utf8')) % len(self._shards)]
+
+    def _split(self, keys):
+        """:returns: a dict, giving the list of the indices in ``keys`` of the keys of each shard"""
+        ret = {}
+        for i, k in enumerate(keys):
+            ret.setdefault(self.shard(k), []).append(i)
+        return ret
+
+    def __contains__(self, k):
+        """:returns: ``True`` if key ``k`` exists, ``False`` otherwise."""
+        return k in self.shard(k)
+
+    def keys(self):
+        """:returns: the list of the keys of all the shards"""
+        return [k for shard in self._shards for k in shard.keys()]
+
+    def __len__(self):
+        return sum(len(shard.keys()) for shard in self._shards)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, k):
+        """Get value for key ``k``, see :meth:`mmappickle.mmapdict.__getitem__`"""
+        return self.shard(k)[k]
+
+    def __setitem__(self, k, v):
+        """Create or change key ``k``, see :meth:`mmappickle.mmapdict.__setitem__`"""
+        self.shard(k)[k] = v
+
+    def __delitem__(self, k):
+        """Remove key ``k``, see :meth:`mmappickle.mmapdict.__delitem__`"""
+        del self.shard(k)[k]
+
+    def get_many(self, keys):
+        """Get the values of ``keys``. Each shard is locked only once, see :meth:`mmappickle.mmapdict.get_many`.
+
+        :returns: a list of the values, in the same order as ``keys``
+        """
+        keys = list(keys)
+        ret = [None] * len(keys)
+        for shard, indices in self._split(keys).items():
+            for i, value in zip(indices, shard.get_many([keys[i] for i in indices])):
+                ret[i] = value
+        return ret
+
+    def update(self, other=(), **kw):
+        """Set several keys at once, like :meth:`dict.update`. Each shard is locked only once, see
+        :meth:`mmappickle.mmapdict.update`.
+
+        :param other: a mapping, or an iterable of ``(key, value)`` pairs
+        :param kw: additional keys to set
+        """
+        if hasattr(other, 'keys'):
+            other = [(k, other[k]) for k in other.keys()]
+        else:
+            other = list(other)
+        other.extend(kw.items())
+        for shard, indices in self._split([k for k, v in other]).items():
+            shard.update([other[i] for i in indices])
+
+    def vacuum(self, chunk_size=1048576):
+        """Free the deleted keys of each shard, one shard after the other, see :meth:`mmappickle.mmapdict.vacuum`."""
+        for shard in self._shards:
+            shard.vacuum(chunk_size)
+
+    def sync(self):
+        """Write the changes of all the shards to the disk, see :meth:`mmappickle.mmapdict.sync`."""
+        for shard in self._shards:
+            shard.sync()
@@ -0,0 +1,63 @@
+import collections
+
+
+class _stats:
+    """Counters and timers of a :class:`mmappickle.mmapdict`, see :meth:`mmappickle.mmapdict.stats`.
+
+    Counters are simply incremented. Timers ``name`` are stored as two counters: ``name.count`` (the number of
+    measurements) and ``name.time`` (the total time, in seconds)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Set all the counters and timers to zero"""
+        self._counters = collections.defaultdict(int)
+
+    def count(self, name, value=1):
+        """Increment counter ``name`` by ``value``"""
+        self._counters[name] += value
+
+    def add_time(self, name, duration):
+        """Add a measurement of ``duration`` seconds to timer ``name``"""
+        self._counters[name + '.count'] += 1
+        self._counters[name + '.time'] += duration
+
+    def snapshot(self):
+        """:returns: a copy of the counters, as a dict"""
+        return dict(self._counters)
+
+
+class _counting_file:
+    """Proxy of a file object, counting the seeks, reads and writes in a :class:`_stats` object.
+
+    Data written or read directly using the file descriptor (for example by :meth:`numpy.ndarray.tofile` or by
+    memory maps) is not counted."""
+
+    def __init__(self, file, stats):
+        self._wrapped_file = file
+        self._stats = stats
+
+    @property
+    def wrapped_file(self):
+        """The underlying file object"""
+        return self._wrapped_file
+
+    def seek(self, *a):
+        self._stats.count('file.seeks')
+        return self._wrapped_file.seek(*a)
+
+    def read(self, *a):
+        data = self._wrapped_file.read(*a)
+        self._stats.count('file.reads')
+        self._stats.count('file.read_bytes', len(data))
+        return data
+
+    def write(self, data):
+        length = self._wrapped_file.write(data)
+        self._stats.count('file.writes')
+        self._stats.count('file.write_bytes', length)
+        return length
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped_file, name)
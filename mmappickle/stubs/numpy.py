@@ -10,11 +10,18 @@ class EmptyNDArray:
 
     :param shape: (tuple of ints) Shape of created array
     :param dtype: (:class:`numpy.dtype`) type of the element of the array
+    :param capacity: (int) if set, the number of rows (along the first axis) to reserve in the file, for rows which will be
+      added using :meth:`mmappickle.mmapdict.append_rows`. It should be at least ``shape[0]``.
     """
 
-    def __init__(self, shape, dtype=numpy.float):
+    def __init__(self, shape, dtype=numpy.float, capacity=None):
         self._shape = tuple(int(x) for x in shape)
         self._dtype = numpy.dtype(dtype)
+        if capacity is not None:
+            capacity = int(capacity)
+            if len(self._shape) == 0 or capacity < self._shape[0]:
+                raise ValueError("capacity should be at least the length of the first axis")
+        self._capacity = capacity
 
     @property
     def shape(self):
@@ -26,9 +33,17 @@ class EmptyNDArray:
 
         :param f: the file object in which to write the data. The stream position should be set at the correct place."""
         # We only seek to the end position, this is fast.
-        f.seek(self._dtype.itemsize * numpy.prod(self._shape), io.SEEK_CUR)
+        shape = self._shape
+        if self._capacity is not None:
+            shape = (self._capacity, ) + shape[1:]
+        f.seek(self._dtype.itemsize * numpy.prod(shape), io.SEEK_CUR)
 
     @property
     def dtype(self):
         """The data type of the ndarray"""
         return self._dtype
+
+    @property
+    def capacity(self):
+        """The number of rows reserved in the file, or ``None``"""
+        return self._capacity
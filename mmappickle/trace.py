@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    """Base class of the tracers, which receive the timing of the operations done by a :class:`mmappickle.mmapdict`.
+
+    A tracer is given to the dictionnary using ``mmapdict(..., tracer=...)``. For each traced operation,
+    :meth:`begin` is called when it starts, and :meth:`end` when it ends. Operations may be nested.
+
+    The following operations are traced (``args`` may contain ``key``, ``offset`` and ``bytes``):
+
+     - ``getitem``, ``setitem``, ``delitem``, ``append_rows``, ``vacuum``, ``verify``: the public operations of the dictionnary
+     - ``lock``: waiting for the file lock
+     - ``cache.rebuild``: scan of the file, to rebuild the cache of the entries
+     - ``cache.index``: rebuild of the index of the valid keys
+     - ``cache.sort``: rebuild of the sorted index of the keys
+     - ``cache.dedup``: rebuild of the index of the values which can be referred to
+     - ``checksum``: verification of the checksum of a value, when it is read
+     - ``fsync``: sync of the file to the disk
+     - ``populate``: mapping of the pages of a value, when it is read
+     - ``info``: read of the properties of a value, without reading it
+     - ``pickler.dispatch``: search of the pickler able to read a value (``args['pickler']`` is set at the end)
+     - ``pickler.<name>.probe``, ``pickler.<name>.read``, ``pickler.<name>.write``, ``pickler.<name>.append``: calls to the pickler ``<name>``
+
+    Timestamps are in seconds, from :func:`time.perf_counter`.
+    """
+
+    def begin(self, name, timestamp, args):
+        """Called when operation ``name`` starts.
+
+        :param name: name of the operation
+        :param timestamp: start time
+        :param args: dict of arguments of the operation (may be updated until :meth:`end` is called)"""
+        pass
+
+    def end(self, name, timestamp, duration, args):
+        """Called when operation ``name`` ends.
+
+        :param name: name of the operation
+        :param timestamp: end time
+        :param duration: duration of the operation, in seconds
+        :param args: dict of arguments of the operation"""
+        pass
+
+
+class ChromeTraceExporter(Tracer):
+    """Tracer storing the events in memory, to export them in the Chrome trace event format.
+
+    The resulting file can be opened in ``chrome://tracing`` or in `Perfetto <https://ui.perfetto.dev>`_.
+
+    When a :class:`mmappickle.mmapdict` is sent to another process, the copy of the tracer starts without any event:
+    each process should :meth:`dump` its own events. Since the timestamps of all the processes share the same clock,
+    the files can be merged using :meth:`merge`.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def __getstate__(self):
+        return {'events': []}
+
+    def _event(self, phase, name, timestamp, args):
+        self.events.append({
+            'name': name,
+            'cat': name.split('.')[0],
+            'ph': phase,
+            'ts': timestamp * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+
+    def begin(self, name, timestamp, args):
+        self._event('B', name, timestamp, dict(args))
+
+    def end(self, name, timestamp, duration, args):
+        args = dict(args)
+        args['duration'] = duration
+        self._event('E', name, timestamp, args)
+
+    def clear(self):
+        """Remove all the events"""
+        self.events = []
+
+    def dump(self, file):
+        """Write the events in the Chrome trace event JSON format.
+
+        :param file: file name, or file-like object opened in text mode"""
+        data = {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+        if isinstance(file, str):
+            with open(file, 'w') as f:
+                json.dump(data, f, default=repr)
+        else:
+            json.dump(data, file, default=repr)
+
+    @staticmethod
+    def merge(files, output):
+        """Merge several files written by :meth:`dump` (e.g. by several processes) into ``output``."""
+        events = []
+        for file in files:
+            with open(file) as f:
+                events.extend(json.load(f)['traceEvents'])
+        events.sort(key=lambda x: x['ts'])
+
+        exporter = ChromeTraceExporter()
+        exporter.events = events
+        exporter.dump(output)
+
+
+class _span:
+    """Context manager measuring an operation, in the statistics and/or the tracer of a :class:`mmappickle.mmapdict`."""
+    __slots__ = ('_stats', '_tracer', '_name', 'args', '_start')
+
+    def __init__(self, stats, tracer, name, args):
+        self._stats = stats
+        self._tracer = tracer
+        self._name = name
+        self.args = args
+
+    def set(self, **kw):
+        """Set additional arguments of the operation (only used by the tracer)"""
+        self.args.update(kw)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        if self._tracer is not None:
+            self._tracer.begin(self._name, self._start, self.args)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if self._stats is not None:
+            self._stats.add_time(self._name, end - self._start)
+        if self._tracer is not None:
+            if exc_type is not None:
+                self.args['exception'] = exc_type.__name__
+            self._tracer.end(self._name, end, end - self._start, self.args)
+        return False
+
+
+class _null_span:
+    """Context manager doing nothing, used when neither the statistics nor the tracer are enabled."""
+    __slots__ = ()
+
+    def set(self, **kw):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_span = _null_span()
@@ -34,6 +34,59 @@ def _unlock_file(f):
         raise OSError("Unsupported OS")
 
 
+def _range_locks_supported():
+    """:returns: True if :func:`_lock_range` is supported by the system"""
+    import os
+    if os.name != 'posix':
+        return False
+    import fcntl
+    return hasattr(fcntl, 'F_OFD_SETLKW')
+
+
+def _lock_range(f, mode, offset, length, wait=True):
+    """Lock ``length`` bytes of ``f`` from ``offset``. The locks of ranges do not interfere with :func:`_lock_file`.
+
+    These are ``fcntl`` byte-range locks, like the ones of :func:`fcntl.lockf`, but they are owned by the open file
+    (open file description locks, on Linux): they are only released when the file is closed (and not when another
+    descriptor of the same file is closed, e.g. by a memory map), and they conflict even within a process.
+
+    :param mode: ``'shared'``, ``'exclusive'`` or ``'unlock'``
+    :param length: number of bytes, or 0 to lock until the end of the file (even if it grows)
+    :param wait: if False, return instead of waiting if the range is locked by another file
+    :returns: True if the lock was changed, False if the range is locked by another file (only if ``wait`` is False)
+    """
+    import errno
+    import fcntl
+    import os
+    import struct
+    lock_type = {'shared': fcntl.F_RDLCK, 'exclusive': fcntl.F_WRLCK, 'unlock': fcntl.F_UNLCK}[mode]
+    command = fcntl.F_OFD_SETLKW if wait else fcntl.F_OFD_SETLK
+    try:
+        fcntl.fcntl(f.fileno(), command, struct.pack('hhqqi', lock_type, os.SEEK_SET, offset, length, 0))
+    except OSError as e:
+        if not wait and e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    return True
+
+
+# Byte locked by the leases (see mmapdict._lease), far after the end of any file
+_lease_offset = 2 ** 62
+# Byte locked while waiting for the lock of the header, with locking='range' (see mmapdict._lock_acquire)
+_turnstile_offset = _lease_offset + 1
+
+
+def _lease_file(f, mode):
+    """Lock the lease byte of ``f`` (see :func:`_lock_range`), without waiting.
+
+    :param mode: ``'shared'``, ``'exclusive'`` or ``'unlock'``
+    :returns: True if the lock was changed, False if it is held by another file or if leases are not supported
+    """
+    if not _range_locks_supported():
+        return False
+    return _lock_range(f, mode, _lease_offset, 1, wait=False)
+
+
 def save_file_position(f):
     """Decorator to save the object._file stream position before calling the method"""
     @wraps(f)
@@ -61,14 +114,38 @@ def require_writable(f):
 
 def lock(f):
     """Lock the file during the execution of this method. This is a re-entrant lock."""
+    return _lock_decorator(f, False)
+
+
+def lock_shared(f):
+    """Lock the file during the execution of this method, for reading only.
+
+    With ``mmapdict(..., locking='range')``, other methods decorated with :func:`lock_shared` can run at the same
+    time, and a method decorated with :func:`lock` can't be called by a method decorated with :func:`lock_shared`.
+    Otherwise, this is the same as :func:`lock`. This is a re-entrant lock."""
+    return _lock_decorator(f, True)
+
+
+def _lock_decorator(f, shared):
     @wraps(f)
     def lock_wrapper(self, *a, **kw):
+        if self._immutable:
+            # The file doesn't change, there is no need to lock it and to check the commit number
+            return f(self, *a, **kw)
+
+        if self._locked > 0 and self._locked_shared and not shared and self._locking == 'range':
+            # Upgrading the lock could deadlock, if two processes do it at the same time
+            raise RuntimeError("Cannot lock the file exclusively while it is locked for reading")
+
         self._locked += 1
 
         if self._locked == 1:
+            self._locked_shared = shared
             try:
-                _lock_file(self._file)
+                with self._span('lock'):
+                    self._lock_acquire(shared)
                 lock_failed = False
+                _drop_read_buffer(self._file)
             except OSError:
                 # Cannot lock?
                 lock_failed = True
@@ -90,7 +167,186 @@ def lock(f):
                 if self.commit_number != self._cache_commit_number:
                     self._cache_commit_number = self.commit_number
                     self._file.flush()
-                _unlock_file(self._file)
+                self._lock_release()
             self._locked -= 1
 
     return lock_wrapper
+
+
+def _drop_read_buffer(file):
+    """Discard the data buffered when reading ``file``, which may have been changed by another process.
+
+    Seeking relatively to the end of the file always resets the buffer of :class:`io.BufferedRandom`, while a seek
+    inside the buffer doesn't read the file again."""
+    position = file.tell()
+    file.seek(0, io.SEEK_END)
+    file.seek(position, io.SEEK_SET)
+
+
+def traced(name, with_key=True):
+    """Measure the method as operation ``name``, in the statistics and the tracer of the object.
+
+    :param with_key: if True, the first argument of the method is passed as ``key`` to the tracer"""
+    def traced_decorator(f):
+        @wraps(f)
+        def traced_wrapper(self, *a, **kw):
+            if with_key and len(a) > 0:
+                span = self._span(name, key=a[0])
+            else:
+                span = self._span(name)
+            with span:
+                return f(self, *a, **kw)
+
+        return traced_wrapper
+
+    return traced_decorator
+
+
+class _mmap_file:
+    """Read-only file-like object reading from a memory map of a file, with its own position.
+
+    Reads are done from the memory map, without any system call. The position is stored in the object,
+    so a copy of the object (for example in a child process, after ``fork()``) is independent."""
+
+    def __init__(self, file):
+        import mmap
+        self._wrapped_file = file
+        self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._position = 0
+
+    @property
+    def name(self):
+        return self._wrapped_file.name
+
+    @property
+    def mode(self):
+        return self._wrapped_file.mode
+
+    def fileno(self):
+        return self._wrapped_file.fileno()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = len(self.mmap) + offset
+        else:
+            raise ValueError("invalid whence ({}, should be 0, 1 or 2)".format(whence))
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self.mmap)
+        else:
+            end = min(self._position + size, len(self.mmap))
+        data = self.mmap[self._position:end]
+        self._position += len(data)
+        return data
+
+    def write(self, data):
+        raise io.UnsupportedOperation('not writable')
+
+    def truncate(self, size=None):
+        raise io.UnsupportedOperation('not writable')
+
+    def flush(self):
+        pass
+
+
+class _bounded_file:
+    """Proxy of a file object, which can only be written between ``offset`` and ``offset + length``.
+
+    A write which would go outside of these bounds raises :class:`ValueError`, and nothing is written. The file
+    descriptor is not available, since the data written using it could not be checked."""
+
+    def __init__(self, file, offset, length):
+        self._wrapped_file = file
+        self._start = offset
+        self._end = offset + length
+
+    def fileno(self):
+        raise io.UnsupportedOperation('fileno')
+
+    def write(self, data):
+        position = self._wrapped_file.tell()
+        length = memoryview(data).nbytes
+        if position < self._start or position + length > self._end:
+            raise ValueError("Cannot write {} bytes at offset {}, outside of [{}, {})".format(
+                length, position, self._start, self._end))
+        return self._wrapped_file.write(data)
+
+    def truncate(self, size=None):
+        raise io.UnsupportedOperation('truncate')
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped_file, name)
+
+
+def _crc32_file(f, offset, length, chunk_size=1048576):
+    """:returns: the CRC32 of ``length`` bytes of the file ``f``, starting at ``offset``. The file position is not kept."""
+    import zlib
+    f.seek(offset, io.SEEK_SET)
+    crc = 0
+    while length > 0:
+        data = f.read(min(length, chunk_size))
+        if len(data) == 0:
+            raise ValueError("Unexpected end of file")
+        crc = zlib.crc32(data, crc)
+        length -= len(data)
+    return crc
+
+
+def _gf2_matrix_times(matrix, vector):
+    ret = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            ret ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return ret
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, matrix[i]) for i in range(32)]
+
+
+def _crc32_combine(crc1, crc2, length2):
+    """:returns: the CRC32 of the concatenation of two blocks, from their CRC32 and the length of the second one
+    (this is ``crc32_combine`` of zlib, which is not available in the zlib module)."""
+    if length2 <= 0:
+        return crc1
+
+    # Operator for one zero bit, then two and four zero bits
+    odd = [0xedb88320] + [1 << i for i in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+
+    # Apply length2 zeros to crc1
+    while True:
+        even = _gf2_matrix_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        length2 >>= 1
+        if length2 == 0:
+            break
+
+        odd = _gf2_matrix_square(even)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        length2 >>= 1
+        if length2 == 0:
+            break
+
+    return crc1 ^ crc2
@@ -6,10 +6,14 @@ import io
 import os
 import numpy
 import numpy.testing
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-from mmappickle import mmapdict
+from mmappickle import mmapdict, shardedmmapdict
 from mmappickle.picklers.base import GenericPickler
-from mmappickle.picklers.numpy import ArrayPickler, MaskedArrayPickler
+from mmappickle.picklers.numpy import ArrayPickler, MaskedArrayPickler, PackedMaskedArrayPickler, ContainerPickler
 from mmappickle.stubs.numpy import EmptyNDArray
 
 
@@ -421,6 +425,96 @@ class TestDict(unittest.TestCase):
             d = pickle.load(f)
             self.assertDictEqual(d, {})
 
+    def test_update(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f, picklers=[GenericPickler])
+            m.update({'a': 1, 'b': 2})
+            m.update([('b', 3), ('c', 4)], d=5)
+            self.assertDictEqual(dict(m), {'a': 1, 'b': 3, 'c': 4, 'd': 5})
+
+    def test_long_keys(self):
+        with tempfile.TemporaryFile() as f:
+            keys = ['a' * 255, 'b' * 256, '\u00e9' * 200, 'c' * 70000]
+            m = mmapdict(f, picklers=[GenericPickler])
+            for i, k in enumerate(keys):
+                m[k] = i
+            del m[keys[0]]
+
+            m = mmapdict(f, picklers=[GenericPickler])
+            self.assertEqual(set(m.keys()), set(keys[1:]))
+            for i, k in enumerate(keys[1:], 1):
+                self.assertEqual(m[k], i)
+            self.assertTrue(m.fsck())
+
+            f.seek(0, io.SEEK_SET)
+            d = pickle.load(f)
+            self.assertDictEqual(d, dict((k, i) for i, k in enumerate(keys) if i > 0))
+
+            m.vacuum()
+            self.assertEqual(m['c' * 70000], 3)
+
+
+class TestGroup(unittest.TestCase):
+    def test_group(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f, picklers=[GenericPickler])
+            m['run1/frame2/image'] = 3
+            m['run1/frame1/image'] = 1
+            m['run1/frame1/label'] = 2
+            m['run10/frame1/image'] = 4
+            m['run1'] = 5
+            m['other'] = 6
+
+            run1 = m.group('run1')
+            self.assertEqual(run1.prefix, 'run1/')
+            self.assertEqual(run1.keys(), ['frame1/image', 'frame1/label', 'frame2/image'])
+            self.assertEqual(run1['frame1/label'], 2)
+            self.assertIn('frame2/image', run1)
+            self.assertNotIn('image', run1)
+
+            frame1 = run1.group('frame1')
+            self.assertEqual(frame1.keys(), ['image', 'label'])
+            frame1['extra'] = 7
+            self.assertEqual(m['run1/frame1/extra'], 7)
+            self.assertEqual(frame1.keys(), ['extra', 'image', 'label'])
+            del frame1['extra']
+            self.assertEqual(frame1.keys(), ['image', 'label'])
+            with self.assertRaises(KeyError):
+                frame1['extra']
+
+            commit_number = m.commit_number
+            run1.clear()
+            self.assertEqual(m.commit_number, commit_number + 1)
+            self.assertEqual(run1.keys(), [])
+            self.assertEqual(set(m.keys()), {'run10/frame1/image', 'run1', 'other'})
+
+            m = mmapdict(f, picklers=[GenericPickler])
+            self.assertEqual(m.group('run10').keys(), ['frame1/image'])
+            self.assertEqual(m.group('run1/').keys(), [])
+
+
+class TestSortedKeys(unittest.TestCase):
+    def test_irange(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f, picklers=[GenericPickler], stats=True)
+            for day in (3, 1, 2):
+                for month in ('2026-01', '2026-02', '2025-12'):
+                    m['{}-{:02d}'.format(month, day)] = day
+            self.assertEqual(list(m.irange('2026-01', '2026-02')), ['2026-01-01', '2026-01-02', '2026-01-03'])
+            self.assertEqual(list(m.irange('2026-01-01', '2026-01-03', (False, True))), ['2026-01-02', '2026-01-03'])
+            self.assertEqual(list(m.irange(hi='2026-01')), ['2025-12-01', '2025-12-02', '2025-12-03'])
+            self.assertEqual(list(m.irange('2026-02-02')), ['2026-02-02', '2026-02-03'])
+            self.assertEqual(list(m.iprefix('2025-12')), ['2025-12-01', '2025-12-02', '2025-12-03'])
+
+            # The index is updated without being rebuilt
+            m['2026-01-15'] = 15
+            m['2026-01-02'] = 2
+            del m['2026-01-01']
+            del m['2025-12-02']
+            self.assertEqual(list(m.iprefix('2026-01')), ['2026-01-02', '2026-01-03', '2026-01-15'])
+            self.assertEqual(list(m.iprefix('2025')), ['2025-12-01', '2025-12-03'])
+            self.assertEqual(m.stats()['cache.sort.count'], 1)
+
 
 class TestDictNumpyArray(unittest.TestCase):
     def _dump_file(self, f):
@@ -455,6 +549,129 @@ class TestDictNumpyArray(unittest.TestCase):
             for i in range(1, 9):
                 self.assertEqual(m['test{}'.format(i)].ndim, i)
 
+    def test_store_order(self):
+        with tempfile.TemporaryFile() as f:
+            base = numpy.arange(200, dtype=numpy.int32).reshape(10, 20)
+            m = mmapdict(f, picklers=[ArrayPickler])
+            m._picklers[0]._write_block_size = 16
+            m['fortran'] = numpy.asfortranarray(base)
+            m['transposed'] = base.T[::2, 1:]
+            m['strided'] = base[::3, ::2]
+
+            self.assertTrue(m['fortran'].flags.f_contiguous)
+            self.assertFalse(m['fortran'].flags.c_contiguous)
+            self.assertTrue(m['transposed'].flags.f_contiguous)
+            self.assertTrue(m['strided'].flags.c_contiguous)
+            numpy.testing.assert_array_equal(m['fortran'], base)
+            numpy.testing.assert_array_equal(m['transposed'], base.T[::2, 1:])
+            numpy.testing.assert_array_equal(m['strided'], base[::3, ::2])
+
+            f.seek(0)
+            d = pickle.load(f)
+            numpy.testing.assert_array_equal(d['fortran'], base)
+            numpy.testing.assert_array_equal(d['transposed'], base.T[::2, 1:])
+            numpy.testing.assert_array_equal(d['strided'], base[::3, ::2])
+
+    def test_append_rows(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f)
+            m['grow'] = numpy.zeros((0, 3), numpy.int16)
+            m['reserved'] = EmptyNDArray((1, 2), numpy.float32, capacity=4)
+            m['moved'] = numpy.arange(4)
+            m['last'] = numpy.arange(6).reshape(2, 3)
+
+            # Last value of the file
+            commit_number = m.commit_number
+            m.append_rows('last', [[6, 7, 8]])
+            m.append_rows('last', numpy.arange(9, 300).reshape(97, 3))
+            numpy.testing.assert_array_equal(m['last'], numpy.arange(300).reshape(100, 3))
+            self.assertNotEqual(commit_number, m.commit_number)
+
+            # Reserved capacity
+            commit_number = m.commit_number
+            m.append_rows('reserved', numpy.ones((3, 2)))
+            self.assertNotEqual(commit_number, m.commit_number)
+            numpy.testing.assert_array_equal(m['reserved'], [[0, 0], [1, 1], [1, 1], [1, 1]])
+
+            # Not enough room, copied at the end of the file
+            m.append_rows('moved', [4, 5])
+            m.append_rows('reserved', numpy.ones((1, 2)))
+            m.append_rows('grow', numpy.ones((2, 3)))
+            numpy.testing.assert_array_equal(m['moved'], numpy.arange(6))
+            numpy.testing.assert_array_equal(m['reserved'], [[0, 0], [1, 1], [1, 1], [1, 1], [1, 1]])
+            numpy.testing.assert_array_equal(m['grow'], numpy.ones((2, 3)))
+
+            with self.assertRaises(ValueError):
+                m.append_rows('last', numpy.ones((1, 2)))
+            m['fortran'] = numpy.asfortranarray(numpy.ones((2, 3)))
+            with self.assertRaises(ValueError):
+                m.append_rows('fortran', numpy.ones((1, 3)))
+            m['string'] = 'abc'
+            with self.assertRaises(TypeError):
+                m.append_rows('string', numpy.ones((1, 3)))
+            with self.assertRaises(KeyError):
+                m.append_rows('nonexistent', numpy.ones((1, 3)))
+
+            self.assertTrue(m.fsck())
+            f.seek(0)
+            d = pickle.load(f)
+            numpy.testing.assert_array_equal(d['last'], numpy.arange(300).reshape(100, 3))
+            numpy.testing.assert_array_equal(d['reserved'], [[0, 0], [1, 1], [1, 1], [1, 1], [1, 1]])
+            numpy.testing.assert_array_equal(d['moved'], numpy.arange(6))
+
+    def test_store_container(self):
+        with tempfile.TemporaryFile() as f:
+            image = numpy.arange(12, dtype=numpy.uint8).reshape(3, 4)
+            labels = numpy.ma.masked_array([1, 2, 3], [False, True, False])
+            record = {
+                'image': image,
+                'labels': labels,
+                'meta': {'name': 'abc', 'tags': ['x', 'y'], 'empty': {}},
+                'list': [numpy.zeros(2), 'text', (1, numpy.ones(3))],
+                (1, 2): frozenset([1, 2]),
+            }
+            m = mmapdict(f)
+            m['record'] = record
+            m['plain'] = {'a': [1, 2]}
+
+            value = m['record']
+            self.assertIsInstance(value['image'], numpy.memmap)
+            self.assertIsInstance(value['labels'].data, numpy.memmap)
+            self.assertIsInstance(value['list'][2][1], numpy.memmap)
+            numpy.testing.assert_array_equal(value['image'], image)
+            numpy.testing.assert_array_equal(value['labels'].mask, labels.mask)
+            self.assertEqual(value['meta'], record['meta'])
+            self.assertEqual(value['list'][1:2], ['text'])
+            self.assertIsInstance(value['list'][2], tuple)
+            self.assertEqual(value[(1, 2)], frozenset([1, 2]))
+            self.assertEqual(m['plain'], {'a': [1, 2]})
+
+            f.seek(0)
+            d = pickle.load(f)
+            self.assertEqual(set(d['record'].keys()), set(record.keys()))
+            numpy.testing.assert_array_equal(d['record']['image'], image)
+            numpy.testing.assert_array_equal(d['record']['list'][2][1], numpy.ones(3))
+            self.assertEqual(d['record']['meta'], record['meta'])
+
+    def test_store_container_fallback(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f)
+            cyclic = [1]
+            cyclic.append(cyclic)
+            m['cyclic'] = cyclic
+            value = m['cyclic']
+            self.assertIs(value[1], value)
+            cyclic.append(numpy.zeros(2))
+            m['cyclic_array'] = cyclic
+            self.assertEqual(m.info('cyclic_array').pickler, 'GenericPickler')
+
+            # The array is too far to be found
+            m['far'] = list(range(ContainerPickler.scan_limit)) + [numpy.zeros(2)]
+            self.assertEqual(m.info('far').pickler, 'GenericPickler')
+            numpy.testing.assert_array_equal(m['far'][-1], numpy.zeros(2))
+            m['near'] = [numpy.zeros(2)] + list(range(ContainerPickler.scan_limit))
+            self.assertEqual(m.info('near').pickler, 'ContainerPickler')
+
     def test_store_masked(self):
         with tempfile.TemporaryFile() as f:
             data = numpy.ma.MaskedArray([[1, 2, 3], [4, 5, 6]], [[False, True, False], [True, False, True]])
@@ -492,6 +709,29 @@ class TestDictNumpyArray(unittest.TestCase):
             d = pickle.load(f)
             numpy.testing.assert_array_equal(d['test'], data)
 
+    def test_masked_packed(self):
+        with tempfile.TemporaryFile() as f:
+            data = numpy.ma.masked_greater(numpy.arange(30, dtype=numpy.float32).reshape(3, 10), 20)
+            m = mmapdict(f, picklers=[PackedMaskedArrayPickler, ArrayPickler, GenericPickler])
+            m['test'] = data
+            m['nomask'] = numpy.ma.zeros([2, 3])
+            self.assertIsInstance(m['test'].data, numpy.memmap)
+            numpy.testing.assert_array_equal(m['test'].mask, data.mask)
+            numpy.testing.assert_array_equal(m['test'], data)
+            self.assertIs(m['nomask'].mask, numpy.ma.nomask)
+            numpy.testing.assert_array_equal(m['nomask'], numpy.ma.zeros([2, 3]))
+
+            # The default picklers can read all the layouts
+            m = mmapdict(f)
+            numpy.testing.assert_array_equal(m['test'].mask, data.mask)
+            numpy.testing.assert_array_equal(m['nomask'], numpy.ma.zeros([2, 3]))
+
+            f.seek(0)
+            d = pickle.load(f)
+            numpy.testing.assert_array_equal(d['test'], data)
+            numpy.testing.assert_array_equal(d['test'].mask, data.mask)
+            self.assertFalse(d['nomask'].mask.any())
+
     def test_readonly(self):
         with tempfile.NamedTemporaryFile(delete=False) as f:
             f.close()
@@ -513,6 +753,122 @@ def _tc_increment(args):
     m['value'][idx] += 1
 
 
+def _tc_sharded_set(args):
+    m, k = args
+    m[k] = -m[k]
+
+
+def _tc_sum(value):
+    return int(value.sum())
+
+
+class TestInfo(unittest.TestCase):
+    def test_info(self):
+        with tempfile.NamedTemporaryFile() as f:
+            m = mmapdict(f.name, dedup=True, stats=True)
+            m['a'] = numpy.zeros((10, 20), dtype=numpy.float32)
+            m['fortran'] = numpy.asfortranarray(numpy.zeros((3, 4), dtype='>i2'))
+            m['masked'] = numpy.ma.masked_array(numpy.arange(6), [0, 1, 0, 0, 0, 1])
+            m['growable'] = EmptyNDArray((5, 2), numpy.uint8, capacity=10)
+            m['reference'] = numpy.zeros((10, 20), dtype=numpy.float32)
+            m['text'] = 'abc'
+
+            info = m.info('a')
+            self.assertEqual(info.key, 'a')
+            self.assertEqual(info.pickler, 'ArrayPickler')
+            self.assertEqual(info.shape, (10, 20))
+            self.assertEqual(info.dtype, numpy.float32)
+            self.assertEqual(info.nbytes, 800)
+            self.assertEqual(info.offset, m._kv['a'].data_offset)
+            self.assertGreater(info.length, 800)
+
+            infos = m.info_many(['fortran', 'masked', 'growable', 'reference', 'text'])
+            self.assertEqual([i.key for i in infos], ['fortran', 'masked', 'growable', 'reference', 'text'])
+            self.assertEqual((infos[0].shape, infos[0].dtype), ((3, 4), numpy.dtype('>i2')))
+            self.assertEqual((infos[1].pickler, infos[1].shape, infos[1].nbytes), ('MaskedArrayPickler', (6, ), 48))
+            self.assertEqual(infos[2].shape, (5, 2))
+            self.assertEqual(infos[3].offset, info.offset)
+            self.assertEqual((infos[4].pickler, infos[4].shape, infos[4].dtype, infos[4].nbytes),
+                             ('GenericPickler', None, None, None))
+            with self.assertRaises(KeyError):
+                m.info('nonexistent')
+
+            # Nothing was read
+            self.assertFalse(any(k.endswith('.read.count') for k in m.stats()))
+            self.assertEqual(m.stats()['info.count'], 7)
+
+            m.append_rows('growable', numpy.ones((2, 2), dtype=numpy.uint8))
+            self.assertEqual(m.info('growable').shape, (7, 2))
+
+            m = mmapdict(f.name, immutable=True)
+            self.assertIs(m.info('a'), m.info('a'))
+
+    def test_info_checksum(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f, checksums=True, verify_on_read=True, stats=True)
+            m['a'] = numpy.zeros(1000000)
+            self.assertEqual(m.info('a').shape, (1000000, ))
+            self.assertNotIn('checksum.count', m.stats())
+            m['a']
+            self.assertEqual(m.stats()['checksum.count'], 1)
+
+
+class TestLazy(unittest.TestCase):
+    def test_lazy(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f, stats=True)
+            m['a'] = {'x': [1, 2, 3], 'y': 'test'}
+            m['b'] = numpy.arange(10)
+            m['c'] = 1
+            with self.assertRaises(KeyError):
+                m.lazy('nonexistent')
+
+            a = m.lazy('a')
+            self.assertEqual(a.key, 'a')
+            self.assertFalse(a.loaded)
+            self.assertNotIn('getitem.count', m.stats())
+            self.assertEqual(a['x'], [1, 2, 3])
+            self.assertTrue(a.loaded)
+            self.assertEqual(sorted(a.keys()), ['x', 'y'])
+            self.assertEqual(len(a), 2)
+            self.assertIn('y', a)
+            self.assertEqual(a, {'x': [1, 2, 3], 'y': 'test'})
+            self.assertEqual(m.stats()['getitem.count'], 1)
+
+            b = m.lazy('b')
+            self.assertEqual(b.shape, (10, ))
+            numpy.testing.assert_array_equal(numpy.asarray(b), numpy.arange(10))
+            self.assertEqual(b.sum(), 45)
+
+            # Other keys are changed: the values are not read again
+            m['c'] = 2
+            del m['c']
+            self.assertIs(a.get(), a.get())
+            self.assertEqual(m.stats()['getitem.count'], 2)
+
+            # The key is changed
+            value = a.get()
+            m['a'] = [4, 5]
+            self.assertEqual(a, [4, 5])
+            self.assertIsNot(a.get(), value)
+            self.assertEqual(m.stats()['getitem.count'], 3)
+            del m['a']
+            with self.assertRaises(KeyError):
+                a.get()
+
+    def test_lazy_append_rows(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f)
+            m['reserved'] = EmptyNDArray((1, 2), numpy.float32, capacity=4)
+            m['last'] = numpy.zeros((2, 2))
+            reserved, last = m.lazy('reserved'), m.lazy('last')
+            self.assertEqual((reserved.shape, last.shape), ((1, 2), (2, 2)))
+            m.append_rows('reserved', numpy.ones((1, 2)))
+            m.append_rows('last', numpy.ones((3, 2)))
+            self.assertEqual((reserved.shape, last.shape), ((2, 2), (5, 2)))
+            numpy.testing.assert_array_equal(last, m['last'])
+
+
 class TestConcurrent(unittest.TestCase):
     def test_concurrent_1(self):
         with tempfile.NamedTemporaryFile(delete=False) as f:
@@ -535,6 +891,115 @@ class TestConcurrent(unittest.TestCase):
 
             os.unlink(f.name)
 
+    @unittest.skipUnless(hasattr(fcntl, 'F_OFD_SETLKW'), "requires open file description locks")
+    def test_range_locking(self):
+        from mmappickle.utils import _lock_range
+        with tempfile.NamedTemporaryFile() as f:
+            with self.assertRaises(ValueError):
+                mmapdict(f.name, locking='other')
+            m = mmapdict(f.name, locking='range')
+            m['a'] = 1
+            other = mmapdict(f.name, locking='range')
+            header_length = len(m._header)
+
+            # The readers share the lock, but exclude the writers
+            m._lock_acquire(True)
+            self.assertEqual(other['a'], 1)
+            self.assertEqual(list(other.keys()), ['a'])
+            self.assertFalse(_lock_range(other._file, 'exclusive', 0, header_length, wait=False))
+            m._lock_release()
+            self.assertTrue(_lock_range(other._file, 'exclusive', 0, header_length, wait=False))
+            _lock_range(other._file, 'unlock', 0, header_length)
+
+            # The writers exclude the readers
+            m._lock_acquire(False)
+            self.assertFalse(_lock_range(other._file, 'shared', 0, header_length, wait=False))
+            m._lock_release()
+
+            other['a'] = 2
+            self.assertEqual(m['a'], 2)
+
+            # The lock can't be upgraded, except with locking='file' (where it is always exclusive)
+            from mmappickle.utils import lock_shared
+            set_shared = lock_shared(lambda d: d.__setitem__('b', 3))
+            with self.assertRaises(RuntimeError):
+                set_shared(m)
+            set_shared(mmapdict(f.name))
+            self.assertEqual(m['b'], 3)
+
+            import multiprocessing
+            import itertools
+            m['value'] = numpy.zeros((4, ))
+            with multiprocessing.Pool(4) as p:
+                p.map(_tc_increment, itertools.product([m], range(4)))
+            numpy.testing.assert_array_equal(m['value'], numpy.ones((4, )))
+
+    @unittest.skipUnless(hasattr(fcntl, 'F_OFD_SETLKW'), "requires open file description locks")
+    def test_reserve(self):
+        with tempfile.NamedTemporaryFile() as f:
+            m = mmapdict(f.name, locking='range', checksums=True, dedup=True)
+            masked = numpy.ma.masked_array(numpy.arange(10), mask=numpy.arange(10) % 3 == 0)
+            m['a'] = numpy.arange(10)
+            m['b'] = masked
+            m['c'] = numpy.arange(10)
+            m['a'] = numpy.ones((3, 4), order='F')
+            m['d'] = EmptyNDArray((3, ), capacity=10)
+            m.append_rows('d', numpy.ones((2, )))
+            numpy.testing.assert_array_equal(m['a'], numpy.ones((3, 4)))
+            numpy.testing.assert_array_equal(m['b'].mask, masked.mask)
+            numpy.testing.assert_array_equal(m['c'], numpy.arange(10))
+            self.assertEqual(m['d'].shape, (5, ))
+            self.assertEqual(m.verify(), [])
+            f.seek(0)
+            self.assertEqual(sorted(pickle.load(f).keys()), ['a', 'b', 'c', 'd'])
+
+            # The value is being written by m: the entry is ignored by the other processes
+            other = mmapdict(f.name, locking='range')
+            pickler = ArrayPickler(m)
+            reservation = m._setitem_locked('e', numpy.arange(5), pickler, None)
+            self.assertNotIn('e', other)
+            other['f'] = 1
+            self.assertEqual(other['c'][3], 3)
+            with self.assertRaises(RuntimeError):
+                other.vacuum()
+            self.assertTrue(other.fsck(salvage=True))
+            m._write_reserved(reservation, numpy.arange(5), pickler, None)
+            numpy.testing.assert_array_equal(other['e'], numpy.arange(5))
+            self.assertEqual(other['f'], 1)
+
+            # The writer was interrupted
+            kv = m._setitem_locked('g', numpy.arange(5), pickler, None)[0]
+            reserved = (kv.offset, len(kv))
+            m._file.close()
+            self.assertNotIn('g', other)
+            report = other.fsck()
+            self.assertFalse(report)
+            self.assertEqual(report.damaged, [reserved])
+            self.assertIn(reserved, other.space_report().holes)
+            other.vacuum()
+            self.assertEqual(sorted(other.keys()), ['a', 'b', 'c', 'd', 'e', 'f'])
+            f.seek(0)
+            self.assertEqual(sorted(pickle.load(f).keys()), ['a', 'b', 'c', 'd', 'e', 'f'])
+
+    @unittest.skipUnless(hasattr(fcntl, 'F_OFD_SETLKW'), "requires open file description locks")
+    def test_reserve_wrong_size(self):
+        with tempfile.NamedTemporaryFile() as f:
+            m = mmapdict(f.name, locking='range')
+            other = mmapdict(f.name, locking='range')
+            # A pickler whose size is wrong (a subclass would be used by all the mmapdicts)
+            pickler = ArrayPickler(m)
+            size = pickler.size
+            pickler.size = lambda obj, memo_start_idx=0: (size(obj, memo_start_idx)[0] - 8, 0)
+            reservation = m._setitem_locked('a', numpy.arange(5), pickler, None)
+            other['b'] = numpy.arange(3)
+
+            # The value doesn't fit in its entry: the next entry is not overwritten
+            with self.assertRaises(ValueError):
+                m._write_reserved(reservation, numpy.arange(5), pickler, None)
+            self.assertNotIn('a', other)
+            numpy.testing.assert_array_equal(other['b'], numpy.arange(3))
+            self.assertTrue(other.fsck())
+
     def test_concurrent_mmapdict_pickle(self):
         # This is not a real test, but it fixes the converage computation since the previous test in not counted
         with tempfile.NamedTemporaryFile(delete=False) as f:
@@ -549,6 +1014,486 @@ class TestConcurrent(unittest.TestCase):
 
             os.unlink(f.name)
 
+    def test_changed_by_other_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            other = mmapdict(f.name)
+            other['a'] = 1
+            other['b'] = 2
+            # The beginning of the file is read (and buffered) when it is opened
+            m = mmapdict(f.name, readonly=True)
+            del other['a']
+            self.assertEqual(m.commit_number, other.commit_number)
+            self.assertNotIn('a', m)
+            self.assertEqual(list(m.keys()), ['b'])
+
+    def test_map(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f, tempfile.NamedTemporaryFile(delete=False) as f_out:
+            f.close()
+            f_out.close()
+
+            m = mmapdict(f.name)
+            m.update(('value{}'.format(i), numpy.arange(i * 100)) for i in range(10))
+
+            expected = {'value{}'.format(i): int(numpy.arange(i * 100).sum()) for i in range(10)}
+            self.assertDictEqual(m.map(_tc_sum, processes=2), expected)
+            self.assertDictEqual(m.map(_tc_sum, keys=['value3'], processes=2), {'value3': expected['value3']})
+            with self.assertRaises(KeyError):
+                m.map(_tc_sum, keys=['nonexistent'], processes=2)
+
+            m_out = mmapdict(f_out.name)
+            self.assertIsNone(m.map(_tc_sum, processes=3, out=m_out))
+            self.assertDictEqual(dict(m_out), expected)
+
+            del m
+            del m_out
+
+            os.unlink(f.name)
+            os.unlink(f_out.name)
+
+    def test_open_while_writing(self):
+        import threading
+        import time
+        with tempfile.NamedTemporaryFile() as f:
+            m = mmapdict(f.name)
+            m['a'] = 1
+            size = os.path.getsize(f.name)
+
+            # An entry is being written: the terminator is missing until it is complete
+            m._lock_acquire(False)
+            m._file.truncate(size - len(m._terminator))
+            m._file.flush()
+            opened = []
+            t = threading.Thread(target=lambda: opened.append(mmapdict(f.name)))
+            t.start()
+            time.sleep(0.2)
+            self.assertTrue(t.is_alive())
+            m._terminator.write()
+            m._file.flush()
+            m._lock_release()
+            t.join()
+
+            self.assertEqual(os.path.getsize(f.name), size)
+            self.assertEqual(opened[0]['a'], 1)
+
+    def test_open_lock_failure(self):
+        from unittest import mock
+        with tempfile.NamedTemporaryFile() as f:
+            m = mmapdict(f.name)
+            m['a'] = 1
+            size = os.path.getsize(f.name)
+            m._file.truncate(size - len(m._terminator))
+            m._file.flush()
+
+            # The terminator is not written if the file can't be locked
+            with mock.patch.object(mmapdict, '_lock_acquire', side_effect=OSError):
+                mmapdict(f.name)
+            self.assertEqual(os.path.getsize(f.name), size - len(m._terminator))
+
+
+class TestSharded(unittest.TestCase):
+    def test_sharded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'data')
+            with self.assertRaises(FileNotFoundError):
+                shardedmmapdict(path, readonly=True)
+
+            m = shardedmmapdict(path, shards=4)
+            self.assertEqual(len(m.shards), 4)
+            self.assertEqual(len(os.listdir(path)), 5)
+            m['a'] = 1
+            m.update({'k{}'.format(i): i for i in range(20)}, b=numpy.arange(3))
+            self.assertEqual(len(m), 22)
+            self.assertIn('k3', m)
+            self.assertIn('k3', m.shard('k3'))
+            self.assertEqual(sum(len(shard.keys()) > 0 for shard in m.shards), 4)
+            self.assertEqual(m.get_many(['k5', 'a', 'k19']), [5, 1, 19])
+            numpy.testing.assert_array_equal(m['b'], numpy.arange(3))
+            del m['a']
+            self.assertNotIn('a', m)
+            with self.assertRaises(KeyError):
+                m.get_many(['k1', 'a'])
+            m.vacuum()
+
+            # The same shards are used by all the processes
+            import multiprocessing
+            with multiprocessing.Pool(2) as p:
+                p.map(_tc_sharded_set, [(m, 'k{}'.format(i)) for i in range(20)])
+            self.assertEqual(m.get_many(['k{}'.format(i) for i in range(20)]), [-i for i in range(20)])
+
+            m = shardedmmapdict(path, readonly=True)
+            self.assertEqual(len(m.shards), 4)
+            self.assertEqual(sorted(m.keys()), sorted(['b'] + ['k{}'.format(i) for i in range(20)]))
+            with self.assertRaises(ValueError):
+                shardedmmapdict(path, shards=8)
+
+    def test_missing_shard(self):
+        with tempfile.TemporaryDirectory() as directory:
+            m = shardedmmapdict(directory, shards=4)
+            m.update({'k{}'.format(i): i for i in range(20)})
+            os.remove(os.path.join(directory, 'shard-0003.mmdpickle'))
+            with self.assertRaises(ValueError):
+                shardedmmapdict(directory)
+
+            # Interrupted before the manifest was written
+            os.remove(os.path.join(directory, 'manifest.json'))
+            with self.assertRaises(ValueError):
+                shardedmmapdict(directory)
+            with self.assertRaises(FileNotFoundError):
+                shardedmmapdict(directory, readonly=True)
+            m = shardedmmapdict(directory, shards=4)
+            self.assertEqual(len(m.shards), 4)
+            keys = m.keys()
+            self.assertEqual(m.get_many(keys), [int(k[1:]) for k in keys])
+
+
+class TestStats(unittest.TestCase):
+    def test_disabled(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f)
+            with self.assertRaises(RuntimeError):
+                m.stats()
+            with self.assertRaises(RuntimeError):
+                m.reset_stats()
+
+    def test_stats(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f, picklers=[ArrayPickler, GenericPickler], stats=True)
+            m['a'] = 'abc'
+            m['b'] = numpy.zeros((10, ), dtype=numpy.uint8)
+            self.assertEqual(m['a'], 'abc')
+            numpy.testing.assert_array_equal(m['b'], numpy.zeros((10, ), dtype=numpy.uint8))
+
+            stats = m.stats()
+            self.assertGreater(stats['file.seeks'], 0)
+            self.assertGreater(stats['file.reads'], 0)
+            self.assertGreater(stats['file.write_bytes'], 0)
+            self.assertGreater(stats['lock.count'], 0)
+            self.assertGreaterEqual(stats['lock.time'], 0)
+            self.assertEqual(stats['pickler.GenericPickler.write.count'], 1)
+            self.assertEqual(stats['pickler.ArrayPickler.write.count'], 1)
+            self.assertEqual(stats['pickler.GenericPickler.read.count'], 1)
+            self.assertEqual(stats['pickler.ArrayPickler.read.count'], 1)
+            # 'a' is probed by both picklers
+            self.assertEqual(stats['pickler.ArrayPickler.probe.count'], 2)
+            self.assertEqual(stats['pickler.GenericPickler.probe.count'], 1)
+
+            # Another process changing the file forces a rebuild of the cache
+            m2 = mmapdict(f)
+            m2['c'] = 1
+            m.reset_stats()
+            self.assertEqual(m['c'], 1)
+            stats = m.stats()
+            self.assertEqual(stats['cache.clears'], 1)
+            self.assertEqual(stats['cache.rebuild.count'], 1)
+            self.assertNotIn('pickler.ArrayPickler.write.count', stats)
+
+    def test_pickle(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.close()
+
+            m = mmapdict(f.name, stats=True)
+            m['a'] = 1
+            m2 = pickle.loads(pickle.dumps(m))
+            self.assertEqual(m2['a'], 1)
+            self.assertNotEqual(m.stats(), m2.stats())
+
+            del m
+            del m2
+            os.unlink(f.name)
+
+
+class TestTrace(unittest.TestCase):
+    def test_chrome_trace(self):
+        import json
+        from mmappickle.trace import ChromeTraceExporter
+        with tempfile.TemporaryFile() as f:
+            tracer = ChromeTraceExporter()
+            m = mmapdict(f, picklers=[ArrayPickler, GenericPickler], tracer=tracer)
+            m['a'] = numpy.zeros((10, ), dtype=numpy.uint8)
+            m['a']
+            del m['a']
+            m.vacuum()
+
+            names = set(e['name'] for e in tracer.events)
+            for name in ('setitem', 'getitem', 'delitem', 'vacuum', 'lock', 'cache.rebuild', 'pickler.dispatch',
+                         'pickler.ArrayPickler.probe', 'pickler.ArrayPickler.read', 'pickler.ArrayPickler.write'):
+                self.assertIn(name, names)
+
+            # Events are balanced, and nested
+            stack = []
+            for e in tracer.events:
+                if e['ph'] == 'B':
+                    stack.append(e['name'])
+                else:
+                    self.assertEqual(stack.pop(), e['name'])
+                    self.assertGreaterEqual(e['args']['duration'], 0)
+            self.assertEqual(stack, [])
+
+            read = [e for e in tracer.events if e['name'] == 'pickler.ArrayPickler.read' and e['ph'] == 'E'][0]
+            self.assertEqual(read['args']['key'], 'a')
+            self.assertIn('offset', read['args'])
+            self.assertIn('bytes', read['args'])
+
+            out = io.StringIO()
+            tracer.dump(out)
+            self.assertEqual(len(json.loads(out.getvalue())['traceEvents']), len(tracer.events))
+
+            tracer.clear()
+            m.tracer = None
+            m['b'] = 1
+            self.assertEqual(tracer.events, [])
+
+    def test_custom_tracer(self):
+        from mmappickle.trace import Tracer
+
+        class RecordingTracer(Tracer):
+            def __init__(self):
+                self.ended = []
+
+            def end(self, name, timestamp, duration, args):
+                self.ended.append((name, args))
+
+        with tempfile.TemporaryFile() as f:
+            tracer = RecordingTracer()
+            m = mmapdict(f, picklers=[GenericPickler], tracer=tracer)
+            m['test'] = 'abc'
+            self.assertIn(('setitem', {'key': 'test'}), tracer.ended)
+            with self.assertRaises(KeyError):
+                m['nonexistent']
+            self.assertIn(('getitem', {'key': 'nonexistent', 'exception': 'KeyError'}), tracer.ended)
+
+
+class TestImmutable(unittest.TestCase):
+    def test_immutable(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.close()
+
+            m = mmapdict(f.name)
+            m['a'] = 'abc'
+            m['b'] = numpy.arange(12).reshape(3, 4)
+            m['c'] = numpy.ma.masked_array([1, 2], [False, True])
+            del m
+
+            with self.assertRaises(ValueError):
+                mmapdict(f.name, readonly=False, immutable=True)
+
+            m = mmapdict(f.name, immutable=True, stats=True)
+            self.assertEqual(set(m.keys()), {'a', 'b', 'c'})
+            self.assertEqual(m['a'], 'abc')
+            self.assertEqual(m['a'], 'abc')
+            numpy.testing.assert_array_equal(m['b'], numpy.arange(12).reshape(3, 4))
+            self.assertFalse(m['b'].flags.writeable)
+            numpy.testing.assert_array_equal(m['c'].mask, [False, True])
+
+            stats = m.stats()
+            # Only locked once, to read the keys
+            self.assertEqual(stats['lock.count'], 1)
+            self.assertEqual(stats['pickler.dispatch.count'], 3)
+
+            with self.assertRaises(io.UnsupportedOperation):
+                m['d'] = 1
+            with self.assertRaises(io.UnsupportedOperation):
+                del m['a']
+
+            self.assertEqual(m.map(_tc_sum, ['b']), {'b': 66})
+            del m
+
+            os.unlink(f.name)
+
+
+class TestDedup(unittest.TestCase):
+    def test_dedup(self):
+        with tempfile.TemporaryFile() as f:
+            calibration = numpy.arange(1000, dtype=numpy.float64).reshape(10, 100)
+            m = mmapdict(f, dedup=True, stats=True)
+            m['frame1/calibration'] = calibration
+            f.seek(0, io.SEEK_END)
+            size = f.tell()
+            m['frame2/calibration'] = calibration.copy()
+            m['frame3/calibration'] = numpy.asfortranarray(calibration)
+            m['blob1'] = b'abc' * 100
+            m['blob2'] = b'abc' * 100
+            m['text'] = 'abc'
+            self.assertEqual(m.stats()['dedup.references'], 2)
+
+            f.seek(0, io.SEEK_END)
+            self.assertLess(f.tell() - size, calibration.nbytes * 1.1)
+
+            for k in ('frame1/calibration', 'frame2/calibration', 'frame3/calibration'):
+                numpy.testing.assert_array_equal(m[k], calibration)
+            self.assertEqual(m['frame2/calibration'].offset, m['frame1/calibration'].offset)
+            self.assertEqual(m['blob2'], b'abc' * 100)
+            with self.assertRaises(ValueError):
+                m.append_rows('frame2/calibration', calibration[:1])
+
+            # Values which are still referred to are kept by vacuum
+            del m['frame1/calibration']
+            del m['blob1']
+            m.vacuum()
+            f.seek(0)
+            d = pickle.load(f)
+            numpy.testing.assert_array_equal(d['frame2/calibration'], calibration)
+            self.assertEqual(d['blob2'], b'abc' * 100)
+            self.assertEqual(set(d.keys()), {'frame2/calibration', 'frame3/calibration', 'blob2', 'text'})
+
+            m = mmapdict(f)
+            numpy.testing.assert_array_equal(m['frame2/calibration'], calibration)
+            self.assertEqual(m['blob2'], b'abc' * 100)
+
+            # Once they aren't referred to anymore, they are freed
+            f.seek(0, io.SEEK_END)
+            size = f.tell()
+            del m['frame2/calibration']
+            del m['blob2']
+            m.vacuum()
+            f.seek(0, io.SEEK_END)
+            self.assertLess(f.tell(), size - calibration.nbytes)
+            self.assertEqual(set(m.keys()), {'frame3/calibration', 'text'})
+
+    def test_dedup_parsing(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f)
+            m['a'] = numpy.arange(100)
+            m['b'] = b'x' * 100
+            del m['a']
+            del m['b']
+            m.space_report()
+            m._dedup_index
+            # Without references, the deleted values are not parsed
+            self.assertFalse(any('dedup' in kv._cache for kv in m._kv_all))
+
+            m = mmapdict(f, dedup=True)
+            m['c'] = b'y' * 100
+            m['d'] = b'y' * 100
+            dead_bytes = m.space_report().dead_bytes
+            # The deleted value is still referred to
+            del m['c']
+            self.assertEqual(m['d'], b'y' * 100)
+            self.assertEqual(m.space_report().dead_bytes, dead_bytes)
+
+
+class TestAdvice(unittest.TestCase):
+    def test_advise(self):
+        from unittest import mock
+        with tempfile.NamedTemporaryFile() as f:
+            m = mmapdict(f.name, dedup=True)
+            m['a'] = numpy.arange(100000)
+            m['b'] = numpy.arange(100000)
+            m['c'] = 'test'
+            a_range = (m._kv['a'].data_offset, m._kv['a'].data_length)
+            with self.assertRaises(ValueError):
+                m.advise(['a'], 'soon')
+            with self.assertRaises(KeyError):
+                m.prefetch(['nonexistent'])
+
+            if hasattr(os, 'posix_fadvise'):
+                with mock.patch('os.posix_fadvise') as fadvise:
+                    m.prefetch(['b', 'c'])
+                    m.evict(['a'])
+                calls = [(c[0][1], c[0][2], c[0][3]) for c in fadvise.call_args_list]
+                self.assertEqual(calls[0], a_range + (os.POSIX_FADV_WILLNEED, ))
+                self.assertEqual(calls[2], a_range + (os.POSIX_FADV_DONTNEED, ))
+
+            m = mmapdict(f.name, advice='sequential')
+            numpy.testing.assert_array_equal(m['a'], numpy.arange(100000))
+            m = mmapdict(f.name, immutable=True, advice='random')
+            numpy.testing.assert_array_equal(m['b'], numpy.arange(100000))
+            m.evict(['a', 'b', 'c'])
+            self.assertEqual(m['c'], 'test')
+            with self.assertRaises(ValueError):
+                mmapdict(f.name, advice='soon')
+
+    def test_populate(self):
+        with tempfile.NamedTemporaryFile() as f:
+            m = mmapdict(f.name)
+            m['a'] = numpy.arange(100000)
+            m['b'] = numpy.zeros(0)
+            m['c'] = 'test'
+
+            for kw in ({'populate': True}, {'hugepages': True}, {'populate': True, 'hugepages': True, 'immutable': True}):
+                m = mmapdict(f.name, stats=True, **kw)
+                numpy.testing.assert_array_equal(m['a'], numpy.arange(100000))
+                self.assertEqual(m['b'].shape, (0, ))
+                self.assertEqual(m['c'], 'test')
+                self.assertEqual(m.stats()['populate.count'], 3)
+
+
+class TestDurability(unittest.TestCase):
+    def test_durability(self):
+        with tempfile.TemporaryFile() as f:
+            with self.assertRaises(ValueError):
+                mmapdict(f, durability='sometimes')
+
+            m = mmapdict(f, durability='always', stats=True)
+            m['a'] = numpy.arange(10)
+            # Data, end of the entry and terminator, header
+            self.assertEqual(m.stats()['fsync.count'], 3)
+            del m['a']
+            self.assertEqual(m.stats()['fsync.count'], 5)
+
+            m = mmapdict(f, durability='batch', fsync_commits=3, fsync_interval=3600, stats=True)
+            for i in range(7):
+                m['b{}'.format(i)] = i
+            self.assertEqual(m.stats()['fsync.count'], 2)
+            m.sync()
+            self.assertEqual(m.stats()['fsync.count'], 3)
+
+            m = mmapdict(f, durability='batch', fsync_interval=0, stats=True)
+            m['c'] = 1
+            self.assertEqual(m.stats()['fsync.count'], 1)
+
+            m = mmapdict(f, stats=True)
+            m['d'] = 1
+            self.assertNotIn('fsync.count', m.stats())
+            self.assertEqual(set(m.keys()), {'b{}'.format(i) for i in range(7)} | {'c', 'd'})
+
+
+class TestChecksum(unittest.TestCase):
+    def test_checksum(self):
+        with tempfile.NamedTemporaryFile() as f:
+            m = mmapdict(f.name, checksums=True)
+            m['c'] = {'x': 1}
+            m['d'] = EmptyNDArray((2, 3), numpy.float64, capacity=4)
+            m.append_rows('d', numpy.ones((1, 3)))
+            m['e'] = numpy.zeros((1, 3))
+            m.append_rows('e', numpy.ones((1, 3)))
+            m['f'] = 1
+            m.append_rows('e', numpy.ones((1, 3)))
+            m = mmapdict(f.name, checksums=True, dedup=True)
+            m['a'] = numpy.arange(1000, dtype=numpy.int32)
+            m['b'] = numpy.arange(1000, dtype=numpy.int32)
+            self.assertEqual(m.verify(), [])
+            self.assertEqual(m.verify(workers=2, chunk_size=1000), [])
+
+            f.seek(0)
+            d = pickle.load(f)
+            numpy.testing.assert_array_equal(d['b'], numpy.arange(1000))
+            self.assertEqual(d['e'].shape, (3, 3))
+
+            # Corrupt the array written in 'a' (and referred to by 'b')
+            m['a'][500] = -1
+            self.assertEqual(m.verify(chunk_size=1000), ['a', 'b'])
+            self.assertEqual(m.verify(['c', 'b']), ['b'])
+            self.assertEqual(m['a'][500], -1)
+            m2 = mmapdict(f.name, verify_on_read=True)
+            self.assertEqual(m2['c'], {'x': 1})
+            with self.assertRaises(ValueError):
+                m2['b']
+
+    def test_data_ending_like_checksum(self):
+        # 49 is BININT1 '1', the pickle of these values ends with POP_MARK
+        values = {'a': 49, 'b': 'x1', 'c': b'1', 'd': b'(J\x00\x00\x00\x001'}
+        for checksums in (False, True):
+            with tempfile.TemporaryFile() as f:
+                m = mmapdict(f, checksums=checksums, verify_on_read=True)
+                for k, v in values.items():
+                    m[k] = v
+                m = mmapdict(f)
+                for k, v in values.items():
+                    self.assertEqual(m[k], v)
+                self.assertEqual(m.verify(), [])
+                self.assertTrue(m.fsck().valid)
+
 
 class TestVacuum(unittest.TestCase):
     def _dump_file(self, f):
@@ -605,6 +1550,64 @@ class TestVacuum(unittest.TestCase):
             m.vacuum()
             self.assertNotEqual(0, m.commit_number)
 
+    def test_space_report(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f, picklers=[GenericPickler])
+            for k in 'abcdef':
+                m[k] = k * 1000
+
+            report = m.space_report()
+            self.assertEqual(report.dead_bytes, 0)
+            self.assertEqual(report.dead_ratio, 0)
+            self.assertEqual(report.holes, [])
+            self.assertEqual(sorted(report.keys), list('abcdef'))
+            self.assertEqual(report.live_bytes, sum(report.keys.values()))
+            self.assertEqual(report.file_size, report.live_bytes + report.overhead)
+
+            size = report.keys['b']
+            del m['b']
+            del m['c']
+            m['e'] = 'x'
+            report = m.space_report(max_holes=1)
+            self.assertEqual(report.dead_bytes, 3 * size)
+            self.assertEqual(report.file_size, report.live_bytes + report.dead_bytes + report.overhead)
+            self.assertEqual(len(report.holes), 1)
+            self.assertEqual(report.holes[0][1], 2 * size)
+
+            m.vacuum()
+            report = m.space_report()
+            self.assertEqual(report.dead_bytes, 0)
+            f.seek(0, io.SEEK_END)
+            self.assertEqual(report.file_size, f.tell())
+
+    @unittest.skipUnless(hasattr(fcntl, 'F_OFD_SETLK'), "requires open file description locks")
+    def test_auto_vacuum(self):
+        with tempfile.NamedTemporaryFile() as f:
+            m = mmapdict(f.name, stats=True, auto_vacuum=0.2, auto_vacuum_min_bytes=0)
+            for i in range(4):
+                m[str(i)] = numpy.zeros((1000, ))
+
+            # A value is mapped in this process
+            value = m['0']
+            del m['1']
+            del m['2']
+            self.assertEqual(m.stats()['vacuum.deferred'], 2)
+            self.assertNotIn('vacuum.count', m.stats())
+            del value
+
+            # A value is mapped by another object
+            other = mmapdict(f.name, readonly=True)
+            value = other['0']
+            m['3'] = 1
+            self.assertEqual(m.stats()['vacuum.deferred'], 3)
+            del value
+
+            m['3'] = 2
+            self.assertEqual(m.stats()['vacuum.count'], 1)
+            self.assertEqual(m.space_report().dead_bytes, 0)
+            self.assertEqual(list(m.keys()), ['0', '3'])
+            numpy.testing.assert_array_equal(other['0'], numpy.zeros((1000, )))
+
 
 class TestConvert(unittest.TestCase):
     def _dump_file(self, f):
@@ -676,6 +1679,55 @@ class TestConvert(unittest.TestCase):
 
                 self.assertDictEqual(original_dict, dict(m))
 
+    def test_salvage(self):
+        with tempfile.TemporaryFile() as f:
+            m = mmapdict(f, checksums=True)
+            for i in range(6):
+                m['key{}'.format(i)] = numpy.arange(i * 100)
+            m['small'] = 1
+            m['last'] = 'test'
+            self.assertTrue(m.fsck(salvage=True))
+
+            # Torn writes at the end of key1, inside the data of key3, and in the frame header of key4
+            for k, shift in (('key1', len(m._kv['key1']) - 16), ('key3', 100), ('key4', 0)):
+                f.seek(m._kv[k].offset + shift)
+                f.write(b'\x00' * 16)
+            damaged = [(m._kv['key1'].offset, len(m._kv['key1'])),
+                       (m._kv['key3'].offset, m._kv['key5'].offset - m._kv['key3'].offset)]
+            f.seek(0, io.SEEK_END)
+            size = f.tell()
+
+            report = mmapdict(f).fsck(salvage=True)
+            self.assertFalse(report)
+            self.assertEqual(report.damaged, damaged)
+            self.assertEqual(report.truncated, 0)
+            self.assertEqual(report.entries, 5)
+
+            f.seek(0, io.SEEK_END)
+            self.assertEqual(f.tell(), size)
+            f.seek(0)
+            d = pickle.load(f)
+            self.assertEqual(set(d.keys()), {'key0', 'key2', 'key5', 'small', 'last'})
+            m = mmapdict(f)
+            self.assertEqual(set(m.keys()), {'key0', 'key2', 'key5', 'small', 'last'})
+            numpy.testing.assert_array_equal(m['key5'], numpy.arange(500))
+            self.assertEqual(m.verify(), [])
+            self.assertTrue(m.fsck(salvage=True))
+
+            # Damaged data in a valid frame is found by verify
+            f.seek(m._kv['key2'].offset + 40)
+            f.write(b'\x00' * 16)
+            self.assertTrue(m.fsck(salvage=True))
+            self.assertEqual(m.verify(), ['key2'])
+
+            # Without salvage, everything after the damaged region is lost
+            f.seek(m._kv['key5'].offset)
+            f.write(b'\x00')
+            report = m.fsck()
+            self.assertFalse(report)
+            self.assertEqual(report.entries, 4)  # Including the deleted entries in the damaged regions
+            self.assertEqual(set(m.keys()), {'key0', 'key2'})
+
 
 if __name__ == '__main__':
     unittest.main()